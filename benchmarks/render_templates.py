@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+Measure the time it takes to render job scripts.
+
+Compares compiling the job template for every job, as drmr used to,
+with the compiled template cache. No resource manager is needed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import timeit
+
+import jinja2
+
+import drmr.config
+
+
+def render_uncached(resource_manager, job_data):
+    template_data = resource_manager.make_job_script_data(job_data)
+    template_environment = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
+    return template_environment.from_string(resource_manager.default_job_template).render(**template_data)
+
+
+def render_cached(resource_manager, job_data):
+    return resource_manager.make_job_script(job_data)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark job script rendering.')
+    parser.add_argument('-n', '--jobs', type=int, default=2000, help='The number of jobs to render (default: %(default)s).')
+    parser.add_argument('-r', '--resource-manager', default='Slurm', choices=sorted(drmr.config.RESOURCE_MANAGERS.keys()), help='The resource manager whose template to render.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    resource_manager = drmr.config.get_resource_manager(args.resource_manager, {'template_cache': False})
+    job_data = {
+        'master_job_name': 'benchmark',
+        'job_name': 'benchmark.1',
+        'timestamp': '20160101000000',
+        'processors': '4',
+        'processor_memory': '8000',
+        'time_limit': '12h',
+        'dependencies': {'ok': ['1', '2', '3']},
+        'command': 'echo "hello world"',
+    }
+
+    print('Rendering {} {} job scripts\n'.format(args.jobs, args.resource_manager))
+    for label, render in [('compiled per job', render_uncached), ('compiled once', render_cached)]:
+        elapsed = timeit.timeit(lambda: render(resource_manager, job_data), number=args.jobs)
+        print('{:<20} {:>10.1f} us/job {:>10.3f} s total'.format(label, elapsed / args.jobs * 1e6, elapsed))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+Measure how long drmr takes to start.
+
+Each case runs in a new Python process, as drmr does when workflow
+tooling launches it, and the median of several runs is reported, less
+the time Python itself takes to start. With --max-ms, the exit status
+is non-zero if any case takes longer, so the benchmark can guard
+against slow imports creeping back in. No resource manager is needed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = [
+    ('import drmr.config', ['-c', 'import drmr.config']),
+    ('Slurm instance', ['-c', 'import drmr.config; drmr.config.get_resource_manager("Slurm", {})']),
+    ('PBS instance', ['-c', 'import drmr.config; drmr.config.get_resource_manager("PBS", {})']),
+    ('drmr --help', [os.path.join(PACKAGE_DIRECTORY, 'scripts', 'drmr'), '--help']),
+]
+
+
+def time_command(arguments, runs):
+    """Return the median time, in seconds, of running Python with the given arguments."""
+    environment = dict(os.environ, PYTHONPATH=PACKAGE_DIRECTORY)
+    timings = []
+    with open(os.devnull, 'w') as devnull:
+        for run in range(runs):
+            start = time.time()
+            subprocess.check_call([sys.executable] + arguments, env=environment, stdout=devnull)
+            timings.append(time.time() - start)
+    return sorted(timings)[runs // 2]
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Benchmark drmr startup.')
+    parser.add_argument('-n', '--runs', type=int, default=11, help='The number of times to run each case (default: %(default)s).')
+    parser.add_argument('--max-ms', type=float, help='Exit with a non-zero status if any case takes more than this many milliseconds, beyond the time Python takes to start.')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+
+    baseline = time_command(['-c', 'pass'], args.runs)
+    print('Median of {} runs, less {:.1f} ms to start Python\n'.format(args.runs, baseline * 1000))
+
+    too_slow = []
+    for label, arguments in CASES:
+        elapsed = (time_command(arguments, args.runs) - baseline) * 1000
+        print('{:<20} {:>10.1f} ms'.format(label, elapsed))
+        if args.max_ms is not None and elapsed > args.max_ms:
+            too_slow.append(label)
+
+    if too_slow:
+        print('\nSlower than {} ms: {}'.format(args.max_ms, ', '.join(too_slow)), file=sys.stderr)
+        sys.exit(1)
@@ -11,3 +11,13 @@
 __author__ = 'The Parker Lab'
 __email__ = 'parkerlab-software@umich.edu'
 __version__ = '1.0.2'
+
+
+def __getattr__(name):
+    # Pipeline is imported only when it's used, so commands that don't
+    # build pipelines don't pay for importing them. This works from
+    # Python 3.7; on earlier versions, import drmr.pipeline.
+    if name in ('Pipeline', 'PipelineResult'):
+        import drmr.pipeline
+        return getattr(drmr.pipeline, name)
+    raise AttributeError("module 'drmr' has no attribute '{}'".format(name))
@@ -8,33 +8,131 @@
 #
 
 
+import importlib
 import json
 import logging
 import os
 
-import drmr.drm.PBS
-import drmr.drm.Slurm
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
 import drmr.exceptions
 
 
-RESOURCE_MANAGERS = {
-    'PBS': drmr.drm.PBS.PBS,
-    'Slurm': drmr.drm.Slurm.Slurm,
+# The resource managers that come with drmr, as module:class.
+BUILTIN_RESOURCE_MANAGERS = {
+    'Local': 'drmr.drm.Local:Local',
+    'PBS': 'drmr.drm.PBS:PBS',
+    'Slurm': 'drmr.drm.Slurm:Slurm',
 }
 
+# The entry point group in which other packages can add resource managers.
+RESOURCE_MANAGER_ENTRY_POINT_GROUP = 'drmr.resource_managers'
+
+
+def load_object(location):
+    """Import the object named by a "module:attribute" string."""
+    module_name, _, attribute = location.partition(':')
+    return getattr(importlib.import_module(module_name), attribute)
+
+
+def find_entry_points(group):
+    """Return the installed entry points in the given group, by name."""
+    try:
+        import importlib.metadata
+    except ImportError:
+        try:
+            import pkg_resources
+        except ImportError:
+            return {}
+        return dict((entry_point.name, entry_point) for entry_point in pkg_resources.iter_entry_points(group))
+
+    entry_points = importlib.metadata.entry_points()
+    if hasattr(entry_points, 'select'):
+        entry_points = entry_points.select(group=group)
+    else:
+        entry_points = entry_points.get(group, [])
+    return dict((entry_point.name, entry_point) for entry_point in entry_points)
+
+
+class ResourceManagerRegistry(Mapping):
+    """
+    The resource manager classes drmr knows, by name, imported only when they're wanted.
+
+    Each resource manager is given as its class, or a "module:class"
+    string naming it, so a site using one never imports the others or
+    what they need, like PBS's lxml. Packages can add resource
+    managers with entry points in entry_point_group; those are only
+    looked for when a name isn't otherwise known, or every name is
+    wanted, as by iteration. Names given here take precedence.
+    """
+
+    def __init__(self, resource_managers, entry_point_group=None):
+        self.resource_managers = dict(resource_managers)
+        self.entry_point_group = entry_point_group
+        self.entry_points = None
+        self.classes = {}
+
+    def register(self, name, resource_manager):
+        """Add a resource manager class, or the "module:class" string naming one."""
+        self.resource_managers[name] = resource_manager
+        self.classes.pop(name, None)
+
+    def get_entry_points(self):
+        if self.entry_points is None:
+            self.entry_points = self.entry_point_group and find_entry_points(self.entry_point_group) or {}
+        return self.entry_points
+
+    def __getitem__(self, name):
+        if name not in self.classes:
+            if name in self.resource_managers:
+                resource_manager = self.resource_managers[name]
+                if hasattr(resource_manager, 'partition'):
+                    resource_manager = load_object(resource_manager)
+            elif name in self.get_entry_points():
+                resource_manager = self.get_entry_points()[name].load()
+            else:
+                raise KeyError(name)
+            self.classes[name] = resource_manager
+        return self.classes[name]
+
+    def __contains__(self, name):
+        return name in self.resource_managers or name in self.get_entry_points()
+
+    def __iter__(self):
+        return iter(sorted(set(self.resource_managers) | set(self.get_entry_points())))
+
+    def __len__(self):
+        return len(set(self.resource_managers) | set(self.get_entry_points()))
+
+
+RESOURCE_MANAGERS = ResourceManagerRegistry(BUILTIN_RESOURCE_MANAGERS, RESOURCE_MANAGER_ENTRY_POINT_GROUP)
+
 
 def get_available_resource_managers():
+    logger = logging.getLogger("{}.{}".format(__name__, get_available_resource_managers.__name__))
+
     available_resource_managers = []
-    for name, rm in RESOURCE_MANAGERS.items():
-        if rm().is_installed():
+    for name in RESOURCE_MANAGERS:
+        try:
+            rm = RESOURCE_MANAGERS[name]
+        except ImportError as e:
+            logger.debug('Could not load resource manager {}: {}'.format(name, e))
+            continue
+        if rm.detectable and rm().is_installed():
             available_resource_managers.append(name)
     return available_resource_managers
 
 
-def get_resource_manager(name):
-    """Given the name of a resource manager, return an instance of it."""
+def get_resource_manager(name, config=None):
+    """Given the name of a resource manager, return an instance of it, configured with the given settings."""
     if name in RESOURCE_MANAGERS:
-        return RESOURCE_MANAGERS[name]()
+        try:
+            return RESOURCE_MANAGERS[name](config)
+        except ImportError as e:
+            raise drmr.exceptions.ConfigurationError('Could not load resource manager "{}": {}'.format(name, e))
     raise drmr.exceptions.ConfigurationError('Unrecognized resource manager "{}"'.format(name))
 
 
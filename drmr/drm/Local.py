@@ -0,0 +1,534 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+from __future__ import print_function
+
+import collections
+import multiprocessing
+import os
+import re
+import signal
+import subprocess
+import textwrap
+import threading
+import time
+
+import drmr
+import drmr.drm.base
+import drmr.exceptions
+import drmr.util
+
+
+class LocalJob(object):
+    """A job, or one task of an array job, run by the Local resource manager."""
+
+    __slots__ = [
+        'array_id',
+        'array_task_id',
+        'concurrency',
+        'dependencies',
+        'environment',
+        'filename',
+        'job_id',
+        'memory',
+        'name',
+        'output',
+        'process',
+        'processors',
+        'started',
+        'state',
+        'tasks',
+        'time_limit',
+        'working_directory',
+    ]
+
+    def __init__(self, job_id, name, filename):
+        self.job_id = job_id
+        self.name = name
+        self.filename = filename
+        self.array_id = None
+        self.array_task_id = None
+        self.concurrency = None
+        self.dependencies = {}
+        self.environment = {}
+        self.memory = 0
+        self.output = None
+        self.process = None
+        self.processors = 1
+        self.started = None
+        self.state = 'pending'
+        self.tasks = []
+        self.time_limit = None
+        self.working_directory = None
+
+    @property
+    def finished(self):
+        return self.state in Local.finished_states
+
+
+class Local(drmr.drm.base.DistributedResourceManager):
+    """
+    Runs jobs on this machine, as many at once as its processors and memory allow.
+
+    Jobs are run by the process that submits them, which must call
+    wait_for_jobs before exiting. Job scripts and output go in the
+    control directory, just as with a cluster resource manager.
+    """
+
+    name = 'Local'
+
+    # Local is always available, so it's only used when configured.
+    detectable = False
+
+    default_job_template = textwrap.dedent(
+        """
+        #!/bin/bash
+
+        ####  Local preamble
+
+        #LOCAL --job-name={{job_name}}
+        #LOCAL --processors={{processors|default(1)}}
+        {% if memory %}
+        #LOCAL --memory={{memory}}
+        {% elif processor_memory %}
+        #LOCAL --processor-memory={{processor_memory}}
+        {% endif %}
+        {% if time_limit %}
+        #LOCAL --time={{time_limit}}
+        {% endif %}
+        {% if array_controls %}
+        #LOCAL --output={{control_directory}}/{{job_name}}_%A_%a.out
+        {% else %}
+        #LOCAL --output={{control_directory}}/{{job_name}}_%j.out
+        {% endif %}
+        {% if dependencies %}
+        #LOCAL --dependency={{resource_manager.make_dependency_string(dependencies)}}
+        {% endif %}
+        {% if working_directory %}
+        #LOCAL --workdir={{working_directory}}
+        {% endif %}
+        {% if array_controls %}
+        #LOCAL --array={{array_controls['array_index_min']|default(1)}}-{{array_controls['array_index_max']|default(1)}}{% if array_controls['array_concurrent_jobs'] %}%{{array_controls['array_concurrent_jobs']}}{% endif %}
+
+        {% endif %}
+        {% if raw_preamble %}
+        {{raw_preamble}}
+        {% endif %}
+
+
+        ####  End Local preamble
+
+        {% if notes %}
+        ####  Notes
+        {{notes}}
+        {% endif %}
+
+        {% if environment_setup %}
+        ####  Environment setup
+        {% for line in environment_setup %}
+        {{line}}
+        {% endfor %}
+        {% endif %}
+
+        ####  Commands
+
+        {{command}}
+
+
+        """
+    ).lstrip()
+
+    default_array_command_template = textwrap.dedent(
+        """
+        if [ "$LOCAL_ARRAY_TASK_ID" = "{{index}}" ]; then
+            {{command}}
+        fi
+        """
+    )
+
+    default_array_table_command_template = textwrap.dedent(
+        """
+        drmr_command_table="{{command_table}}"
+        read drmr_command_offset drmr_command_length < <(dd if="${drmr_command_table}.index" bs={{record_width}} skip=$(($LOCAL_ARRAY_TASK_ID + {{index_offset}} - 1)) count=1 2>/dev/null)
+        eval "$(tail -c +$((10#${drmr_command_offset} + 1)) "${drmr_command_table}" | head -c $((10#${drmr_command_length})))"
+        """
+    ).strip()
+
+    telemetry_job_id_expression = '${LOCAL_ARRAY_JOB_ID:-$LOCAL_JOB_ID}'
+    telemetry_array_task_id_expression = '${LOCAL_ARRAY_TASK_ID:-}'
+
+    job_dependency_states = [
+        'any',
+        'notok',
+        'ok',
+    ]
+
+    finished_states = ('cancelled', 'failed', 'ok')
+
+    preamble_re = re.compile(r'^#LOCAL\s+--(?P<option>[a-z-]+)=(?P<value>.*)$')
+    argument_re = re.compile(r'^--(?P<option>[a-z-]+)=(?P<value>.*)$')
+    time_limit_re = re.compile(r'^(\d+):(\d+):(\d+)$')
+
+    def __init__(self, config=None):
+        super(Local, self).__init__(config)
+        self.condition = threading.Condition()
+        self.jobs = collections.OrderedDict()
+        self.last_job_id = 0
+        self.scheduler = None
+        self.total_processors = int(self.config.get('local_processors') or multiprocessing.cpu_count())
+        self.total_memory = int(self.config.get('local_memory') or self.get_physical_memory())
+        self.free_processors = self.total_processors
+        self.free_memory = self.total_memory
+
+    def get_physical_memory(self):
+        """Return the machine's memory in megabytes, or 0 if it can't be determined."""
+        try:
+            return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1000 * 1000)
+        except (AttributeError, ValueError, OSError):
+            return 0
+
+    def probe_capabilities(self):
+        return self.make_capabilities(True, drmr.__version__, hold=False, max_array_tasks=None)
+
+    def validate_destination(self, destination):
+        # there's only here
+        return True
+
+    def make_dependency_string(self, dependencies):
+        dependency_list = []
+        if dependencies:
+            if not isinstance(dependencies, collections.Mapping):
+                raise ValueError('Job data does not contain a map under the "dependencies" key.')
+            for state, job_ids in sorted(dependencies.items()):
+                if state not in self.job_dependency_states:
+                    raise ValueError('Unsupported dependency state: %s' % state)
+                if job_ids:
+                    dependency_list.append('%s:%s' % (state, ':'.join(str(job_id) for job_id in job_ids)))
+        return ','.join(dependency_list)
+
+    def parse_dependency_string(self, dependency_string):
+        dependencies = {}
+        for dependency in dependency_string.split(','):
+            fields = dependency.split(':')
+            if len(fields) > 1:
+                dependencies.setdefault(fields[0], []).extend(fields[1:])
+        return dependencies
+
+    def set_mail_event_string(self, job_data):
+        pass
+
+    def write_cancel_script(self, job_data, job_ids):
+        logger = self.get_method_logger()
+        logger.debug('Writing canceller script for {}'.format(job_data))
+
+        self.set_control_directory(job_data)
+        filename = drmr.util.absjoin(job_data['control_directory'], job_data['job_name'])
+        drmr.util.makedirs(job_data['control_directory'])
+        with open(filename, 'w') as canceller:
+            canceller.write('#!/bin/sh\n\n')
+            canceller.write('# Local jobs are run by the drmr process that submitted them; stopping it cancels them.\n')
+            canceller.write('kill -TERM %d\n' % os.getpid())
+            os.chmod(filename, 0o755)
+
+    def read_job_file(self, job_filename):
+        """Read the job parameters from a job file's preamble."""
+        options = {}
+        with open(job_filename) as job_file:
+            for line in job_file:
+                if line.startswith('####  End Local preamble'):
+                    break
+                match = self.preamble_re.match(line.strip())
+                if match:
+                    options[match.group('option')] = match.group('value')
+        return options
+
+    def make_submit_arguments(self, job_data):
+        arguments = [
+            '--job-name={}'.format(job_data['job_name']),
+            '--output={}/{}_%j.out'.format(job_data['control_directory'], job_data['job_name']),
+            '--export=DRMR_COMMAND_INDEX={}'.format(job_data['command_index']),
+        ]
+        if job_data.get('dependencies'):
+            arguments.append('--dependency={}'.format(self.make_dependency_string(job_data['dependencies'])))
+        return arguments
+
+    def parse_submit_arguments(self, arguments):
+        """Parse submission arguments, which look like the job file's preamble options, without "#LOCAL"."""
+        options = {}
+        for argument in arguments or []:
+            match = self.argument_re.match(argument)
+            if not match:
+                raise ValueError('Invalid argument for Local job submission: {}'.format(argument))
+            options[match.group('option')] = match.group('value')
+        return options
+
+    def parse_time_limit(self, time_limit):
+        match = self.time_limit_re.match(time_limit)
+        if not match:
+            time_limit = drmr.util.normalize_time(time_limit)
+            match = self.time_limit_re.match(time_limit)
+        hours, minutes, seconds = [int(field) for field in match.groups()]
+        return hours * 60 * 60 + minutes * 60 + seconds
+
+    def submit(self, job_filename, hold=False, arguments=None):
+        logger = self.get_method_logger()
+
+        if hold:
+            logger.warning('Local jobs cannot be held; {} will run as soon as possible.'.format(job_filename))
+
+        options = self.read_job_file(job_filename)
+        options.update(self.parse_submit_arguments(arguments))
+        processors = int(options.get('processors', 1))
+        if 'memory' in options:
+            memory = int(drmr.util.normalize_memory(options['memory']))
+        else:
+            memory = int(drmr.util.normalize_memory(options.get('processor-memory', '0'))) * processors
+
+        if processors > self.total_processors:
+            logger.warning('{} requests {} processors, but only {} are available; limiting it.'.format(job_filename, processors, self.total_processors))
+            processors = self.total_processors
+        if not self.total_memory:
+            memory = 0  # we can't tell how much there is, so we can't ration it
+        elif memory > self.total_memory:
+            logger.warning('{} requests {}MB of memory, but only {}MB is available; limiting it.'.format(job_filename, memory, self.total_memory))
+            memory = self.total_memory
+
+        with self.condition:
+            self.last_job_id += 1
+            job = LocalJob(str(self.last_job_id), options.get('job-name', os.path.basename(job_filename)), job_filename)
+            job.processors = processors
+            job.memory = memory
+            job.output = options.get('output')
+            job.working_directory = options.get('workdir')
+            if options.get('export'):
+                job.environment = dict(variable.split('=', 1) for variable in options['export'].split(','))
+            if options.get('time'):
+                job.time_limit = self.parse_time_limit(options['time'])
+
+            job.dependencies = self.parse_dependency_string(options.get('dependency', ''))
+            for state, job_ids in job.dependencies.items():
+                unknown_job_ids = [job_id for job_id in job_ids if job_id not in self.jobs]
+                if unknown_job_ids:
+                    logger.warning('{} depends on jobs not run here, which will be ignored: {}'.format(job_filename, ', '.join(unknown_job_ids)))
+                    job.dependencies[state] = [job_id for job_id in job_ids if job_id in self.jobs]
+
+            if options.get('array'):
+                indexes, _, concurrency = options['array'].partition('%')
+                first, _, last = indexes.partition('-')
+                job.concurrency = concurrency and int(concurrency) or None
+                for task_id in range(int(first), int(last or first) + 1):
+                    task = LocalJob('{}_{}'.format(job.job_id, task_id), job.name, job_filename)
+                    for attribute in ['dependencies', 'environment', 'memory', 'output', 'processors', 'time_limit', 'working_directory']:
+                        setattr(task, attribute, getattr(job, attribute))
+                    task.array_id = job.job_id
+                    task.array_task_id = task_id
+                    job.tasks.append(task)
+                    self.jobs[task.job_id] = task
+
+            self.jobs[job.job_id] = job
+            self.start_scheduler()
+            self.condition.notify_all()
+
+        logger.debug('Submitted {} as job {}'.format(job_filename, job.job_id))
+        return job.job_id
+
+    def start_scheduler(self):
+        if self.scheduler is None:
+            self.scheduler = threading.Thread(target=self.schedule, name='drmr-local-scheduler')
+            self.scheduler.daemon = True
+            self.scheduler.start()
+
+    def get_dependency_status(self, job):
+        """
+        Decide whether a job's dependencies allow it to run.
+
+        Returns True if they're satisfied, False if they never can be,
+        or None if we have to wait and see.
+        """
+        status = True
+        for state, job_ids in job.dependencies.items():
+            for job_id in job_ids:
+                dependency = self.jobs[job_id]
+                if not dependency.finished:
+                    status = None
+                elif state == 'ok' and dependency.state != 'ok':
+                    return False
+                elif state == 'notok' and dependency.state == 'ok':
+                    return False
+        return status
+
+    def schedule(self):
+        """Start jobs as their dependencies and the machine's resources allow, until all are done."""
+        logger = self.get_method_logger()
+
+        with self.condition:
+            while True:
+                now = time.time()
+                for job in self.jobs.values():
+                    if job.tasks:
+                        if not job.finished and all(task.finished for task in job.tasks):
+                            job.state = all(task.state == 'ok' for task in job.tasks) and 'ok' or 'failed'
+                            self.condition.notify_all()
+                        continue
+
+                    if job.state == 'running':
+                        if job.time_limit and now - job.started > job.time_limit:
+                            logger.warning('Job {} exceeded its time limit; stopping it.'.format(job.job_id))
+                            self.stop_process(job)
+                        continue
+
+                    if job.state != 'pending':
+                        continue
+
+                    dependency_status = self.get_dependency_status(job)
+                    if dependency_status is False:
+                        logger.debug('Dependencies of job {} can never be satisfied; cancelling it.'.format(job.job_id))
+                        job.state = 'cancelled'
+                        self.condition.notify_all()
+                    elif dependency_status:
+                        if job.array_id is not None:
+                            array = self.jobs[job.array_id]
+                            if array.concurrency and len([t for t in array.tasks if t.state == 'running']) >= array.concurrency:
+                                continue
+                        if job.processors <= self.free_processors and job.memory <= self.free_memory:
+                            self.start_job(job)
+
+                if all(job.finished for job in self.jobs.values()):
+                    # submit will start another scheduler if needed
+                    self.scheduler = None
+                    self.condition.notify_all()
+                    return
+
+                self.condition.wait(1.0)
+
+    def start_job(self, job):
+        logger = self.get_method_logger()
+
+        environment = dict(os.environ)
+        environment.update(job.environment)
+        environment['LOCAL_JOB_ID'] = job.job_id
+        output = job.output or os.devnull
+        if job.array_id is not None:
+            environment['LOCAL_ARRAY_JOB_ID'] = job.array_id
+            environment['LOCAL_ARRAY_TASK_ID'] = str(job.array_task_id)
+            output = output.replace('%A', job.array_id).replace('%a', str(job.array_task_id))
+        output = output.replace('%j', job.job_id)
+
+        logger.debug('Starting job {} ({})'.format(job.job_id, job.name))
+        try:
+            with open(os.devnull) as input_file, open(output, 'w') as output_file:
+                job.process = subprocess.Popen(
+                    ['/bin/bash', job.filename],
+                    cwd=job.working_directory or None,
+                    env=environment,
+                    stdin=input_file,
+                    stdout=output_file,
+                    stderr=subprocess.STDOUT,
+                )
+        except (IOError, OSError) as e:
+            logger.error('Could not start job {}: {}'.format(job.job_id, e))
+            job.state = 'failed'
+            return
+
+        job.state = 'running'
+        job.started = time.time()
+        self.free_processors -= job.processors
+        self.free_memory -= job.memory
+
+        waiter = threading.Thread(target=self.wait_for_process, args=(job,), name='drmr-local-job-{}'.format(job.job_id))
+        waiter.daemon = True
+        waiter.start()
+
+    def wait_for_process(self, job):
+        returncode = job.process.wait()
+        with self.condition:
+            job.state = returncode == 0 and 'ok' or 'failed'
+            self.free_processors += job.processors
+            self.free_memory += job.memory
+            self.condition.notify_all()
+
+    def stop_process(self, job):
+        try:
+            job.process.terminate()
+        except OSError:
+            pass  # already gone
+
+    def get_active_job_ids(self, job_ids=None, job_name=None, job_owner=None):
+        with self.condition:
+            return set(
+                job.job_id for job in self.jobs.values()
+                if job.array_id is None
+                and not job.finished
+                and (not job_ids or job.job_id in job_ids)
+                and (not job_name or job_name in job.name)
+            )
+
+    def get_job_states(self, job_ids):
+        # Only jobs submitted by this process are known.
+        categories = {'cancelled': 'failed', 'failed': 'failed', 'ok': 'done', 'pending': 'pending', 'running': 'running'}
+        with self.condition:
+            return dict(
+                (job_id, job_id in self.jobs and categories[self.jobs[job_id].state] or 'unknown')
+                for job_id in job_ids
+            )
+
+    def get_job_usage(self, job_ids):
+        # Jobs are forgotten when drmr exits, and their usage with them.
+        return {}
+
+    def delete_jobs(self, job_ids=None, job_name=None, job_owner=None, dry_run=False):
+        logger = self.get_method_logger()
+
+        targets = self.get_active_job_ids(job_ids, job_name, job_owner)
+        if not targets:
+            return
+
+        if dry_run:
+            logger.info(self.explain_job_deletion(targets, job_name, job_owner or 'this process', dry_run))
+            return
+
+        with self.condition:
+            for job_id in targets:
+                job = self.jobs[job_id]
+                for target in job.tasks or [job]:
+                    if target.state == 'pending':
+                        target.state = 'cancelled'
+                    elif target.state == 'running':
+                        self.stop_process(target)
+            self.condition.notify_all()
+
+    def wait_for_jobs(self):
+        """
+        Run the submitted jobs to completion.
+
+        Returns True if all of them succeeded. If this process is
+        interrupted or terminated, the jobs are cancelled.
+        """
+
+        logger = self.get_method_logger()
+
+        def cancel(signum, frame):
+            logger.info('Cancelling jobs.')
+            self.delete_jobs()
+
+        previous_handler = signal.signal(signal.SIGTERM, cancel)
+        try:
+            with self.condition:
+                while not all(job.finished for job in self.jobs.values()):
+                    try:
+                        self.condition.wait(1.0)
+                    except KeyboardInterrupt:
+                        cancel(signal.SIGINT, None)
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+
+        failed_jobs = [job.job_id for job in self.jobs.values() if job.array_id is None and job.state != 'ok']
+        if failed_jobs:
+            logger.debug('These jobs failed or were cancelled: {}'.format(', '.join(failed_jobs)))
+        return not failed_jobs
@@ -14,16 +14,33 @@ import logging
 import os
 import re
 import subprocess
-import time
 import textwrap
 
-import lxml.objectify
-
 import drmr
 import drmr.drm.base
 import drmr.util
 
 
+def parse_pbs_duration(duration):
+    """Convert a duration reported by qstat, like 01:02:03, to seconds."""
+    if duration is None or not str(duration):
+        return None
+    seconds = 0
+    for part in str(duration).split(':'):
+        seconds = seconds * 60 + int(part)
+    return seconds
+
+
+def parse_pbs_memory(memory):
+    """Convert an amount of memory reported by qstat, like 123456kb, to megabytes."""
+    if memory is None:
+        return None
+    match = re.match('^(\d+)([kmgt]?)b?$', str(memory).lower())
+    if not match:
+        return None
+    return drmr.util.get_megabytes(match.group(1), match.group(2))
+
+
 class PBS(drmr.drm.base.DistributedResourceManager):
     name = 'PBS'
 
@@ -109,6 +126,18 @@ class PBS(drmr.drm.base.DistributedResourceManager):
         """
     )
 
+    default_array_table_command_template = textwrap.dedent(
+        """
+        drmr_command_table="{{command_table}}"
+        read drmr_command_offset drmr_command_length < <(dd if="${drmr_command_table}.index" bs={{record_width}} skip=$(($PBS_ARRAYID + {{index_offset}} - 1)) count=1 2>/dev/null)
+        eval "$(tail -c +$((10#${drmr_command_offset} + 1)) "${drmr_command_table}" | head -c $((10#${drmr_command_length})))"
+        """
+    ).strip()
+
+    # array tasks have IDs like JOBID[TASK], the array JOBID[]
+    telemetry_job_id_expression = '${PBS_JOBID/\\[*\\]/[]}'
+    telemetry_array_task_id_expression = '${PBS_ARRAYID:-}'
+
     job_dependency_states = [
         'any',
         'notok',
@@ -124,6 +153,38 @@ class PBS(drmr.drm.base.DistributedResourceManager):
 
     array_job_id_re = re.compile('^\S+\[.*\]')
 
+    array_task_index_re = re.compile('\[\d+\]')
+
+    # What qstat job states mean to get_job_states; C depends on the exit status
+    job_state_categories = {
+        'E': 'running',
+        'H': 'pending',
+        'Q': 'pending',
+        'R': 'running',
+        'S': 'pending',
+        'T': 'pending',
+        'W': 'pending',
+    }
+
+    server_version_re = re.compile('pbs_version = (\S+)')
+
+    # PBS is frail: delete fewer jobs at once, and submit and delete them more slowly
+    deletion_batch_size = 100
+    deletion_concurrency = 2
+    deletion_rate = 4.0
+    submission_rate = 10.0
+
+    transient_submission_errors = [
+        'cannot connect to server',
+        'End of File',
+        'Pbs Server is currently too busy',
+        'Premature end of message',
+        'Request timed out',
+    ]
+
+    # TORQUE calls it max_job_array_size, PBS Professional max_array_size
+    max_array_size_re = re.compile('max_(?:job_)?array_size = (\d+)')
+
     def delete_jobs(self, job_ids=None, job_name=None, job_owner=None, dry_run=False):
         logger = self.get_method_logger()
 
@@ -139,26 +200,36 @@ class PBS(drmr.drm.base.DistributedResourceManager):
             else:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug(self.explain_job_deletion(targets, job_name, job_owner, dry_run))
-                for target in sorted(targets):
-                    command = ['qdel', target]
-                    try:
-                        subprocess.check_call(command)
-                    except subprocess.CalledProcessError as e:
-                        raise drmr.exceptions.DeletionError(e.returncode, e.cmd, e.output, [target])
-                    time.sleep(0.25)  # PBS is frail
+                self.delete_job_batches(targets)
 
     def get_active_job_ids(self, job_ids=None, job_name=None, job_owner=None):
         logger = self.get_method_logger()
 
-        if job_ids is None:
-            job_ids = []
+        # job IDs may be given as integers, but are compared and passed to the scheduler as strings
+        job_ids = [str(job_id) for job_id in job_ids or []]
 
         jobs = set([])
 
+        # Only job IDs can be pushed down to qstat: TORQUE can't filter
+        # its XML output by owner, and only matches whole job names.
         command = ['qstat', '-t', '-x']
-
-        qstat = lxml.objectify.fromstring(self.capture_process_output(command))
-        for job in qstat.findall('Job'):
+        try:
+            if job_ids:
+                # in batches, as a command line can only be so long
+                queued_jobs = []
+                sorted_job_ids = sorted(job_ids)
+                for i in range(0, len(sorted_job_ids), self.job_state_batch_size):
+                    queued_jobs.extend(self.get_queue_snapshot(command + sorted_job_ids[i:i + self.job_state_batch_size], self.parse_qstat_output))
+            else:
+                queued_jobs = self.get_queue_snapshot(command, self.parse_qstat_output)
+        except (OSError, subprocess.CalledProcessError) as e:
+            if not job_ids:
+                raise
+            # qstat fails if any of the jobs have left the queue
+            logger.debug('qstat rejected job IDs {} ({}); listing all jobs instead.'.format(job_ids, e))
+            queued_jobs = self.get_queue_snapshot(command, self.parse_qstat_output)
+
+        for job in queued_jobs:
             if job.job_state not in ['E', 'H', 'Q', 'R', 'T', 'W']:
                 continue
 
@@ -181,27 +252,72 @@ class PBS(drmr.drm.base.DistributedResourceManager):
 
         return jobs
 
-    def is_installed(self):
+    def get_job_states(self, job_ids):
+        # Finished jobs are only listed if the server keeps them, so
+        # the whole queue is read, as naming a purged job makes qstat fail.
+        task_states = {}
+        for job in self.get_queue_snapshot(['qstat', '-t', '-x'], self.parse_qstat_output):
+            state = job.job_state.text
+            if state == 'C':
+                exit_status = getattr(job, 'exit_status', None)
+                state = exit_status is not None and int(exit_status) == 0 and 'done' or 'failed'
+            else:
+                state = self.job_state_categories.get(state, 'unknown')
+            # array tasks are reported as JOBID[TASK], the array as JOBID[]
+            task_states.setdefault(self.array_task_index_re.sub('[]', job.Job_Id.text), []).append(state)
+
+        return dict((str(job_id), self.combine_job_states(task_states.get(str(job_id), []))) for job_id in job_ids)
+
+    def get_job_usage(self, job_ids):
+        job_ids = set(str(job_id) for job_id in job_ids)
+        usage = {}
+        for job in self.get_queue_snapshot(['qstat', '-t', '-x'], self.parse_qstat_output):
+            job_id = job.Job_Id.text
+            if job_id not in job_ids or job.job_state.text != 'C':
+                continue
+            exit_status = getattr(job, 'exit_status', None)
+            resources_used = getattr(job, 'resources_used', None)
+            usage[job_id] = {
+                'state': exit_status is not None and int(exit_status) == 0 and 'done' or 'failed',
+                'elapsed': parse_pbs_duration(getattr(resources_used, 'walltime', None)),
+                'cpu_time': parse_pbs_duration(getattr(resources_used, 'cput', None)),
+                'max_rss': parse_pbs_memory(getattr(resources_used, 'mem', None)),
+            }
+        return usage
+
+    def parse_qstat_output(self, output):
+        """Parse the XML output of qstat -x into a list of its Job elements."""
+        if not output.strip():
+            return []
+
+        # imported here, so sites without PBS don't need lxml, and
+        # commands that never query the queue don't wait for it
+        import lxml.objectify
+
+        return lxml.objectify.fromstring(output).findall('Job')
+
+    def probe_capabilities(self):
         output = ''
         try:
             output = self.capture_process_output(['qmgr', '-c', 'list server'])
         except:
             pass
-        return 'pbs_version = ' in output
 
-    def write_cancel_script(self, job_data, job_ids):
-        logger = self.get_method_logger()
-        logger.debug('Writing canceller script for {}'.format(job_data))
-
-        self.set_control_directory(job_data)
-        filename = drmr.util.absjoin(job_data['control_directory'], job_data['job_name'])
-        if not os.path.exists(job_data['control_directory']):
-            os.makedirs(job_data['control_directory'])
-        with open(filename, 'w') as canceller:
-            canceller.write('#!/bin/sh\n\n')
-            for job_id in job_ids:
-                canceller.write('qdel %s; sleep 0.25\n' % job_id)
-            os.chmod(filename, 0o755)
+        installed = 'pbs_version = ' in output
+        version = None
+        match = self.server_version_re.search(output)
+        if match:
+            version = match.group(1)
+
+        max_array_tasks = None
+        match = self.max_array_size_re.search(output)
+        if match:
+            max_array_tasks = int(match.group(1))
+
+        return self.make_capabilities(installed, version, max_array_tasks=max_array_tasks)
+
+    def make_deletion_command(self, job_ids):
+        return ['qdel'] + list(job_ids)
 
     def make_dependency_string(self, dependencies):
         dependency_string = ''
@@ -230,22 +346,40 @@ class PBS(drmr.drm.base.DistributedResourceManager):
                 )
             )
 
-    def submit(self, job_filename, hold=False):
-        if not self.is_installed():
-            raise drmr.exceptions.ConfigurationError('{} is not installed or not usable.'.format(self.name))
+    def make_submit_arguments(self, job_data):
+        arguments = [
+            '-N', job_data['job_name'],
+            '-v', 'DRMR_COMMAND_INDEX={}'.format(job_data['command_index']),
+        ]
+        if job_data.get('dependencies'):
+            arguments.extend(['-W', 'depend={}'.format(self.make_dependency_string(job_data['dependencies']))])
+        return arguments
+
+    def submit(self, job_filename, hold=False, arguments=None):
+        self.require_installed()
 
         try:
-            command = ['qsub', job_filename]
+            command = ['qsub'] + (arguments or []) + [job_filename]
             if hold:
                 command.insert(1, '-h')
-            job_id = self.capture_process_output(command)
+            job_id = self.run_submission_command(command, os.path.splitext(os.path.basename(job_filename))[0])
+            self.invalidate_queue_snapshots()
             return job_id.strip()
         except subprocess.CalledProcessError as e:
             raise drmr.exceptions.SubmissionError(e.returncode, e.cmd, e.output)
 
+    def list_destinations(self):
+        self.require_installed()
+
+        try:
+            status = self.capture_process_output(['qstat', '-Q', '-f'])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        return frozenset(re.findall(r'^Queue: (\S+)', status, re.MULTILINE))
+
     def validate_destination(self, destination):
-        if not self.is_installed():
-            raise drmr.exceptions.ConfigurationError('{} is not installed or not usable.'.format(self.name))
+        self.require_installed()
 
         valid = False
         try:
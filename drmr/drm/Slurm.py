@@ -10,8 +10,10 @@
 from __future__ import print_function
 
 import collections
+import getpass
 import logging
 import os
+import re
 import subprocess
 import textwrap
 
@@ -20,6 +22,26 @@ import drmr.drm.base
 import drmr.util
 
 
+def parse_slurm_duration(duration):
+    """Convert a duration reported by sacct, like 1-02:03:04 or 03:04.567, to seconds."""
+    if not duration:
+        return None
+    days, _, clock = duration.rpartition('-')
+    seconds = 0
+    for part in clock.split(':'):
+        seconds = seconds * 60 + float(part)
+    return int(round(int(days or 0) * 24 * 60 * 60 + seconds))
+
+
+def parse_slurm_memory(memory):
+    """Convert an amount of memory reported by sacct, like 1234K or 1.5G, to megabytes."""
+    if not memory:
+        return None
+    if memory[-1] in 'KMGT':
+        return drmr.util.get_megabytes(memory[:-1], memory[-1])
+    return drmr.util.get_megabytes(memory)
+
+
 class Slurm(drmr.drm.base.DistributedResourceManager):
     name = 'Slurm'
 
@@ -107,12 +129,25 @@ class Slurm(drmr.drm.base.DistributedResourceManager):
         """
     )
 
+    default_array_table_command_template = textwrap.dedent(
+        """
+        drmr_command_table="{{command_table}}"
+        read drmr_command_offset drmr_command_length < <(dd if="${drmr_command_table}.index" bs={{record_width}} skip=$(($SLURM_ARRAY_TASK_ID + {{index_offset}} - 1)) count=1 2>/dev/null)
+        eval "$(tail -c +$((10#${drmr_command_offset} + 1)) "${drmr_command_table}" | head -c $((10#${drmr_command_length})))"
+        """
+    ).strip()
+
+    telemetry_job_id_expression = '${SLURM_ARRAY_JOB_ID:-$SLURM_JOB_ID}'
+    telemetry_array_task_id_expression = '${SLURM_ARRAY_TASK_ID:-}'
+
     job_dependency_states = [
         'any',
         'notok',
         'ok',
     ]
 
+    max_array_size_re = re.compile('^MaxArraySize\s*=\s*(\d+)', re.MULTILINE)
+
     job_state_map = {
         'any': 'any',
         'notok': 'notok',
@@ -120,12 +155,41 @@ class Slurm(drmr.drm.base.DistributedResourceManager):
         'start': '',
     }
 
+    # What sacct and squeue job states mean to get_job_states
+    job_state_categories = {
+        'BOOT_FAIL': 'failed',
+        'CANCELLED': 'failed',
+        'COMPLETED': 'done',
+        'COMPLETING': 'running',
+        'CONFIGURING': 'running',
+        'DEADLINE': 'failed',
+        'FAILED': 'failed',
+        'NODE_FAIL': 'failed',
+        'OUT_OF_MEMORY': 'failed',
+        'PENDING': 'pending',
+        'PREEMPTED': 'failed',
+        'REQUEUED': 'pending',
+        'RESIZING': 'running',
+        'RUNNING': 'running',
+        'STAGE_OUT': 'running',
+        'SUSPENDED': 'pending',
+        'TIMEOUT': 'failed',
+    }
+
     mail_event_map = {
         'BEGIN': 'BEGIN',
         'END': 'END',
         'FAIL': 'FAIL',
     }
 
+    transient_submission_errors = [
+        'Resource temporarily unavailable',
+        'Slurm temporarily unable to accept job',
+        'Socket timed out on send/recv operation',
+        'Unable to contact slurm controller',
+        'Zero Bytes were transmitted or received',
+    ]
+
     def delete_jobs(self, job_ids=None, job_name=None, job_owner=None, dry_run=False):
         logger = self.get_method_logger()
 
@@ -141,42 +205,56 @@ class Slurm(drmr.drm.base.DistributedResourceManager):
             else:
                 if logger.isEnabledFor(logging.DEBUG):
                     logger.debug(self.explain_job_deletion(targets, job_name, job_owner, dry_run))
-                command = ['scancel'] + list(targets)
-                try:
-                    subprocess.check_call(command)
-                except subprocess.CalledProcessError as e:
-                    raise drmr.exceptions.DeletionError(e.returncode, e.cmd, e.output, targets)
+                self.delete_job_batches(targets)
 
     def get_active_job_ids(self, job_ids=None, job_name=None, job_owner=None):
         logger = self.get_method_logger()
 
-        if job_ids is None:
-            job_ids = []
+        # job IDs may be given as integers, but are compared and passed to the scheduler as strings
+        job_ids = [str(job_id) for job_id in job_ids or []]
 
         jobs = set([])
 
+        # Filters are pushed down to squeue, so it only lists what we
+        # need, but are still applied here: squeue's --name only
+        # matches whole names, and we match any part of them.
         command = [
             'squeue',
             '-r',
             '--format=%A,%j,%u',
             '--states=CONFIGURING,COMPLETING,PENDING,PREEMPTED,RUNNING,SUSPENDED'
         ]
+        if job_owner:
+            command.append('--user={}'.format(job_owner))
 
-        squeue_lines = self.capture_process_output(command).splitlines()
-        if 1 < len(squeue_lines):
-            squeue_lines = set(squeue_lines[1:])
-            for job in squeue_lines:
-                job_id, name, owner = job.split(',')
-                if job_owner and owner != job_owner:
-                    continue
+        try:
+            if job_ids:
+                # in batches, as one argument can only be so long
+                queued_jobs = set([])
+                sorted_job_ids = sorted(job_ids)
+                for i in range(0, len(sorted_job_ids), self.job_state_batch_size):
+                    batch = sorted_job_ids[i:i + self.job_state_batch_size]
+                    queued_jobs.update(self.get_queue_snapshot(command + ['--jobs={}'.format(','.join(batch))], self.parse_squeue_output))
+            else:
+                queued_jobs = self.get_queue_snapshot(command, self.parse_squeue_output)
+        except (OSError, subprocess.CalledProcessError) as e:
+            if not job_ids:
+                raise
+            # squeue rejects the whole query if any of the jobs have left the queue
+            logger.debug('squeue rejected job IDs {} ({}); listing all jobs instead.'.format(job_ids, e))
+            queued_jobs = self.get_queue_snapshot(command, self.parse_squeue_output)
 
-                if job_name and job_name not in name:
-                    continue
+        for job_id, name, owner in queued_jobs:
+            if job_owner and owner != job_owner:
+                continue
 
-                if job_ids and job_id not in job_ids:
-                    continue
+            if job_name and job_name not in name:
+                continue
 
-                jobs.add(job_id)
+            if job_ids and job_id not in job_ids:
+                continue
+
+            jobs.add(job_id)
 
         if jobs:
             logger.debug('Found {} active jobs'.format(len(jobs)))
@@ -185,28 +263,103 @@ class Slurm(drmr.drm.base.DistributedResourceManager):
 
         return jobs
 
-    def is_installed(self):
+    def get_job_states(self, job_ids):
+        logger = self.get_method_logger()
+
+        job_ids = [str(job_id) for job_id in job_ids]
+        task_states = {}
+        for i in range(0, len(job_ids), self.job_state_batch_size):
+            batch = job_ids[i:i + self.job_state_batch_size]
+            command = ['sacct', '--noheader', '--parsable2', '--allocations', '--format=JobID,State', '--jobs={}'.format(','.join(batch))]
+            try:
+                jobs = self.get_queue_snapshot(command, self.parse_sacct_output)
+            except subprocess.CalledProcessError as e:
+                # without accounting, squeue still knows recently finished jobs
+                logger.debug('sacct failed ({}); asking squeue instead.'.format(e.output.strip()))
+                command = ['squeue', '-r', '--format=%i|%T', '--states=all', '--user={}'.format(getpass.getuser())]
+                jobs = self.get_queue_snapshot(command, self.parse_sacct_output)
+
+            for job_id, state in jobs:
+                # array tasks are reported as JOBID_TASK, and count toward both the task and its array
+                state = self.job_state_categories.get(state.split(' ')[0], 'unknown')
+                array_id = job_id.split('_')[0]
+                task_states.setdefault(array_id, []).append(state)
+                if job_id != array_id:
+                    task_states.setdefault(job_id, []).append(state)
+
+        return dict((job_id, self.combine_job_states(task_states.get(job_id, []))) for job_id in job_ids)
+
+    def get_job_usage(self, job_ids):
+        wanted = set(str(job_id) for job_id in job_ids)
+        job_ids = sorted(wanted)
+        usage = {}
+        for i in range(0, len(job_ids), self.job_state_batch_size):
+            batch = job_ids[i:i + self.job_state_batch_size]
+            command = ['sacct', '--noheader', '--parsable2', '--format=JobID,State,Elapsed,TotalCPU,MaxRSS', '--jobs={}'.format(','.join(batch))]
+            with self.profiler.phase('query'):
+                output = self.capture_process_output(command)
+            for line in output.splitlines():
+                fields = line.split('|')
+                if len(fields) != 5:
+                    continue
+                job_id, step = fields[0].partition('.')[::2]
+                if job_id not in wanted:
+                    continue
+                job = usage.setdefault(job_id, {'state': None, 'elapsed': None, 'cpu_time': None, 'max_rss': None})
+                if step:
+                    # memory is only measured for the job's steps, like JOBID.batch
+                    max_rss = parse_slurm_memory(fields[4])
+                    if max_rss is not None and max_rss > (job['max_rss'] or 0):
+                        job['max_rss'] = max_rss
+                else:
+                    job['state'] = self.job_state_categories.get(fields[1].split(' ')[0], 'unknown')
+                    job['elapsed'] = parse_slurm_duration(fields[2])
+                    job['cpu_time'] = parse_slurm_duration(fields[3])
+
+        return dict((job_id, job) for job_id, job in usage.items() if job['state'] in ('done', 'failed'))
+
+    def parse_sacct_output(self, output):
+        """Parse the output of sacct --parsable2 --format=JobID,State into a list of (job ID, state) tuples."""
+        jobs = []
+        for line in output.splitlines():
+            if '|' in line and not line.startswith('JOBID|'):
+                job_id, state = line.split('|', 1)
+                jobs.append((job_id, state))
+        return jobs
+
+    def parse_squeue_output(self, output):
+        """Parse the output of squeue --format=%A,%j,%u into a set of (job ID, name, owner) tuples."""
+        jobs = set([])
+        for line in output.splitlines()[1:]:
+            job_id, rest = line.split(',', 1)
+            name, owner = rest.rsplit(',', 1)
+            jobs.add((job_id, name, owner))
+        return jobs
+
+    def probe_capabilities(self):
         output = ''
         try:
             output = self.capture_process_output(['scontrol', 'version'])
         except:
             pass
 
-        return 'slurm' in output
+        installed = 'slurm' in output
+        version = installed and output.replace('slurm', '', 1).strip() or None
 
-    def write_cancel_script(self, job_data, job_ids):
-        logger = self.get_method_logger()
-        logger.debug('Writing canceller script for {}'.format(job_data))
-
-        self.set_control_directory(job_data)
-        filename = drmr.util.absjoin(job_data['control_directory'], job_data['job_name'])
-        if not os.path.exists(job_data['control_directory']):
-            os.makedirs(job_data['control_directory'])
-        with open(filename, 'w') as canceller:
-            canceller.write('#!/bin/sh\n\n')
-            for job in job_ids:
-                canceller.write('scancel %s\n' % job)
-            os.chmod(filename, 0o755)
+        max_array_tasks = None
+        if installed:
+            try:
+                match = self.max_array_size_re.search(self.capture_process_output(['scontrol', 'show', 'config']))
+                if match:
+                    # array indexes must be less than MaxArraySize, and ours start at 1
+                    max_array_tasks = int(match.group(1)) - 1
+            except:
+                pass
+
+        return self.make_capabilities(installed, version, max_array_tasks=max_array_tasks)
+
+    def make_deletion_command(self, job_ids):
+        return ['scancel'] + list(job_ids)
 
     def make_dependency_string(self, dependencies):
         dependency_string = ''
@@ -231,23 +384,42 @@ class Slurm(drmr.drm.base.DistributedResourceManager):
                 )
             )
 
-    def submit(self, job_filename, hold=False):
-        if not self.is_installed():
-            raise drmr.exceptions.ConfigurationError('{} is not installed or not usable.'.format(self.name))
+    def make_submit_arguments(self, job_data):
+        arguments = [
+            '--job-name={}'.format(job_data['job_name']),
+            '--output={}/{}_%j.out'.format(job_data['control_directory'], job_data['job_name']),
+            '--export=ALL,DRMR_COMMAND_INDEX={}'.format(job_data['command_index']),
+        ]
+        if job_data.get('dependencies'):
+            arguments.append('--dependency={}'.format(self.make_dependency_string(job_data['dependencies'])))
+        return arguments
+
+    def submit(self, job_filename, hold=False, arguments=None):
+        self.require_installed()
 
         try:
-            command = ['sbatch', '--parsable', job_filename]
+            command = ['sbatch', '--parsable'] + (arguments or []) + [job_filename]
             if hold:
                 command.insert(1, '--hold')
 
-            job_id = self.capture_process_output(command)
+            job_id = self.run_submission_command(command, os.path.splitext(os.path.basename(job_filename))[0])
+            self.invalidate_queue_snapshots()
             return job_id.strip().split(';')[0]
         except subprocess.CalledProcessError as e:
             raise drmr.exceptions.SubmissionError(e.returncode, e.cmd, e.output)
 
+    def list_destinations(self):
+        self.require_installed()
+
+        try:
+            status = self.capture_process_output(['scontrol', 'show', 'partition'])
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+        return frozenset(re.findall(r'^PartitionName=(\S+)', status, re.MULTILINE))
+
     def validate_destination(self, destination):
-        if not self.is_installed():
-            raise drmr.exceptions.ConfigurationError('{} is not installed or not usable.'.format(self.name))
+        self.require_installed()
 
         valid = False
         try:
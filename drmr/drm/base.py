@@ -9,21 +9,41 @@
 
 from __future__ import print_function
 
-import copy
 import datetime
-import inspect
+import hashlib
+import json
 import logging
+import multiprocessing.pool
 import os
+import random
 import subprocess
-import uuid
+import sys
+import tempfile
+import threading
+import time
 import textwrap
 
-import jinja2
-
 import drmr
+import drmr.exceptions
+import drmr.jobspec
+import drmr.profile
+import drmr.ratelimit
+import drmr.table
 import drmr.util
 
 
+def load_template_source(template):
+    """
+    Load a template named by its own source.
+
+    Jinja2 only caches templates, in memory or as bytecode on disk, when
+    they come from a loader. Using the source as the name lets us cache
+    templates defined in strings, and means a changed template (a site
+    override, say) can never be confused with a cached one.
+    """
+    return template, None, lambda: True
+
+
 class DistributedResourceManager(object):
     name = 'Base Distributed Resource Manager'
     default_job_template = ''
@@ -34,8 +54,238 @@ class DistributedResourceManager(object):
         fi
         """
     )
+    default_array_table_command_template = textwrap.dedent(
+        """
+        drmr_command_table="{{command_table}}"
+        read drmr_command_offset drmr_command_length < <(dd if="${drmr_command_table}.index" bs={{record_width}} skip=$(($THE_DRM_ARRAY_JOB_INDEX_ID + {{index_offset}} - 1)) count=1 2>/dev/null)
+        eval "$(tail -c +$((10#${drmr_command_offset} + 1)) "${drmr_command_table}" | head -c $((10#${drmr_command_length})))"
+        """
+    ).strip()
+
+    default_packed_command_template = textwrap.dedent(
+        """
+        {% for command in commands %}
+        drmr_packed_command_{{loop.index}}() {
+        {{command}}
+        }
+        {% endfor %}
+
+        drmr_run_packed_commands() {
+            for drmr_index in "$@"; do
+                (drmr_packed_command_${drmr_index})
+                echo "${drmr_index} $?" >> "{{status_filename}}"
+            done
+        }
+
+        : > "{{status_filename}}"
+        {% for lane in lanes %}
+        drmr_run_packed_commands {{lane|join(' ')}} &
+        {% endfor %}
+        wait
+
+        drmr_packed_failures=0
+        while read drmr_index drmr_status; do
+            if [ "$drmr_status" != "0" ]; then
+                echo "drmr: packed command ${drmr_index} exited with status ${drmr_status}" >&2
+                drmr_packed_failures=$((drmr_packed_failures + 1))
+            fi
+        done < "{{status_filename}}"
+        drmr_packed_missing=$(({{commands|length}} - $(wc -l < "{{status_filename}}")))
+        if [ "$drmr_packed_failures" != "0" -o "$drmr_packed_missing" != "0" ]; then
+            echo "drmr: ${drmr_packed_failures} of {{commands|length}} packed commands failed, and ${drmr_packed_missing} did not finish" >&2
+            exit 1
+        fi
+        """
+    ).strip()
+
+    default_marked_command_template = textwrap.dedent(
+        """
+        {{command}}
+        drmr_status=$?
+        if [ "$drmr_status" = "0" ]; then
+            touch "{{marker_filename}}"
+        fi
+        exit $drmr_status
+        """
+    ).strip()
+
+    default_telemetry_command_template = textwrap.dedent(
+        """
+        drmr_telemetry_job_id="{{job_id_expression}}"
+        drmr_telemetry_task_id="{{array_task_id_expression}}"
+        drmr_telemetry_record="{{telemetry_directory}}/${drmr_telemetry_job_id}${drmr_telemetry_task_id:+.${drmr_telemetry_task_id}}.json"
+
+        drmr_telemetry_cgroup_file() {
+            # Print the path of the file named $1 in the job's cgroup v2
+            # directory, or $2 in its cgroup v1 memory directory, if the
+            # job has a cgroup of its own.
+            local drmr_cgroup
+            drmr_cgroup=$(sed -n 's/^0:://p' /proc/self/cgroup 2>/dev/null)
+            case "$drmr_cgroup" in
+                *job*|*slurm*|*torque*|*pbs*)
+                    if [ -r "/sys/fs/cgroup${drmr_cgroup}/$1" ]; then
+                        echo "/sys/fs/cgroup${drmr_cgroup}/$1"
+                        return
+                    fi
+                    ;;
+            esac
+            drmr_cgroup=$(awk -F: '$2 ~ /(^|,)memory(,|$)/ { print $3 }' /proc/self/cgroup 2>/dev/null)
+            case "$drmr_cgroup" in
+                *job*|*slurm*|*torque*|*pbs*)
+                    if [ -r "/sys/fs/cgroup/memory${drmr_cgroup}/$2" ]; then
+                        echo "/sys/fs/cgroup/memory${drmr_cgroup}/$2"
+                    fi
+                    ;;
+            esac
+        }
+
+        {% if interval %}
+        drmr_telemetry_memory=$(drmr_telemetry_cgroup_file memory.current memory.usage_in_bytes)
+        (
+            drmr_telemetry_samples=0
+            drmr_telemetry_peak=0
+            while true; do
+                if [ -n "$drmr_telemetry_memory" ]; then
+                    drmr_telemetry_rss=$(($(cat "$drmr_telemetry_memory") / 1024))
+                else
+                    # the resident memory of this job's processes, not counting the sampler's
+                    drmr_telemetry_rss=$(ps -e -o pid= -o ppid= -o rss= | awk -v root=$$ -v sampler=$BASHPID '{ parent[$1] = $2; rss[$1] = $3 } END { for (pid in parent) { ancestor = pid; while (ancestor in parent && ancestor != root && ancestor != sampler) ancestor = parent[ancestor]; if (ancestor == root && pid != root) total += rss[pid] } print total + 0 }')
+                fi
+                drmr_telemetry_samples=$((drmr_telemetry_samples + 1))
+                if [ "$drmr_telemetry_rss" -gt "$drmr_telemetry_peak" ]; then
+                    drmr_telemetry_peak=$drmr_telemetry_rss
+                fi
+                echo "$drmr_telemetry_samples $drmr_telemetry_peak" > "${drmr_telemetry_record}.samples.tmp"
+                mv "${drmr_telemetry_record}.samples.tmp" "${drmr_telemetry_record}.samples"
+                sleep {{interval}}
+            done
+        ) &
+        drmr_telemetry_sampler=$!
+        {% endif %}
+
+        drmr_telemetry_start=$(date +%s)
+        TIMEFORMAT='%3R %3U %3S'
+        # the command's standard error goes where the job's does, and
+        # the time it took to the record
+        { time { (
+        {{command}}
+        ) 2>&9 9>&- ; } ; } 9>&2 2> "${drmr_telemetry_record}.time"
+        drmr_status=$?
+        drmr_telemetry_end=$(date +%s)
+        {% if interval %}
+        kill $drmr_telemetry_sampler 2>/dev/null
+        wait $drmr_telemetry_sampler 2>/dev/null
+        {% endif %}
+
+        read drmr_telemetry_elapsed drmr_telemetry_user drmr_telemetry_system < <(tail -n 1 "${drmr_telemetry_record}.time" | tr , .)
+        drmr_telemetry_max_rss=null
+        drmr_telemetry_max_rss_source=null
+        drmr_telemetry_samples=0
+        drmr_telemetry_peak_file=$(drmr_telemetry_cgroup_file memory.peak memory.max_usage_in_bytes)
+        if [ -n "$drmr_telemetry_peak_file" ]; then
+            drmr_telemetry_max_rss=$((($(cat "$drmr_telemetry_peak_file") + 1048575) / 1048576))
+            drmr_telemetry_max_rss_source='"cgroup"'
+        {% if interval %}
+        fi
+        if [ -s "${drmr_telemetry_record}.samples" ]; then
+            read drmr_telemetry_samples drmr_telemetry_peak < "${drmr_telemetry_record}.samples"
+            if [ "$drmr_telemetry_max_rss" = "null" ]; then
+                drmr_telemetry_max_rss=$(((drmr_telemetry_peak + 1023) / 1024))
+                drmr_telemetry_max_rss_source='"samples"'
+            fi
+        {% endif %}
+        fi
 
-    def __init__(self):
+        printf '{"job_id": "%s", "array_task_id": %s, "host": "%s", "processors": %s, "start": %s, "end": %s, "elapsed": %s, "user_cpu": %s, "system_cpu": %s, "exit_code": %s, "max_rss": %s, "max_rss_source": %s, "samples": %s}\\n' \\
+            "$drmr_telemetry_job_id" "${drmr_telemetry_task_id:-null}" "$HOSTNAME" {{processors}} \\
+            "$drmr_telemetry_start" "$drmr_telemetry_end" "${drmr_telemetry_elapsed:-null}" "${drmr_telemetry_user:-null}" "${drmr_telemetry_system:-null}" \\
+            "$drmr_status" "$drmr_telemetry_max_rss" "$drmr_telemetry_max_rss_source" "$drmr_telemetry_samples" > "${drmr_telemetry_record}.tmp"
+        mv "${drmr_telemetry_record}.tmp" "$drmr_telemetry_record"
+        rm -f "${drmr_telemetry_record}.time" "${drmr_telemetry_record}.samples" "${drmr_telemetry_record}.samples.tmp"
+        exit $drmr_status
+        """
+    ).strip()
+
+    default_shared_command_template = textwrap.dedent(
+        """
+        drmr_command_table="{{command_table}}"
+        read drmr_command_offset drmr_command_length < <(dd if="${drmr_command_table}.index" bs={{record_width}} skip=$(($DRMR_COMMAND_INDEX - 1)) count=1 2>/dev/null)
+        eval "$(tail -c +$((10#${drmr_command_offset} + 1)) "${drmr_command_table}" | head -c $((10#${drmr_command_length})))"
+        """
+    ).strip()
+
+    # The job data that can differ between jobs sharing a job script;
+    # they're given to each job by make_submit_arguments instead.
+    shared_job_keys = ['command', 'command_index', 'dependencies', 'job_name', 'notes']
+
+    # Whether guess_resource_manager should consider this resource manager.
+    detectable = True
+
+    job_dependency_states = []
+
+    # How long a successful capability probe is trusted on disk, in seconds.
+    capability_cache_ttl = 24 * 60 * 60
+
+    # How long a queue snapshot is reused, in seconds. See get_queue_snapshot.
+    queue_snapshot_ttl = 5
+
+    # The most job IDs given to one deletion command, how many
+    # deletion commands may run at once, how many may start each
+    # second, and how many times each is retried. See delete_job_batches.
+    deletion_batch_size = 500
+    deletion_concurrency = 4
+    deletion_rate = 10.0
+    deletion_retries = 3
+
+    # How many submission commands may start each second, and how many
+    # may start at once after a lull, once the resource manager has
+    # pushed back; the rate is halved each time it does. Until then,
+    # submissions aren't paced. See run_submission_command.
+    submission_rate = 20.0
+    submission_burst = 10
+
+    # How many times a submission that fails with a transient error is
+    # retried, and the most seconds to wait before the first and any
+    # later retry.
+    submission_retries = 5
+    submission_backoff = 1.0
+    submission_max_backoff = 60.0
+
+    # Output of the submission command that means the resource manager
+    # was too busy to take the job, and it's worth trying again.
+    transient_submission_errors = []
+
+    # Shell expressions for the ID drmr was given for a running job,
+    # and its array task index if it's an array job, for telemetry.
+    telemetry_job_id_expression = '$THE_DRM_JOB_ID'
+    telemetry_array_task_id_expression = '$THE_DRM_ARRAY_JOB_INDEX_ID'
+
+    # The most job IDs given to one query by get_job_states and
+    # get_active_job_ids.
+    job_state_batch_size = 1000
+
+    # Capabilities probed by this process, keyed by get_capability_cache_key().
+    probed_capabilities = {}
+
+    # Jinja2 environments, and through them compiled templates, shared
+    # by every instance of each resource manager class. See get_template.
+    template_environments = {}
+
+    # Site job templates read from files named in the configuration.
+    job_template_overrides = {}
+
+    def __init__(self, config=None):
+        self.config = config or {}
+        self.profiler = drmr.profile.Profiler(enabled=False)
+        self.shared_job_files = {}
+        self.shared_job_lock = threading.Lock()
+        self.queue_snapshots = {}
+        self.queue_snapshot_lock = threading.Lock()
+        self.submission_rate_limiter = drmr.ratelimit.RateLimiter(self.config.get('submission_rate', self.submission_rate), burst=self.submission_burst)
+        # a configured rate paces every submission; otherwise pacing starts with the first busy error
+        self.submission_throttled = 'submission_rate' in self.config
+        self.submission_statistics = {'submissions': 0, 'retried_submissions': 0, 'retries': 0, 'retry_delay': 0.0}
+        self.submission_statistics_lock = threading.Lock()
         self.default_job_data = {
             'dependencies': {},
             'environment_setup': [],
@@ -47,6 +297,87 @@ class DistributedResourceManager(object):
     def delete_jobs(self, job_ids=None, job_name=None, job_owner=None, dry_run=False):
         raise NotImplementedError
 
+    def make_deletion_command(self, job_ids):
+        """Make the command that deletes the given jobs."""
+        raise NotImplementedError
+
+    def make_deletion_batches(self, job_ids):
+        """Split job IDs into lists of at most deletion_batch_size."""
+        job_ids = sorted(str(job_id) for job_id in job_ids)
+        return [job_ids[i:i + self.deletion_batch_size] for i in range(0, len(job_ids), self.deletion_batch_size)]
+
+    def delete_job_batches(self, job_ids):
+        """
+        Delete jobs in batches, several batches at once.
+
+        Each deletion command is given deletion_batch_size jobs, and
+        deletion_concurrency commands are run at once. They're paced
+        by a rate limiter that slows down when a command fails, and
+        speeds up again as they succeed. Failed commands are retried
+        deletion_retries times. If any batch still can't be deleted,
+        a DeletionError naming all of the jobs in failed batches is
+        raised once the other batches are done.
+        """
+        logger = self.get_method_logger()
+
+        batches = self.make_deletion_batches(job_ids)
+        rate_limiter = drmr.ratelimit.RateLimiter(self.deletion_rate)
+
+        def delete_batch(batch):
+            for attempt in range(self.deletion_retries + 1):
+                rate_limiter.acquire()
+                try:
+                    self.capture_process_output(self.make_deletion_command(batch))
+                    rate_limiter.speed_up()
+                    return None
+                except subprocess.CalledProcessError as e:
+                    logger.debug('Deleting {} jobs failed (attempt {}): {}'.format(len(batch), attempt + 1, e.output))
+                    rate_limiter.slow_down()
+                    error = e
+            return (error, batch)
+
+        try:
+            if self.deletion_concurrency > 1 and len(batches) > 1:
+                pool = multiprocessing.pool.ThreadPool(min(self.deletion_concurrency, len(batches)))
+                try:
+                    failures = pool.map(delete_batch, batches)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                failures = [delete_batch(batch) for batch in batches]
+        finally:
+            self.invalidate_queue_snapshots()
+
+        failures = [failure for failure in failures if failure]
+        if failures:
+            error = failures[0][0]
+            raise drmr.exceptions.DeletionError(error.returncode, error.cmd, error.output, [job_id for e, batch in failures for job_id in batch])
+
+    def write_cancel_script(self, job_data, job_ids):
+        """
+        Write a script that deletes the given jobs, in the control directory.
+
+        The jobs are deleted in batches, deletion_concurrency at a
+        time, pausing between them to stay within deletion_rate.
+        """
+        logger = self.get_method_logger()
+        logger.debug('Writing canceller script for {}'.format(job_data))
+
+        self.set_control_directory(job_data)
+        filename = drmr.util.absjoin(job_data['control_directory'], job_data['job_name'])
+        drmr.util.makedirs(job_data['control_directory'])
+        batches = self.make_deletion_batches(job_ids)
+        with open(filename, 'w') as canceller:
+            canceller.write('#!/bin/sh\n\n')
+            for i in range(0, len(batches), self.deletion_concurrency):
+                for batch in batches[i:i + self.deletion_concurrency]:
+                    canceller.write(' '.join("'{}'".format(argument) for argument in self.make_deletion_command(batch)) + ' &\n')
+                canceller.write('wait\n')
+                if i + self.deletion_concurrency < len(batches):
+                    canceller.write('sleep {:g}\n'.format(self.deletion_concurrency / self.deletion_rate))
+            os.chmod(filename, 0o755)
+
     def explain_job_deletion(self, job_ids=None, job_name=None, job_owner=None, dry_run=False):
         if job_ids is None:
             job_ids = []
@@ -60,21 +391,222 @@ class DistributedResourceManager(object):
 
         return msg
 
-    def get_active_job_ids(self, job_name=None, job_owner=None):
+    def get_capabilities(self, refresh=False):
+        """
+        Describe the resource manager: whether it's installed, its version and features.
+
+        The resource manager is probed at most once per process, and
+        probes are cached on disk for capability_cache_ttl seconds, so
+        repeated submissions don't fork control commands just to find
+        out what's there. Failed probes are cached too, so looking for
+        the resource managers that aren't installed is just as cheap,
+        but only until a directory on the PATH changes, so one that's
+        installed is noticed immediately.
+        """
+
+        logger = self.get_method_logger()
+
+        key = self.get_capability_cache_key()
+        if not refresh:
+            capabilities = self.get_cached_capabilities()
+            if capabilities is not None:
+                return capabilities
+
+        logger.debug('Probing {}'.format(self.name))
+        path_signature = self.get_path_signature()
+        with self.profiler.phase('probe'):
+            capabilities = self.probe_capabilities()
+        if not capabilities['installed']:
+            capabilities['path_signature'] = path_signature
+        self.probed_capabilities[key] = capabilities
+        self.save_cached_capabilities(key, capabilities)
+
+        return capabilities
+
+    def get_cached_capabilities(self):
+        """Return the capabilities probed by this process or cached on disk, or None if they'd have to be probed."""
+        key = self.get_capability_cache_key()
+        capabilities = self.probed_capabilities.get(key)
+        if capabilities is None:
+            capabilities = self.load_cached_capabilities(key)
+        if capabilities is not None and not capabilities['installed'] and capabilities.get('path_signature') != self.get_path_signature():
+            capabilities = None
+        if capabilities is not None:
+            self.probed_capabilities[key] = capabilities
+        return capabilities
+
+    def get_capability_cache_key(self):
+        """
+        Identify cached capabilities by resource manager and PATH.
+
+        The control commands we find depend on PATH, so a probe made
+        with one PATH says nothing about another.
+        """
+        path_digest = hashlib.sha1(os.environ.get('PATH', '').encode('utf-8')).hexdigest()
+        return '{}:{}'.format(self.name, path_digest)
+
+    def get_path_signature(self):
+        """Summarize the modification times of the directories on PATH, which change when commands are added to them."""
+        modification_times = []
+        for directory in os.environ.get('PATH', '').split(os.pathsep):
+            try:
+                modification_times.append(os.stat(directory or os.curdir).st_mtime)
+            except OSError:
+                modification_times.append(None)
+        return hashlib.sha1(json.dumps(modification_times).encode('utf-8')).hexdigest()
+
+    def get_capability_cache_filename(self):
+        return drmr.util.get_cache_directory('capabilities.json')
+
+    def load_cached_capabilities(self, key):
+        """Return capabilities cached on disk under the given key, if they haven't expired."""
+        if self.capability_cache_ttl <= 0:
+            return None
+
+        try:
+            with open(self.get_capability_cache_filename()) as cache_file:
+                entry = json.load(cache_file).get(key)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry and time.time() - entry.get('probed_at', 0) < self.capability_cache_ttl:
+            return entry.get('capabilities')
+
+        return None
+
+    def save_cached_capabilities(self, key, capabilities):
+        """Record capabilities on disk. Failure to do so is not fatal."""
+        if self.capability_cache_ttl <= 0:
+            return
+
+        logger = self.get_method_logger()
+
+        cache_filename = self.get_capability_cache_filename()
+        try:
+            with open(cache_filename) as cache_file:
+                cache = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            cache = {}
+
+        cache[key] = {'probed_at': time.time(), 'capabilities': capabilities}
+
+        try:
+            cache_directory = os.path.dirname(cache_filename)
+            drmr.util.makedirs(cache_directory)
+            # write and rename, so concurrent readers never see a partial file
+            fd, temporary_filename = tempfile.mkstemp(dir=cache_directory, prefix='.capabilities')
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump(cache, cache_file, indent=2, sort_keys=True)
+            os.rename(temporary_filename, cache_filename)
+        except (IOError, OSError, ValueError) as e:
+            logger.debug('Could not cache capabilities in {}: {}'.format(cache_filename, e))
+
+    def get_active_job_ids(self, job_ids=None, job_name=None, job_owner=None):
         """
         Get a list of ids of jobs that are running, or might be in the future.
         """
         raise NotImplementedError
 
+    def get_job_states(self, job_ids):
+        """
+        Get the states of the given jobs, as a dictionary keyed by job ID.
+
+        Each state is one of 'pending', 'running', 'done', 'failed' or,
+        for jobs the resource manager no longer knows, 'unknown'.
+        Resource managers ask for as many jobs at once as they can,
+        instead of querying each job.
+        """
+        raise NotImplementedError
+
+    def get_job_usage(self, job_ids):
+        """
+        Return the resources used by those of the given jobs that have finished.
+
+        The result maps job IDs to dictionaries of their state ('done'
+        or 'failed'), elapsed and CPU time in seconds, and peak memory
+        use (max_rss) in megabytes, any of which may be None if the
+        resource manager's accounting doesn't say. Jobs still queued,
+        or unknown to the accounting, are left out.
+        """
+        raise NotImplementedError
+
+    def combine_job_states(self, states):
+        """Combine the states of an array job's tasks into one state for the job."""
+        states = set(states)
+        if not states:
+            return 'unknown'
+        if 'failed' in states:
+            return 'failed'
+        if states == set(['done']):
+            return 'done'
+        if 'running' in states or 'done' in states:
+            return 'running'
+        if states == set(['unknown']):
+            return 'unknown'
+        return 'pending'
+
+    def get_queue_snapshot(self, command, parse):
+        """
+        Run a queue query, returning its output as parsed by parse.
+
+        Results are kept for queue_snapshot_ttl seconds (overridable
+        with the queue_snapshot_ttl configuration setting), so that
+        repeated queries in one process -- finding jobs to delete, then
+        checking on them -- don't each ask the scheduler to list its
+        queue. Submitting or deleting jobs discards the snapshots.
+        """
+        ttl = float(self.config.get('queue_snapshot_ttl', self.queue_snapshot_ttl))
+        key = tuple(command)
+        with self.queue_snapshot_lock:
+            snapshot = self.queue_snapshots.get(key)
+            if snapshot and time.time() - snapshot[0] < ttl:
+                return snapshot[1]
+
+        with self.profiler.phase('query'):
+            result = parse(self.capture_process_output(command))
+
+        if ttl > 0:
+            with self.queue_snapshot_lock:
+                self.queue_snapshots[key] = (time.time(), result)
+        return result
+
+    def invalidate_queue_snapshots(self):
+        """Discard queue snapshots, after changing what's in the queue."""
+        with self.queue_snapshot_lock:
+            self.queue_snapshots.clear()
+
     def get_method_logger(self):
-        stack = inspect.getouterframes(inspect.currentframe())
-        caller = stack[1][3]
+        caller = sys._getframe(1).f_code.co_name
         return logging.getLogger("{}.{}.{}".format(self.__module__, self.__class__.__name__, caller))
 
     def is_installed(self):
         """Verifies that the resource manager is installed."""
+        return self.get_capabilities()['installed']
+
+    def make_capabilities(self, installed=False, version=None, **features):
+        """Build the capability record returned by probe_capabilities."""
+        capability_features = {
+            'arrays': True,
+            'dependency_states': list(self.job_dependency_states),
+            'hold': True,
+        }
+        capability_features.update(features)
+        return {
+            'name': self.name,
+            'installed': installed,
+            'version': version,
+            'features': capability_features,
+        }
+
+    def probe_capabilities(self):
+        """Run the resource manager's control commands to find out what it supports."""
         raise NotImplementedError
 
+    def require_installed(self):
+        """Raise a ConfigurationError unless the resource manager is installed."""
+        if not self.is_installed():
+            raise drmr.exceptions.ConfigurationError('{} is not installed or not usable.'.format(self.name))
+
     def make_cancel_script(self, job_data, job_ids):
         raise NotImplementedError
 
@@ -88,19 +620,248 @@ class DistributedResourceManager(object):
         self.make_control_directory(job_data)
         return drmr.util.absjoin(job_data['control_directory'], job_data['job_name'] + '.' + self.name.lower())
 
+    def get_bytecode_cache_directory(self):
+        """
+        Return the directory for compiled template bytecode, or None if it shouldn't be cached.
+
+        The cache is on unless the configuration sets "template_cache" to false.
+        """
+        if self.config.get('template_cache', True) is False:
+            return None
+        return drmr.util.get_cache_directory('templates')
+
+    def get_job_template(self):
+        """Return the job template source: the site's template if one is configured, else the default."""
+        filename = self.config.get('job_template')
+        if not filename:
+            return self.default_job_template
+
+        filename = os.path.abspath(os.path.expanduser(filename))
+        if filename not in self.job_template_overrides:
+            try:
+                with open(filename) as template_file:
+                    self.job_template_overrides[filename] = template_file.read()
+            except (IOError, OSError) as e:
+                raise drmr.exceptions.ConfigurationError('Could not read job template {}: {}'.format(filename, e))
+        return self.job_template_overrides[filename]
+
+    def get_template(self, source, **options):
+        """
+        Return a compiled template for the given source.
+
+        Each template is compiled at most once per process for each
+        resource manager class, and its bytecode is cached on disk so
+        later runs can skip compilation too.
+        """
+
+        bytecode_cache_directory = self.get_bytecode_cache_directory()
+        key = (self.__class__, bytecode_cache_directory, tuple(sorted(options.items())))
+        template_environment = self.template_environments.get(key)
+        if template_environment is None:
+            # imported here, so commands that never render a job script don't wait for it
+            import jinja2
+
+            bytecode_cache = None
+            if bytecode_cache_directory:
+                try:
+                    drmr.util.makedirs(bytecode_cache_directory)
+                    bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_directory)
+                except (IOError, OSError, ValueError) as e:
+                    self.get_method_logger().debug('Not caching template bytecode: {}'.format(e))
+
+            template_environment = jinja2.Environment(loader=jinja2.FunctionLoader(load_template_source), bytecode_cache=bytecode_cache, **options)
+            self.template_environments[key] = template_environment
+
+        return template_environment.get_template(source)
+
     def make_array_command(self, command_data):
-        template_environment = jinja2.Environment()
-        return template_environment.from_string(self.default_array_command_template).render(**command_data)
+        return self.get_template(self.default_array_command_template).render(**command_data)
+
+    def make_array_table_command(self, command_table, index_offset=0):
+        """
+        Make the command for an array job that runs the commands in a CommandTable.
+
+        Each task looks up its own command by its array index, plus
+        index_offset, so the job script is the same size however many
+        commands there are.
+        """
+        return self.get_template(self.default_array_table_command_template).render(
+            command_table=command_table.filename,
+            index_offset=index_offset,
+            record_width=drmr.table.RECORD_WIDTH,
+        )
+
+    def make_marked_command(self, command, marker_filename):
+        """Make a command that creates marker_filename if the given command succeeds, preserving its exit status."""
+        return self.get_template(self.default_marked_command_template).render(command=command, marker_filename=marker_filename)
+
+    def make_marker_directory(self, job_data):
+        """Create the directory in the control directory where jobs record the success of their commands."""
+        self.make_control_directory(job_data)
+        marker_directory = drmr.util.absjoin(job_data['control_directory'], 'markers')
+        drmr.util.makedirs(marker_directory)
+        return marker_directory
+
+    def make_packed_command(self, job_data, commands):
+        """
+        Make the command for a job that runs several commands, as many at once as it has processors.
+
+        The exit status of each command, numbered from 1, is recorded
+        in <job name>.status in the control directory. The job fails
+        if any command fails.
+        """
+        self.make_control_directory(job_data)
+        concurrency = max(1, min(int(job_data.get('processors') or 1), len(commands)))
+        return self.get_template(self.default_packed_command_template, trim_blocks=True, lstrip_blocks=True).render(
+            commands=commands,
+            lanes=[list(range(lane, len(commands) + 1, concurrency)) for lane in range(1, concurrency + 1)],
+            status_filename=drmr.util.absjoin(job_data['control_directory'], job_data['job_name'] + '.status'),
+        )
+
+    def make_telemetry_directory(self, job_data):
+        """Create the directory in the control directory where jobs record their telemetry."""
+        self.make_control_directory(job_data)
+        telemetry_directory = drmr.util.absjoin(job_data['control_directory'], 'telemetry')
+        drmr.util.makedirs(telemetry_directory)
+        return telemetry_directory
+
+    def make_telemetry_command(self, job_data):
+        """
+        Make a command that runs the job's command, and records how it behaved.
+
+        The start and end times, elapsed and CPU time, exit status and
+        peak memory use of the command are written as a line of JSON
+        to telemetry/<job ID>.json in the control directory, or
+        <job ID>.<task>.json for each task of an array job. Peak memory
+        is read from the job's cgroup when the resource manager gives
+        it one; if the configuration sets "telemetry_interval", the
+        job's memory is also sampled every that many seconds, and the
+        largest sample is used when there's no cgroup. The command's
+        exit status is preserved.
+        """
+        return self.get_template(self.default_telemetry_command_template, trim_blocks=True, lstrip_blocks=True).render(
+            command=job_data['command'],
+            telemetry_directory=self.make_telemetry_directory(job_data),
+            job_id_expression=self.telemetry_job_id_expression,
+            array_task_id_expression=self.telemetry_array_task_id_expression,
+            processors=int(job_data.get('processors') or 1),
+            interval=self.config.get('telemetry_interval'),
+        )
+
+    def read_telemetry(self, control_directory):
+        """Read the telemetry records of the jobs of the pipeline with the given control directory."""
+        records = []
+        telemetry_directory = drmr.util.absjoin(control_directory, 'telemetry')
+        if os.path.isdir(telemetry_directory):
+            for filename in sorted(os.listdir(telemetry_directory)):
+                if filename.endswith('.json'):
+                    with open(os.path.join(telemetry_directory, filename)) as record:
+                        records.append(json.load(record))
+        return records
+
+    def get_max_array_tasks(self):
+        """Return the most tasks the resource manager allows in one array job, or None if unlimited."""
+        return self.get_capabilities()['features'].get('max_array_tasks')
+
+    def plan_array_jobs(self, task_count, slot_limit='all', max_array_tasks=None):
+        """
+        Divide an array of tasks among as many array jobs as the resource manager requires.
+
+        If max_array_tasks isn't given, the resource manager's limit is
+        used. The slot limit applies to all the array jobs combined:
+        they're arranged in lanes, each allowed a share of the slots,
+        and each array job waits for the previous one in its lane to
+        finish.
+
+        Returns a list of dictionaries, one per array job, with the
+        keys "offset" (the number of tasks in earlier array jobs),
+        "size", "concurrency" and "after" (the position in the list of
+        the array job it must wait for, or None).
+        """
+
+        if max_array_tasks is None:
+            max_array_tasks = self.get_max_array_tasks()
+
+        task_count = max(task_count, 1)
+        chunk_size = max_array_tasks and min(max_array_tasks, task_count) or task_count
+        chunk_count = (task_count + chunk_size - 1) // chunk_size
+
+        lanes = chunk_count
+        lane_concurrency = chunk_size
+        if slot_limit != 'all':
+            lanes = max(1, min(chunk_count, slot_limit // chunk_size))
+            lane_concurrency = max(1, min(chunk_size, slot_limit // lanes))
+
+        chunks = []
+        for i in range(chunk_count):
+            offset = i * chunk_size
+            size = min(chunk_size, task_count - offset)
+            chunks.append({
+                'offset': offset,
+                'size': size,
+                'concurrency': min(size, lane_concurrency),
+                'after': i - lanes if i >= lanes else None,
+            })
+
+        return chunks
+
+    def make_command_table_filename(self, job_data):
+        """Create a name for a command table in the control directory."""
+        self.make_control_directory(job_data)
+        return drmr.util.absjoin(job_data['control_directory'], job_data['job_name'] + '.commands')
+
+    def make_profile_filename(self, job_data):
+        """Create a name for a submission profile in the control directory."""
+        self.make_control_directory(job_data)
+        return drmr.util.absjoin(job_data['control_directory'], job_data['master_job_name'] + '.profile.json')
+
+    def make_manifest_filename(self, job_data):
+        """Create a name for the job manifest in the control directory."""
+        self.make_control_directory(job_data)
+        return drmr.util.absjoin(job_data['control_directory'], job_data['master_job_name'] + '.jobs.json')
+
+    def write_job_manifest(self, job_data, stages, completion_job_id):
+        """
+        Record the IDs of a pipeline's jobs in its control directory, so drmrstatus can find them.
+
+        stages is a list of the lists of IDs of the jobs between each
+        of the script's wait directives.
+        """
+        with open(self.make_manifest_filename(job_data), 'w') as manifest:
+            json.dump(
+                {
+                    'completion_job_id': completion_job_id,
+                    'master_job_name': job_data['master_job_name'],
+                    'resource_manager': self.name,
+                    'stages': stages,
+                },
+                manifest,
+                indent=2,
+                sort_keys=True
+            )
+
+    def read_job_manifest(self, control_directory):
+        """Read the job manifest in the given control directory. Raises ValueError if there isn't one."""
+        job_data = self.parse_control_directory(control_directory)
+        filename = self.make_manifest_filename(job_data)
+        try:
+            with open(filename) as manifest:
+                return json.load(manifest)
+        except (IOError, OSError):
+            raise ValueError('{} has no job manifest; the pipeline was not completely submitted, or was submitted by an older drmr.'.format(control_directory))
 
     def make_job_script(self, job_data):
         """Format a job template, suitable for submission to the DRM."""
         template_data = self.make_job_script_data(job_data)
-        template_environment = jinja2.Environment(trim_blocks=True, lstrip_blocks=True)
-        return template_environment.from_string(self.default_job_template).render(**template_data)
+        template = self.get_template(self.get_job_template(), trim_blocks=True, lstrip_blocks=True)
+        return template.render(**template_data)
 
     def make_job_script_data(self, job_data):
         """Prepare the job data for interpolation into the job file template."""
-        template_data = drmr.util.merge_mappings(self.default_job_data, job_data, {'resource_manager': self})
+        template_data = drmr.jobspec.JobSpec(job_data, {'resource_manager': self})
+        for key, value in self.default_job_data.items():
+            if key not in template_data:
+                template_data[key] = value
 
         self.set_control_directory(template_data)
         self.set_working_directory(template_data)
@@ -109,9 +870,12 @@ class DistributedResourceManager(object):
         self.normalize_memory(template_data)
         self.normalize_time_limit(template_data)
 
+        if template_data.get('telemetry'):
+            template_data['command'] = self.make_telemetry_command(template_data)
+
         python_virtualenv = os.getenv('VIRTUAL_ENV')
         if python_virtualenv:
-            template_data['environment_setup'].append('. {}/bin/activate'.format(python_virtualenv))
+            template_data['environment_setup'] = list(template_data['environment_setup']) + ['. {}/bin/activate'.format(python_virtualenv)]
 
         return template_data
 
@@ -144,12 +908,36 @@ class DistributedResourceManager(object):
         job_data['control_directory'] = control_path
         return control_path
 
+    def parse_control_directory(self, control_directory):
+        """
+        Return the job data from which the given control directory's name was made.
+
+        The result has the master_job_name, timestamp and
+        submission_directory that set_control_directory would turn
+        back into the same path. Raises ValueError if the path isn't
+        an existing control directory.
+        """
+        control_directory = os.path.abspath(control_directory)
+        drmr_directory, name = os.path.split(control_directory)
+        master_job_name, _, timestamp = name.rpartition('-')
+        if not (os.path.isdir(control_directory) and os.path.basename(drmr_directory) == '.drmr' and master_job_name and timestamp.isdigit()):
+            raise ValueError('{} is not a drmr control directory.'.format(control_directory))
+
+        return {
+            'master_job_name': master_job_name,
+            'submission_directory': os.path.dirname(drmr_directory),
+            'timestamp': timestamp,
+        }
+
     def make_dependency_string(self, state, job_id):
         """Convert a dependency states and job ID to the dependency string format required by the DRM."""
         raise NotImplementedError
 
     def set_job_name(self, job_data):
         if 'job_name' not in job_data:
+            # imported here, as it's slow to import, and job names are almost always given
+            import uuid
+
             job_data['job_name'] = uuid.uuid4()
 
     def set_mail_event_string(self, job_data):
@@ -160,17 +948,135 @@ class DistributedResourceManager(object):
         if 'working_directory' not in job_data:
             job_data['working_directory'] = os.getcwd()
 
-    def submit(self, job_file, hold=False):
-        """Submit a job file. Return the job ID."""
+    def submit(self, job_file, hold=False, arguments=None):
+        """
+        Submit a job file. Return the job ID.
+
+        Any arguments, as returned by make_submit_arguments, are added
+        to the submission command, overriding the job file's settings.
+        """
         raise NotImplementedError
 
+    def is_transient_submission_error(self, output):
+        """Return True if a submission command's output says the resource manager was just too busy."""
+        return any(message in (output or '') for message in self.transient_submission_errors)
+
+    def run_submission_command(self, command, job_name=None):
+        """
+        Run a submission command, retrying it if the resource manager is too busy.
+
+        Submissions aren't paced until one fails with one of
+        transient_submission_errors, or submission_rate is set in the
+        configuration. From then on, every submission through this
+        resource manager waits for a shared rate limiter. Each busy
+        error halves the rate, and the command is retried after a random delay of up
+        to submission_backoff seconds, doubling with each attempt up
+        to submission_max_backoff, so many clients rejected at once
+        don't all come back at once. After submission_retries retries,
+        or any other error, the CalledProcessError is raised.
+
+        Returns the command's output. The retries are counted in
+        submission_statistics.
+        """
+        logger = self.get_method_logger()
+        retries = self.config.get('submission_retries', self.submission_retries)
+        attempt = 0
+        delays = 0.0
+        try:
+            while True:
+                if self.submission_throttled:
+                    self.submission_rate_limiter.acquire()
+                try:
+                    with self.profiler.phase('submit', job_name):
+                        output = self.capture_process_output(command)
+                    if self.submission_throttled:
+                        self.submission_rate_limiter.speed_up()
+                    return output
+                except subprocess.CalledProcessError as e:
+                    if attempt >= retries or not self.is_transient_submission_error(e.output):
+                        raise
+                    self.submission_throttled = True
+                    self.submission_rate_limiter.slow_down()
+                    delay = random.uniform(0, min(self.submission_max_backoff, self.submission_backoff * 2 ** attempt))
+                    logger.debug('Submitting {} failed (attempt {}), retrying in {:.2f} seconds: {}'.format(job_name, attempt + 1, delay, e.output.strip()))
+                    with self.profiler.phase('backoff', job_name):
+                        time.sleep(delay)
+                    attempt += 1
+                    delays += delay
+        finally:
+            with self.submission_statistics_lock:
+                self.submission_statistics['submissions'] += 1
+                if attempt:
+                    self.submission_statistics['retried_submissions'] += 1
+                    self.submission_statistics['retries'] += attempt
+                    self.submission_statistics['retry_delay'] += delays
+
+    def format_submission_statistics(self):
+        """Describe the retries of submissions, or return None if there weren't any."""
+        statistics = self.submission_statistics
+        if not statistics['retries']:
+            return None
+        return 'Retried {} of {} submissions {} times, waiting {:.1f} seconds in all, because {} was busy.'.format(
+            statistics['retried_submissions'], statistics['submissions'], statistics['retries'], statistics['retry_delay'], self.name
+        )
+
+    def make_submit_arguments(self, job_data):
+        """
+        Make submission arguments giving a job its own name, output file, dependencies and command index.
+
+        These are the settings a job can't get from a shared job script.
+        The job's command index is passed in the environment, as
+        DRMR_COMMAND_INDEX.
+        """
+        raise NotImplementedError
+
+    def get_shared_job_file(self, job_data, command_table):
+        """
+        Return a job file for any job with the same parameters as job_data.
+
+        The job file runs the command in command_table whose index is
+        in DRMR_COMMAND_INDEX. It's written the first time jobs with
+        these parameters are submitted.
+        """
+        profile = dict((key, value) for key, value in job_data.items() if key not in self.shared_job_keys)
+        profile_key = json.dumps(profile, sort_keys=True, default=str)
+        with self.shared_job_lock:
+            job_filename = self.shared_job_files.get(profile_key)
+            if job_filename is None:
+                shared_data = dict(
+                    profile,
+                    command=self.get_template(self.default_shared_command_template).render(command_table=command_table.filename, record_width=drmr.table.RECORD_WIDTH),
+                    job_name='{}.shared.{}'.format(job_data['master_job_name'], len(self.shared_job_files) + 1),
+                )
+                job_filename = self.write_job_file(shared_data)
+                self.shared_job_files[profile_key] = job_filename
+        return job_filename
+
+    def submit_shared_job(self, job_data, command_table, hold=False):
+        """
+        Submit a job using a job file shared with every job that has the same parameters.
+
+        The job's command is added to command_table, and its name,
+        dependencies and command index are given as submission
+        arguments, so no file is written for the job itself. Returns
+        the job ID.
+        """
+        job_data = drmr.jobspec.JobSpec(job_data)
+        self.set_control_directory(job_data)
+        with self.profiler.phase('table', job_data['job_name']):
+            job_data['command_index'] = command_table.append(job_data['command'])
+            command_table.flush(sync=True)
+        job_filename = self.get_shared_job_file(job_data, command_table)
+        return self.submit(job_filename, hold, self.make_submit_arguments(job_data))
+
     def submit_completion_jobs(self, job_data, job_list, mail_at_finish=False):
         """Submit two jobs: one to record success, and one just to record completion."""
 
         if not job_list:
             raise ValueError('You did not supply a list of job IDs to wait for.')
 
-        common_data = copy.deepcopy(job_data)
+        common_data = drmr.jobspec.JobSpec(job_data)
+        common_data.pop('telemetry', None)
         self.set_control_directory(common_data)
 
         #
@@ -178,7 +1084,7 @@ class DistributedResourceManager(object):
         # next phase. This success job ID is what dependent tasks should
         # watch.
         #
-        success_data = drmr.util.merge_mappings(
+        success_data = drmr.jobspec.JobSpec(
             common_data,
             {
                 'job_name': common_data['job_name'] + '.success',
@@ -197,7 +1103,7 @@ class DistributedResourceManager(object):
         #
         # Whatever happened, let's record that the job is done.
         #
-        finish_data = drmr.util.merge_mappings(
+        finish_data = drmr.jobspec.JobSpec(
             common_data,
             {
                 'job_name': common_data['job_name'] + '.finish',
@@ -218,10 +1124,44 @@ class DistributedResourceManager(object):
 
         return success_job_id
 
+    def list_destinations(self):
+        """
+        Return the set of the destinations (queues, partitions, etc.) the workload manager has.
+
+        Returns None if they can't be listed, in which case each must
+        be checked with validate_destination.
+        """
+        return None
+
+    def get_destinations(self):
+        """
+        Return the set of the workload manager's destinations.
+
+        They're listed the first time they're wanted, and cached with
+        the capabilities, so they aren't listed again for every
+        submission. A destination added since won't be in the set, so
+        one that isn't should be checked with validate_destination.
+        """
+        capabilities = self.get_capabilities()
+        if 'destinations' not in capabilities:
+            destinations = self.list_destinations()
+            capabilities['destinations'] = destinations is not None and sorted(destinations) or None
+            self.save_cached_capabilities(self.get_capability_cache_key(), capabilities)
+        return frozenset(capabilities['destinations'] or [])
+
     def validate_destination(self, destination):
         """Verifies that the given destination is valid."""
         raise NotImplementedError
 
+    def wait_for_jobs(self):
+        """
+        Wait for submitted jobs, if they're run by this process.
+
+        Cluster resource managers run jobs independently of drmr, so
+        there's nothing to wait for. Returns False if jobs failed.
+        """
+        return True
+
     def write_job_file(self, job_data):
         """Write a batch script to be submitted to the resource manager."""
 
@@ -229,7 +1169,10 @@ class DistributedResourceManager(object):
         logger.debug('Writing job file for {}'.format(job_data))
 
         job_filename = self.make_job_filename(job_data)
-        with open(job_filename, 'w') as job_file:
-            job_file.write(self.make_job_script(job_data))
+        with self.profiler.phase('render', job_data['job_name']):
+            job_script = self.make_job_script(job_data)
+        with self.profiler.phase('write', job_data['job_name']):
+            with open(job_filename, 'w') as job_file:
+                job_file.write(job_script)
 
         return job_filename
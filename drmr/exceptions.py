@@ -44,3 +44,19 @@ class DeletionError(ControlError):
 
 class SubmissionError(ControlError):
     action = 'submit'
+
+
+class ValidationError(ValueError):
+    """
+    Raised when a script has errors that would stop its jobs being submitted.
+
+    errors is a list of (line number, message) tuples; the line number
+    is None for errors in settings that didn't come from the script.
+    """
+
+    def __init__(self, errors):
+        super(ValidationError, self).__init__(errors)
+        self.errors = errors
+
+    def __str__(self):
+        return '\n'.join((line_number is None and '{1}' or 'line {0}: {1}').format(line_number, message) for line_number, message in self.errors)
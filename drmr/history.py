@@ -0,0 +1,307 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+A local history of the resources jobs have used, for right-sizing their requests.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import logging
+import math
+import os
+import re
+import subprocess
+import threading
+import time
+
+import drmr.jobspec
+import drmr.plan
+import drmr.util
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    resource_manager TEXT NOT NULL,
+    job_id TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    command TEXT,
+    processors INTEGER,
+    requested_memory INTEGER,
+    requested_time INTEGER,
+    submitted REAL,
+    state TEXT,
+    elapsed INTEGER,
+    cpu_time INTEGER,
+    max_rss INTEGER,
+    PRIMARY KEY (resource_manager, job_id)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_fingerprint ON jobs (fingerprint, processors);
+"""
+
+# Programs whose first argument says what they do, like "python align.py".
+INTERPRETERS = set(['bash', 'java', 'node', 'perl', 'python', 'python2', 'python3', 'Rscript', 'ruby', 'sh'])
+
+NUMBER = re.compile(r'\d+')
+FILE_EXTENSIONS = re.compile(r'^[^.]+((?:\.[A-Za-z][A-Za-z0-9]{0,9})+)$')
+
+
+def normalize_command(command):
+    """
+    Reduce a command to the shape it shares with the same step run on other inputs.
+
+    The program (and, for interpreters, the script) is kept, paths are
+    reduced to their basenames, other file names to their extensions,
+    and numbers to #, so "bwa mem -t 4 ref.fa /data/s1.fq" and "bwa mem
+    -t 8 ref.fa /data/s2.fq" are both "bwa mem -t # *.fa *.fq".
+    """
+    words = []
+    program = None
+    for position, word in enumerate(command.split()):
+        if '/' in word and not word.startswith('-'):
+            word = os.path.basename(word.rstrip('/')) or word
+        if position == 0:
+            program = word
+        if position == 0 or (position == 1 and program in INTERPRETERS):
+            words.append(word)
+            continue
+        if not word.startswith('-'):
+            match = FILE_EXTENSIONS.match(word)
+            if match:
+                word = '*' + match.group(1)
+        words.append(NUMBER.sub('#', word))
+    return ' '.join(words)
+
+
+def make_command_fingerprint(command):
+    """Return a hash of the normalized command, to find jobs that ran the same step."""
+    return hashlib.sha1(normalize_command(command).encode('utf-8')).hexdigest()
+
+
+def get_requested_memory(job_data):
+    """Return the total memory a job requests, in megabytes, or None if it doesn't say."""
+    try:
+        if job_data.get('memory'):
+            return int(drmr.util.normalize_memory(str(job_data['memory'])))
+        if job_data.get('processor_memory'):
+            return int(drmr.util.normalize_memory(str(job_data['processor_memory']))) * int(job_data.get('processors') or 1)
+    except ValueError:
+        pass
+    return None
+
+
+def get_requested_time(job_data):
+    """Return a job's time limit in seconds, or None if it doesn't have one."""
+    if not job_data.get('time_limit'):
+        return None
+    return drmr.plan.get_time_limit_seconds(drmr.util.normalize_time(str(job_data['time_limit'])))
+
+
+def round_up(value, increment):
+    return int(math.ceil(float(value) / increment) * increment)
+
+
+class JobHistory(object):
+    """
+    A SQLite database of submitted jobs, and the resources they used.
+
+    Jobs are recorded when they're submitted, with the fingerprint of
+    their command and what they requested. Their usage is filled in by
+    update, from the resource manager's accounting, once they finish.
+    By default the database is history.sqlite in drmr's cache directory.
+    """
+
+    # Jobs whose usage hasn't been found this many seconds after
+    # submission are forgotten; their accounting is probably gone.
+    max_pending_age = 30 * 24 * 60 * 60
+
+    # The most job IDs given to one accounting query.
+    update_batch_size = 1000
+
+    def __init__(self, filename=None):
+        self.filename = filename or drmr.util.get_cache_directory('history.sqlite')
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        if self.connection is None:
+            # imported here, so submissions that don't keep a history don't wait for it
+            import sqlite3
+
+            drmr.util.makedirs(os.path.dirname(self.filename))
+            self.connection = sqlite3.connect(self.filename, check_same_thread=False)
+            self.connection.executescript(SCHEMA)
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def record_jobs(self, resource_manager_name, jobs):
+        """Record submitted jobs, given as dictionaries of job_id, command, processors, requested_memory and requested_time."""
+        self.open()
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO jobs (resource_manager, job_id, fingerprint, command, processors, requested_memory, requested_time, submitted) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (resource_manager_name, str(job['job_id']), make_command_fingerprint(job['command']), job['command'], job['processors'], job['requested_memory'], job['requested_time'], now)
+                    for job in jobs
+                ]
+            )
+
+    def update(self, resource_manager):
+        """Fetch the usage of recorded jobs that have finished since the last update. Returns the number updated."""
+        logger = logging.getLogger('{}.{}.update'.format(__name__, self.__class__.__name__))
+        self.open()
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM jobs WHERE resource_manager = ? AND state IS NULL AND submitted < ?', (resource_manager.name, time.time() - self.max_pending_age))
+            job_ids = [row[0] for row in self.connection.execute('SELECT job_id FROM jobs WHERE resource_manager = ? AND state IS NULL', (resource_manager.name,))]
+
+        updated = 0
+        for i in range(0, len(job_ids), self.update_batch_size):
+            try:
+                usage = resource_manager.get_job_usage(job_ids[i:i + self.update_batch_size])
+            except subprocess.CalledProcessError as e:
+                logger.warning('Could not get the usage of finished jobs from {}: {}'.format(resource_manager.name, e.output.strip()))
+                break
+            with self.lock, self.connection:
+                self.connection.executemany(
+                    'UPDATE jobs SET state = ?, elapsed = ?, cpu_time = ?, max_rss = ? WHERE resource_manager = ? AND job_id = ?',
+                    [(job['state'], job['elapsed'], job['cpu_time'], job['max_rss'], resource_manager.name, job_id) for job_id, job in usage.items()]
+                )
+            updated += len(usage)
+        logger.debug('Found the usage of {} of {} unfinished jobs.'.format(updated, len(job_ids)))
+        return updated
+
+    def get_usage(self, resource_manager_name, command, processors):
+        """Return the elapsed time and peak memory of each successful job that ran the same step with the same processors."""
+        self.open()
+        with self.lock:
+            return self.connection.execute(
+                'SELECT elapsed, max_rss FROM jobs WHERE resource_manager = ? AND fingerprint = ? AND processors = ? AND state = ? ORDER BY submitted DESC LIMIT 100',
+                (resource_manager_name, make_command_fingerprint(command), processors, 'done')
+            ).fetchall()
+
+
+class RightSizer(object):
+    """
+    Suggests, or applies, memory and time limits for jobs, from what the same steps used before.
+
+    A suggestion is made once min_jobs successful jobs have run a
+    command with the same fingerprint and processors: the most memory
+    and time any of them used, times margin, rounded up to 100MB and
+    five minutes. In 'apply' mode, a suggestion replaces the job's
+    request if it's lower, or the job didn't make one; in 'suggest'
+    mode, suggestions are only collected, for format_suggestions. In
+    'record' mode, jobs are just recorded in the history.
+    """
+
+    def __init__(self, resource_manager, history, mode='suggest', margin=1.5, min_jobs=3):
+        self.resource_manager = resource_manager
+        self.history = history
+        self.mode = mode
+        self.margin = margin
+        self.min_jobs = min_jobs
+        self.jobs = {}
+        self.job_ids = {}
+        self.suggestions = {}
+        self.lock = threading.Lock()
+
+    def suggest(self, command, processors):
+        """Return the suggested memory in megabytes and time limit in seconds for a command, or None."""
+        usage = self.history.get_usage(self.resource_manager.name, command, processors)
+        if len(usage) < self.min_jobs:
+            return None
+        elapsed = [row[0] for row in usage if row[0] is not None]
+        max_rss = [row[1] for row in usage if row[1] is not None]
+        return {
+            'jobs': len(usage),
+            'memory': max_rss and max(100, round_up(max(max_rss) * self.margin, 100)) or None,
+            'time_limit': elapsed and max(300, round_up(max(elapsed) * self.margin, 300)) or None,
+        }
+
+    def adjust(self, job_data, job_name, command):
+        """Return the job data for a job running a single command, right-sized in 'apply' mode, and remember the job for the history."""
+        processors = int(job_data.get('processors') or 1)
+        requested_memory = get_requested_memory(job_data)
+        requested_time = get_requested_time(job_data)
+
+        if self.mode != 'record':
+            key = (normalize_command(command), processors)
+            with self.lock:
+                entry = self.suggestions.get(key)
+                if entry is None:
+                    entry = self.suggestions[key] = {
+                        'suggestion': self.suggest(command, processors),
+                        'jobs': 0,
+                        'requested_memory': requested_memory,
+                        'requested_time': requested_time,
+                    }
+                entry['jobs'] += 1
+            suggestion = entry['suggestion']
+
+            if suggestion and self.mode == 'apply':
+                job_data = drmr.jobspec.JobSpec(job_data)
+                if suggestion['memory'] and (requested_memory is None or suggestion['memory'] < requested_memory):
+                    job_data.pop('processor_memory', None)
+                    job_data['memory'] = str(suggestion['memory'])
+                    requested_memory = suggestion['memory']
+                if suggestion['time_limit'] and (requested_time is None or suggestion['time_limit'] < requested_time):
+                    job_data['time_limit'] = drmr.plan.format_seconds(suggestion['time_limit'])
+                    requested_time = suggestion['time_limit']
+
+        with self.lock:
+            self.jobs[job_name] = {
+                'command': command,
+                'processors': processors,
+                'requested_memory': requested_memory,
+                'requested_time': requested_time,
+            }
+        return job_data
+
+    def add_job_id(self, job_name, job_id):
+        """Note the ID of a submitted job that adjust was given."""
+        if job_name in self.jobs:
+            self.job_ids[job_name] = job_id
+
+    def save(self):
+        """Record the submitted jobs in the history."""
+        self.history.record_jobs(self.resource_manager.name, [dict(self.jobs[job_name], job_id=job_id) for job_name, job_id in self.job_ids.items()])
+
+    def format_suggestions(self):
+        """Describe the suggestions for the jobs that had any, or return None."""
+        lines = []
+        for (command, processors), entry in sorted(self.suggestions.items()):
+            suggestion = entry['suggestion']
+            if not suggestion:
+                continue
+            requested = 'memory={} time_limit={}'.format(
+                entry['requested_memory'] is not None and entry['requested_memory'] or 'default',
+                entry['requested_time'] is not None and drmr.plan.format_seconds(entry['requested_time']) or 'none',
+            )
+            suggested = 'memory={} time_limit={}'.format(
+                suggestion['memory'] or 'unknown',
+                suggestion['time_limit'] and drmr.plan.format_seconds(suggestion['time_limit']) or 'unknown',
+            )
+            lines.append('{} ({} jobs, {} processors): requested {}; suggested {}, from {} earlier runs'.format(
+                command, entry['jobs'], processors, requested, suggested, suggestion['jobs']
+            ))
+        if not lines:
+            return None
+        heading = self.mode == 'apply' and 'Right-sized requests (suggestions were used where they were lower):' or 'Suggested requests:'
+        return heading + '\n  ' + '\n  '.join(lines)
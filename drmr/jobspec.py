@@ -0,0 +1,125 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+Layered job specifications, shared by the pipeline drivers and resource managers.
+"""
+
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
+
+class Deleted(object):
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'DELETED'
+
+
+# Marks a key deleted in a layer, hiding the value of any layer below.
+DELETED = Deleted()
+
+
+class JobSpec(MutableMapping):
+    """
+    A job's parameters, as a layer of changes on top of another mapping.
+
+    Looking up a key checks this layer, then the parent -- usually the
+    pipeline's template, then its job directives, then the job's own
+    settings -- so each job only stores what differs from the jobs
+    around it, instead of a deep copy of everything. Changes only ever
+    go in the top layer, leaving the parent as it was.
+
+    Values are shared with the parent, not copied, so list and
+    dictionary values must be replaced, not changed in place.
+    """
+
+    __slots__ = ('parent', 'layer')
+
+    def __init__(self, parent=None, layer=None):
+        self.parent = parent
+        # The layer's dictionary isn't made until something is set,
+        # as many layers never have anything set in them.
+        self.layer = layer and dict(layer) or None
+
+    def __getitem__(self, key):
+        spec = self
+        while isinstance(spec, JobSpec):
+            if spec.layer is not None and key in spec.layer:
+                value = spec.layer[key]
+                if value is DELETED:
+                    raise KeyError(key)
+                return value
+            spec = spec.parent
+        if spec is None:
+            raise KeyError(key)
+        return spec[key]
+
+    def __setitem__(self, key, value):
+        if self.layer is None:
+            self.layer = {}
+        self.layer[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self[key] = DELETED
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.to_dict())
+
+    def __len__(self):
+        return len(self.to_dict())
+
+    def __repr__(self):
+        return 'JobSpec({!r})'.format(self.to_dict())
+
+    def __reduce__(self):
+        return (JobSpec, (None, self.to_dict()))
+
+    def get_layers(self):
+        """Return the mappings this job specification looks in, from the top down."""
+        layers = []
+        spec = self
+        while isinstance(spec, JobSpec):
+            if spec.layer:
+                layers.append(spec.layer)
+            spec = spec.parent
+        if spec is not None:
+            layers.append(spec)
+        return layers
+
+    def child(self):
+        """
+        Return a new layer on top of this one, to be changed without changing this.
+
+        The child still sees later changes to this job specification,
+        wherever they're not hidden by its own.
+        """
+        return JobSpec(self)
+
+    def copy(self):
+        """Return a flattened copy, unaffected by later changes to this job specification."""
+        return JobSpec(None, self.to_dict())
+
+    def to_dict(self):
+        """Return the job specification flattened into a dictionary."""
+        merged = {}
+        for layer in reversed(self.get_layers()):
+            merged.update(layer)
+        return dict((key, value) for key, value in merged.items() if value is not DELETED)
@@ -0,0 +1,660 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+Submission of pipelines: commands, with dependencies given by wait directives.
+"""
+
+import collections
+import datetime
+import logging
+import multiprocessing.pool
+import os
+
+import drmr.config
+import drmr.exceptions
+import drmr.history
+import drmr.jobspec
+import drmr.plan
+import drmr.script
+import drmr.table
+import drmr.util
+
+
+PipelineResult = collections.namedtuple('PipelineResult', ['job_ids', 'stages', 'completion_job_id'])
+
+
+def make_wait_list_note(wait_list):
+    note = ''
+    if wait_list:
+        note = '\n# wait list:\n#  ' + '\n#  '.join([jid + (job and ' ({})'.format(job) or '') for jid, job in wait_list])
+    return note
+
+
+def create_job_data(template_data, job_name, command_text, wait_list=None, mail_on_error=False):
+    job_data = drmr.jobspec.JobSpec(template_data, {'job_name': job_name, 'command': command_text})
+    if wait_list:
+        job_data['notes'] = make_wait_list_note(wait_list)
+        job_data['dependencies'] = {'ok': [wait_id for wait_id, wait_name in wait_list]}
+    if mail_on_error:
+        job_data['mail_events'] = ['FAIL']
+
+    return job_data
+
+
+def create_job(resource_manager, template_data, job_name, command_text, wait_list=None, mail_on_error=False, start_held=False, command_table=None):
+    """
+    Submit a job, returning its ID.
+
+    Given a command table, the command is added to it, and the job uses
+    a job script shared with other jobs, instead of one of its own.
+    """
+    with resource_manager.profiler.phase('merge', job_name):
+        job_data = create_job_data(template_data, job_name, command_text, wait_list, mail_on_error)
+    if command_table is not None:
+        return resource_manager.submit_shared_job(job_data, command_table, start_held)
+    job_file = resource_manager.write_job_file(job_data)
+    return resource_manager.submit(job_file, start_held)
+
+
+def submit_jobs(resource_manager, jobs, concurrency=1, command_table=None):
+    """
+    Submit jobs, each given as a tuple of the arguments to create_job after the resource manager.
+
+    Up to `concurrency` jobs are submitted at once. The job IDs are
+    returned in the order the jobs were given.
+    """
+
+    if concurrency > 1 and len(jobs) > 1:
+        pool = multiprocessing.pool.ThreadPool(min(concurrency, len(jobs)))
+        try:
+            return pool.map(lambda job: create_job(resource_manager, *job, command_table=command_table), jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    return [create_job(resource_manager, *job, command_table=command_table) for job in jobs]
+
+
+def group_array_jobs(jobs):
+    """
+    Divide queued jobs into runs that could be submitted as one array job.
+
+    Jobs are given as tuples of the arguments to create_job after the
+    resource manager. Consecutive jobs with the same job parameters,
+    dependencies and mail settings go in the same run.
+    """
+    groups = []
+    for job in jobs:
+        if groups and (job[0], job[3], job[4]) == (groups[-1][0][0], groups[-1][0][3], groups[-1][0][4]):
+            groups[-1].append(job)
+        else:
+            groups.append([job])
+    return groups
+
+
+def submit_array_job(resource_manager, jobs, command_table=None):
+    """
+    Submit jobs with the same parameters and dependencies as an array job, with a task for each.
+
+    The jobs are given as tuples of the arguments to create_job after
+    the resource manager. If there are more than the resource manager
+    allows in one array, they're split among several array jobs. Each
+    array job is named for the first and last job it replaces.
+
+    Given a command table, the commands are added to it, and each task
+    looks up its own; otherwise they're all written in the job script.
+    Returns a list of (job ID, job name) tuples, one per array job.
+    """
+    template_data, first_job_name, command_text, wait_list, mail_on_error = jobs[0]
+    commands = [job[2] for job in jobs]
+
+    table_offset = 0
+    if command_table is not None:
+        with resource_manager.profiler.phase('table', first_job_name):
+            table_offset = command_table.extend(commands) - len(commands)
+            command_table.flush(sync=True)
+
+    array_jobs = []
+    for chunk in resource_manager.plan_array_jobs(len(jobs)):
+        chunk_jobs = jobs[chunk['offset']:chunk['offset'] + chunk['size']]
+        job_name = '{}-{}'.format(chunk_jobs[0][1], chunk_jobs[-1][1].rsplit('.', 1)[-1])
+        with resource_manager.profiler.phase('merge', job_name):
+            if command_table is not None:
+                command = resource_manager.make_array_table_command(command_table, table_offset + chunk['offset'])
+            else:
+                command = '\n'.join(
+                    resource_manager.make_array_command({'command': job[2], 'index': index})
+                    for index, job in enumerate(chunk_jobs, 1)
+                )
+            job_data = create_job_data(template_data, job_name, command, wait_list, mail_on_error)
+            job_data['array_controls'] = {
+                'array_index_min': 1,
+                'array_index_max': chunk['size'],
+                'array_concurrent_jobs': chunk['concurrency'],
+            }
+        job_file = resource_manager.write_job_file(job_data)
+        array_jobs.append((resource_manager.submit(job_file), job_name))
+    return array_jobs
+
+
+def queue_packed_job(resource_manager, pending_jobs, pack, prereqs, mail_on_error=False):
+    """
+    Queue a job for the commands gathered in a pack, given as a tuple of template data, job name and commands.
+
+    A pack of one command is queued as an ordinary job. Commands given
+    as None have already succeeded, and are left out; if that leaves
+    nothing to run, no job is queued.
+    """
+
+    job_template_data, job_name, commands = pack
+    commands = [command for command in commands if command is not None]
+    if not commands:
+        return
+
+    if len(commands) == 1:
+        command_text = commands[0]
+    else:
+        with resource_manager.profiler.phase('pack', job_name):
+            command_text = resource_manager.make_packed_command(drmr.jobspec.JobSpec(job_template_data, {'job_name': job_name}), commands)
+    pending_jobs.append((job_template_data, job_name, command_text, prereqs, mail_on_error))
+
+
+def submit_pending_jobs(resource_manager, pending_jobs, wait_list, all_jobs, concurrency=1, command_table=None, arrays=False, right_sizer=None):
+    """
+    Submit the jobs create_jobs has queued, adding their IDs to wait_list and all_jobs.
+
+    The IDs are recorded in the order the jobs were queued, however
+    many are submitted at once, so numbering and dependencies are the
+    same as with serial submission. With arrays, each run of jobs
+    with the same parameters is submitted as an array job, whose ID
+    is recorded in place of theirs, and the jobs left on their own
+    are submitted together. Given a right sizer, it's told
+    the IDs of the jobs.
+    """
+
+    if arrays:
+        groups = group_array_jobs(pending_jobs)
+        # the jobs that aren't in any array are submitted together, so they can be submitted concurrently
+        single_job_ids = iter(submit_jobs(resource_manager, [group[0] for group in groups if len(group) == 1], concurrency, command_table))
+        submitted = []
+        for group in groups:
+            if len(group) > 1:
+                submitted.extend(submit_array_job(resource_manager, group, command_table))
+            else:
+                submitted.append((next(single_job_ids), group[0][1]))
+    else:
+        job_ids = submit_jobs(resource_manager, pending_jobs, concurrency, command_table)
+        submitted = zip(job_ids, [job[1] for job in pending_jobs])
+
+    for job_id, job_name in submitted:
+        wait_list.append((job_id, job_name))
+        all_jobs.append(job_id)
+        if right_sizer is not None:
+            right_sizer.add_job_id(job_name, job_id)
+    del pending_jobs[:]
+
+
+def check_job_parameters(parameters):
+    """Return a list of what's wrong with the given job parameters, other than their destination."""
+    errors = []
+    for key, value in sorted(parameters.items()):
+        if not value:
+            continue
+        if key in ('memory', 'processor_memory'):
+            # normalize_memory returns what it can't parse
+            if drmr.util.normalize_memory(value) == value:
+                errors.append('Could not parse the amount of {} "{}"'.format(key.replace('_', ' '), value))
+        elif key == 'time_limit':
+            try:
+                drmr.util.normalize_time(value)
+            except (SyntaxError, ValueError) as e:
+                errors.append('Invalid time limit: {}'.format(e))
+        elif key in ('nodes', 'processors'):
+            if not str(value).isdigit() or int(value) < 1:
+                errors.append('The number of {} must be a positive integer, not "{}"'.format(key, value))
+    return errors
+
+
+def validate_script(resource_manager, template_data, script):
+    """
+    Check a script's directives, and the job parameters they set, before any of its jobs are submitted.
+
+    The script is given as (line number, line) tuples, like
+    drmr.script.iter_script yields. Every directive is parsed, every
+    amount of memory and time limit is normalized, and every
+    destination is checked, with one query listing the resource
+    manager's destinations. Raises drmr.exceptions.ValidationError
+    listing every error found, so the script can be fixed in one go,
+    instead of failing with some of its jobs already submitted.
+    """
+    errors = [(None, error) for error in check_job_parameters(template_data)]
+
+    # The line where each destination is first named. Slurm takes a
+    # comma-separated list of partitions, and each must exist.
+    destinations = collections.OrderedDict()
+    if template_data.get('destination'):
+        for destination in template_data['destination'].split(','):
+            destinations.setdefault(destination, None)
+
+    for line_number, line in script:
+        try:
+            directive, args = drmr.script.parse_directive(line)
+        except (NotImplementedError, ValueError) as e:
+            errors.append((line_number, str(e)))
+            continue
+
+        if directive == 'job' and args and args != 'default':
+            job_directives = {}
+            for arg in args.split():
+                key, equals, value = arg.partition('=')
+                if equals:
+                    job_directives[key] = value
+                else:
+                    errors.append((line_number, 'Job directive arguments must be given as key=value, not "{}"'.format(arg)))
+            errors.extend((line_number, error) for error in check_job_parameters(job_directives))
+            if job_directives.get('destination'):
+                for destination in job_directives['destination'].split(','):
+                    destinations.setdefault(destination, line_number)
+
+    if destinations:
+        known_destinations = resource_manager.get_destinations()
+        for destination, line_number in destinations.items():
+            # Hidden destinations may not be listed, so ask about any that aren't.
+            if destination not in known_destinations and not resource_manager.validate_destination(destination):
+                errors.append((line_number, '{} has no destination "{}"'.format(resource_manager.name, destination)))
+
+    if errors:
+        raise drmr.exceptions.ValidationError(sorted(errors, key=lambda error: error[0] or 0))
+
+
+def create_jobs(
+        resource_manager, template_data, script, wait_list=None,
+        mail_at_finish=False, mail_on_error=False, from_label=None, to_label=None,
+        start_held=False, submit_concurrency=1, direct_dependencies=False, pack_size=1,
+        completed_markers=None, shared_job_scripts=False, arrays=False, right_sizer=None,
+        telemetry=False):
+    """
+    Submit the script's commands as jobs, with the dependencies given by its directives.
+
+    The script is read lazily, as (line number, line) tuples like
+    drmr.script.iter_script yields. Returns a PipelineResult, with the
+    list of job IDs, the lists of the IDs of the jobs between each wait
+    directive, and the ID of the job that records the success of the
+    whole script. If every command had already succeeded, nothing is
+    submitted, and the completion job ID is None.
+
+    With arrays, the jobs between wait directives that have the same
+    parameters are submitted as one array job, and its ID stands for
+    theirs in the result.
+
+    Given a drmr.history.RightSizer, the parameters of each job that
+    runs a single command are passed through its adjust method.
+
+    With telemetry, each job records how its commands behaved in the
+    control directory; see make_telemetry_command.
+    """
+
+    if wait_list is None:
+        wait_list = []
+
+    if completed_markers is None:
+        completed_markers = set()
+
+    logger = logging.getLogger('{}.{}'.format(__name__, create_jobs.__name__))
+
+    if from_label:
+        logger.debug('Skipping everything before label "{}"'.format(from_label))
+
+    if to_label:
+        logger.debug('Skipping everything after label "{}"'.format(to_label))
+
+    master_job_name = template_data['master_job_name']
+    if start_held:
+        logger.debug('Submitting start hold job.')
+        hold_job_name = master_job_name + '.start'
+        hold_id = create_job(resource_manager, template_data, hold_job_name, """echo 'Job "{}" started.'""".format(master_job_name), wait_list, mail_on_error, start_held)
+        wait_list = [(hold_id, hold_job_name)]
+
+    if telemetry:
+        template_data = drmr.jobspec.JobSpec(template_data, {'telemetry': True})
+
+    prereqs = wait_list[:]
+    all_jobs = []
+    # The IDs of the jobs between each wait directive, for the job manifest
+    stages = []
+    stage_start = 0
+    job_directives = {}
+    job_number = 0
+    from_label_seen = False
+
+    # The commands between wait directives are independent, so they
+    # can be queued and submitted concurrently. The queue is limited
+    # to keep memory use down, and submission is immediate when
+    # submitting serially. Submitting arrays, the queue holds every
+    # job until the next wait, so they can be grouped.
+    pending_jobs = []
+    max_pending_jobs = submit_concurrency > 1 and submit_concurrency * 64 or 1
+
+    # Consecutive commands are gathered into a pack of up to
+    # pack_size, which is queued as one job when it's full, or when a
+    # directive changes the job parameters or dependencies.
+    default_pack_size = pack_size
+    pack = None
+
+    # Each command records its success with a marker named by
+    # drmr.script.make_command_key. Commands whose markers are in
+    # completed_markers are skipped.
+    marker_directory = resource_manager.make_marker_directory(drmr.jobspec.JobSpec(template_data))
+    skipped = 0
+    skipped_in_stage = False
+
+    # With shared job scripts, commands go in one table, and jobs
+    # with the same parameters use the same job script to run them.
+    # The table is named for this submission, so a resubmission can't
+    # change the commands of jobs still queued from an earlier one.
+    command_table = None
+    if shared_job_scripts:
+        table_data = drmr.jobspec.JobSpec(template_data, {'job_name': '{}.{}'.format(master_job_name, datetime.datetime.now().strftime('%Y%m%d%H%M%S%f'))})
+        command_table = drmr.table.CommandTable(resource_manager.make_command_table_filename(table_data))
+        command_table.open()
+
+    for line_number, line in script:
+        directive, args = drmr.script.parse_directive(line)
+        if directive and pack and directive != 'label':
+            queue_packed_job(resource_manager, pending_jobs, pack, prereqs, mail_on_error)
+            pack = None
+
+        if directive:
+            if directive == 'job' and args:
+                if args == 'default':
+                    job_directives = {}
+                else:
+                    job_directives.update(dict([a.split('=', 1) for a in args.split()]))
+            elif directive == 'label':
+                if from_label is not None and from_label in args:
+                    from_label_seen = True
+                    logger.debug('From label "{}" seen. Starting.'.format(from_label))
+                if to_label is not None and to_label in args:
+                    logger.debug('To label "{}" seen. Stopping.'.format(to_label))
+                    break
+            elif directive == 'pack':
+                pack_size = drmr.script.parse_pack_size(args, default_pack_size)
+            elif directive == 'wait':
+                submit_pending_jobs(resource_manager, pending_jobs, wait_list, all_jobs, submit_concurrency, command_table, arrays, right_sizer)
+                if len(all_jobs) > stage_start or skipped_in_stage:
+                    stages.append(all_jobs[stage_start:])
+                    stage_start = len(all_jobs)
+                stage_skipped, skipped_in_stage = skipped_in_stage, False
+                if not wait_list:
+                    if stage_skipped and not direct_dependencies:
+                        # number the following jobs as in the run being resumed
+                        job_number += 1
+                    continue
+
+                if direct_dependencies:
+                    # The next jobs wait for the jobs since the last
+                    # wait themselves, or if there were none, for
+                    # whatever those were waiting for.
+                    stage_jobs = wait_list[len(prereqs):]
+                    if stage_jobs:
+                        prereqs = stage_jobs
+                    wait_list = prereqs[:]
+                    continue
+
+                job_number += 1
+                job_name = master_job_name + '.{}'.format(job_number)
+                with resource_manager.profiler.phase('merge', job_name):
+                    job_data = drmr.jobspec.JobSpec(
+                        template_data,
+                        dict(
+                            job_directives,
+                            job_name=job_name,
+                            notes=make_wait_list_note(wait_list),
+                        )
+                    )
+                job_id = resource_manager.submit_completion_jobs(job_data, [wait_id for wait_id, wait_name in wait_list])
+                wait_list = [(job_id, job_name + '.success')]
+                prereqs = wait_list[:]
+        else:
+            if from_label is not None and not from_label_seen:
+                logger.debug('From label not yet seen, skipping line {} [{}]'.format(line_number, line))
+                continue
+
+            if pack is None:
+                job_number += 1
+                job_name = master_job_name + '.{}'.format(job_number)
+                with resource_manager.profiler.phase('merge', job_name):
+                    job_template_data = drmr.jobspec.JobSpec(template_data, job_directives)
+                pack = (job_template_data, job_name, [])
+
+            command_key = drmr.script.make_command_key(line, job_directives)
+            if command_key in completed_markers:
+                logger.debug('Skipping command on line {} that already succeeded: [{}]'.format(line_number, line))
+                skipped += 1
+                skipped_in_stage = True
+                pack[2].append(None)
+            else:
+                # array jobs share one set of parameters, and their usage is reported per task
+                if right_sizer is not None and pack_size == 1 and not arrays:
+                    pack = (right_sizer.adjust(pack[0], pack[1], line), pack[1], pack[2])
+                pack[2].append(resource_manager.make_marked_command(line, drmr.util.absjoin(marker_directory, command_key)))
+            if len(pack[2]) >= pack_size:
+                queue_packed_job(resource_manager, pending_jobs, pack, prereqs, mail_on_error)
+                pack = None
+                if not arrays and len(pending_jobs) >= max_pending_jobs:
+                    submit_pending_jobs(resource_manager, pending_jobs, wait_list, all_jobs, submit_concurrency, command_table, arrays, right_sizer)
+
+    if pack:
+        queue_packed_job(resource_manager, pending_jobs, pack, prereqs, mail_on_error)
+    submit_pending_jobs(resource_manager, pending_jobs, wait_list, all_jobs, submit_concurrency, command_table, arrays, right_sizer)
+    if len(all_jobs) > stage_start or skipped_in_stage:
+        stages.append(all_jobs[stage_start:])
+
+    if command_table:
+        command_table.close()
+
+    if skipped:
+        logger.info('Skipped {} commands that already succeeded.'.format(skipped))
+        if not all_jobs:
+            return PipelineResult(all_jobs, stages, None)
+
+    if direct_dependencies and wait_list[len(prereqs):]:
+        wait_list = wait_list[len(prereqs):]
+
+    completion_data = drmr.jobspec.JobSpec(template_data, {'job_name': master_job_name, 'notes': make_wait_list_note(wait_list)})
+    completion_job_id = resource_manager.submit_completion_jobs(completion_data, [w[0] for w in wait_list], mail_at_finish=mail_at_finish)
+
+    cancel_data = drmr.jobspec.JobSpec(template_data, {'job_name': master_job_name + '.cancel'})
+    resource_manager.write_cancel_script(cancel_data, all_jobs + [completion_job_id])
+    resource_manager.write_job_manifest(dict(template_data), stages, completion_job_id)
+
+    return PipelineResult(all_jobs, stages, completion_job_id)
+
+
+class Pipeline(object):
+    """
+    A pipeline built in Python, and submitted just like a drmr script.
+
+    Commands and directives are added in the order they'd appear in a
+    script:
+
+        pipeline = drmr.pipeline.Pipeline('align', resource_manager)
+        pipeline.job(processors=4, time_limit='4h')
+        pipeline.add_command('bwa mem ref.fa a.fq > a.sam')
+        pipeline.add_command('bwa mem ref.fa b.fq > b.sam')
+        pipeline.wait()
+        pipeline.add_command('samtools merge all.bam a.sam b.sam')
+        result = pipeline.submit()
+
+    Pipelines given the same resource manager share its probed
+    capabilities, compiled templates and queue snapshots, so many can
+    be submitted from one process without repeating that work. Without
+    a resource manager, one is made from the user's drmr configuration.
+    """
+
+    def __init__(self, name, resource_manager=None, account=None, destination=None, working_directory=None):
+        if resource_manager is None:
+            config = drmr.config.load_configuration({'account': account, 'destination': destination})
+            resource_manager = drmr.config.get_resource_manager(config['resource_manager'], config)
+
+        working_directory = os.path.abspath(working_directory or os.getcwd())
+        self.resource_manager = resource_manager
+        self.template_data = {
+            'account': account or resource_manager.config.get('account'),
+            'destination': destination or resource_manager.config.get('destination'),
+            'master_job_name': name,
+            'submission_directory': working_directory,
+            'working_directory': working_directory,
+        }
+        self.completed_markers = set()
+        self.right_sizer = None
+        self.script = []
+
+    def add(self, line):
+        """Add a line of a drmr script: a command or a directive."""
+        self.script.append(((None, line),))
+
+    def add_command(self, command):
+        """Add a command, which will be run in its own job, or in a pack."""
+        if drmr.script.is_boring(command) or drmr.script.is_directive(command):
+            raise ValueError('Not a command: "{}"'.format(command))
+        self.add(command)
+
+    def add_script(self, script):
+        """
+        Add the commands and directives of a drmr script.
+
+        The script can be a string, or any iterable of lines, like an
+        open file, which will be read as the pipeline is submitted:
+        once to check it, and again to submit it. See
+        drmr.script.ScriptLines.
+        """
+        self.script.append(drmr.script.ScriptLines(script))
+
+    def iter_script(self):
+        """Yield the line number and text of each command and directive added to the pipeline, parsing any scripts again."""
+        for part in self.script:
+            if isinstance(part, drmr.script.ScriptLines):
+                part = self.resource_manager.profiler.iterate('parse', drmr.script.iter_script(part))
+            for line in part:
+                yield line
+
+    def job(self, **parameters):
+        """Set job parameters, as a job directive would, for the commands that follow. With no parameters, revert to the defaults."""
+        arguments = ' '.join('{}={}'.format(key, value) for key, value in sorted(parameters.items())) or 'default'
+        line = '# drmr:job {}'.format(arguments)
+        drmr.script.parse_directive(line)
+        self.add(line)
+
+    def label(self, label):
+        """Add a label, which submit's from_label and to_label can name."""
+        self.add('# drmr:label {}'.format(label))
+
+    def pack(self, size=None):
+        """Pack up to size of the following commands into each job. Without a size, revert to submit's pack_size."""
+        self.add('# drmr:pack {}'.format(size and 'size={:d}'.format(size) or 'default'))
+
+    def wait(self):
+        """Make the commands that follow wait for the success of every command before."""
+        self.add('# drmr:wait')
+
+    def resume(self, control_directory):
+        """
+        Resume an earlier submission of the pipeline, given its control directory.
+
+        Only commands that haven't succeeded will be submitted. Raises
+        ValueError if the path isn't a control directory.
+        """
+        self.template_data.update(self.resource_manager.parse_control_directory(control_directory))
+        marker_directory = self.resource_manager.make_marker_directory(dict(self.template_data))
+        self.completed_markers = set(os.listdir(marker_directory))
+
+    def submit(self, wait_list=None, **options):
+        """
+        Submit the pipeline, returning a PipelineResult.
+
+        wait_list is a list of the IDs of jobs that must succeed
+        before any of the pipeline's start; each may instead be a tuple
+        of the ID and a description, for the job scripts' notes. Other
+        options are those of create_jobs: mail_at_finish,
+        mail_on_error, from_label, to_label, start_held,
+        submit_concurrency, direct_dependencies, pack_size,
+        shared_job_scripts, arrays and telemetry. Telemetry is also
+        turned on by setting telemetry in the configuration.
+
+        With right_size='suggest', the memory and time each command has
+        used in earlier runs are looked up in drmr.history.JobHistory,
+        and the suggestions are left in right_sizer for
+        format_suggestions; with 'apply', they're used where they're
+        lower than the job's request. Either way, and whenever the
+        configuration sets job_history, the jobs are recorded in the
+        history.
+
+        The whole script is checked with validate_script first, and if
+        there's anything wrong with it, drmr.exceptions.ValidationError
+        is raised before any job is submitted.
+        """
+        return self.create_jobs(self.resource_manager, wait_list, options)
+
+    def plan(self, wait_list=None, **options):
+        """
+        Work out the jobs the pipeline would submit, without submitting them.
+
+        Takes the same arguments as submit, and returns a
+        drmr.plan.JobGraph of the jobs. Nothing is written to the
+        control directory, and nothing is submitted.
+        The pipeline can still be submitted afterward.
+        """
+        job_graph = drmr.plan.JobGraph(self.template_data['master_job_name'])
+        options['shared_job_scripts'] = False
+        result = self.create_jobs(drmr.plan.make_planner(self.resource_manager, job_graph), wait_list, options, record=False)
+        job_graph.set_stages(result.stages)
+        return job_graph
+
+    def create_jobs(self, resource_manager, wait_list, options, record=True):
+        self.template_data.setdefault('timestamp', datetime.datetime.now().strftime('%Y%m%d%H%M%S'))
+        wait_list = [isinstance(job, tuple) and job or (job, 'from caller') for job in wait_list or []]
+
+        options = dict(options)
+        config = self.resource_manager.config
+        right_size = options.pop('right_size', None) or (record and config.get('job_history') and 'record' or None)
+        if right_size not in (None, 'record', 'suggest', 'apply'):
+            raise ValueError('Invalid right_size "{}": it must be "suggest" or "apply".'.format(right_size))
+        options['telemetry'] = bool(options.get('telemetry') or config.get('telemetry'))
+
+        # Check the whole script before anything is submitted.
+        with resource_manager.profiler.phase('validate', self.template_data['master_job_name']):
+            validate_script(resource_manager, self.template_data, self.iter_script())
+
+        history = None
+        self.right_sizer = None
+        if right_size:
+            history = drmr.history.JobHistory(config.get('job_history_file'))
+            if record:
+                # planning only reads the history, without asking the resource manager anything
+                history.update(self.resource_manager)
+            self.right_sizer = drmr.history.RightSizer(self.resource_manager, history, right_size, config.get('right_size_margin', 1.5), config.get('right_size_min_jobs', 3))
+
+        try:
+            result = create_jobs(
+                resource_manager,
+                self.template_data,
+                self.iter_script(),
+                wait_list,
+                completed_markers=self.completed_markers,
+                right_sizer=self.right_sizer,
+                **options
+            )
+            if self.right_sizer is not None and record:
+                self.right_sizer.save()
+            return result
+        finally:
+            if history is not None:
+                history.close()
@@ -0,0 +1,280 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+Planning pipelines: the jobs they'd submit, worked out without submitting them.
+"""
+
+from __future__ import print_function
+
+import collections
+import json
+
+import drmr.jobspec
+import drmr.util
+
+
+def get_time_limit_seconds(time_limit):
+    """Convert a time limit, as normalized by drmr.util.normalize_time, to seconds."""
+    hours, minutes, seconds = time_limit.split(':')
+    return int(hours) * 60 * 60 + int(minutes) * 60 + int(seconds)
+
+
+def format_seconds(seconds):
+    return '{:d}:{:02d}:{:02d}'.format(int(seconds // 3600), int(seconds % 3600 // 60), int(seconds % 60))
+
+
+class JobGraph(object):
+    """
+    The jobs a pipeline would submit, and their dependencies.
+
+    Jobs are added in the order they'd be submitted, after any jobs
+    they depend on. Each is a dictionary of its name, its kind ('job',
+    'hold' for a start hold job, or 'barrier' for the completion jobs
+    drmr submits at each wait directive), the stage it belongs to, the
+    number of tasks if it's an array job, and the resources each task
+    requests. Time limits are in seconds, and memory in megabytes.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.jobs = collections.OrderedDict()
+        self.dependencies = collections.OrderedDict()
+
+    def add_job(self, name, kind='job', dependencies=None, processors=1, nodes=1, memory=None, processor_memory=None, time_limit=None, tasks=1):
+        self.jobs[name] = {
+            'name': name,
+            'kind': kind,
+            'stage': None,
+            'processors': processors,
+            'nodes': nodes,
+            'memory': memory,
+            'processor_memory': processor_memory,
+            'time_limit': time_limit,
+            'tasks': tasks,
+        }
+        self.dependencies[name] = list(dependencies or [])
+
+    def set_stages(self, stages):
+        """Number the stages of the jobs in stages, a list of the lists of job names between wait directives."""
+        for number, stage in enumerate(stages, 1):
+            for name in stage:
+                self.jobs[name]['stage'] = number
+
+    def get_stages(self):
+        """Return the lists of the jobs in each stage, in order."""
+        stages = collections.OrderedDict()
+        for job in self.jobs.values():
+            if job['stage'] is not None:
+                stages.setdefault(job['stage'], []).append(job)
+        return list(stages.values())
+
+    def count_tasks(self, jobs):
+        """Count the jobs, counting each task of an array job."""
+        return sum(job['tasks'] for job in jobs)
+
+    def get_core_hours(self, jobs):
+        """Return the core-hours requested by the jobs that have time limits."""
+        return sum(job['tasks'] * job['processors'] * job['nodes'] * job['time_limit'] for job in jobs if job['time_limit']) / 3600.0
+
+    def get_critical_path(self):
+        """
+        Return the longest chain of dependent jobs, and how long it would take.
+
+        Each job is assumed to run for its whole time limit, as soon
+        as its dependencies are done. Jobs without time limits, and
+        barriers, are counted as taking no time.
+        """
+        finish = collections.OrderedDict()
+        previous = {}
+        for name, job in self.jobs.items():
+            start = 0
+            dependencies = [dependency for dependency in self.dependencies[name] if dependency in finish]
+            if dependencies:
+                previous[name] = max(dependencies, key=finish.get)
+                start = finish[previous[name]]
+            finish[name] = start + (job['kind'] != 'barrier' and job['time_limit'] or 0)
+
+        if not finish:
+            return [], 0
+
+        # prefer the last job to finish, so the path runs through to the pipeline's completion
+        name = max(reversed(list(finish)), key=finish.get)
+        makespan = finish[name]
+        path = [name]
+        while name in previous:
+            name = previous[name]
+            path.append(name)
+        return list(reversed(path)), makespan
+
+    def summarize(self):
+        """
+        Summarize the pipeline's shape and the resources it requests.
+
+        Array jobs are counted as their tasks, and the number of
+        submission commands drmr would run is given as submissions.
+        """
+        jobs = [job for job in self.jobs.values() if job['kind'] != 'barrier']
+        stages = self.get_stages()
+        critical_path, makespan = self.get_critical_path()
+        widest = max(stages, key=self.count_tasks) if stages else []
+        return {
+            'jobs': self.count_tasks(jobs),
+            'submissions': len(jobs) + 2 * len([job for job in self.jobs.values() if job['kind'] == 'barrier']),
+            'stages': [
+                {
+                    'stage': job_list[0]['stage'],
+                    'jobs': self.count_tasks(job_list),
+                    'core_hours': self.get_core_hours(job_list),
+                    'longest_time_limit': max(job['time_limit'] or 0 for job in job_list),
+                }
+                for job_list in stages
+            ],
+            'core_hours': self.get_core_hours(jobs),
+            'jobs_without_time_limit': len([job for job in jobs if not job['time_limit']]),
+            'widest_stage': widest and widest[0]['stage'] or None,
+            'widest_stage_jobs': self.count_tasks(widest),
+            'critical_path': critical_path,
+            'makespan': makespan,
+        }
+
+    def format_summary(self):
+        summary = self.summarize()
+        lines = [
+            'Plan for {}: {} jobs in {} stages, with {} submissions in all.'.format(self.name, summary['jobs'], len(summary['stages']), summary['submissions']),
+            '',
+            '{:<8} {:>8} {:>12} {:>14}'.format('Stage', 'Jobs', 'Core-hours', 'Longest limit'),
+        ]
+        for stage in summary['stages']:
+            lines.append('{:<8} {:>8} {:>12.2f} {:>14}'.format(stage['stage'], stage['jobs'], stage['core_hours'], format_seconds(stage['longest_time_limit'])))
+        lines.append('')
+        lines.append('Core-hours requested: {:.2f}'.format(summary['core_hours']))
+        if summary['jobs_without_time_limit']:
+            lines.append('  ({} jobs have no time limit, and are not counted)'.format(summary['jobs_without_time_limit']))
+        if summary['widest_stage'] is not None:
+            lines.append('Widest stage: {} ({} jobs)'.format(summary['widest_stage'], summary['widest_stage_jobs']))
+        lines.append('Estimated makespan, if every job on the critical path used its whole time limit: {}'.format(format_seconds(summary['makespan'])))
+        return '\n'.join(lines)
+
+    def to_dict(self):
+        jobs = []
+        for name, job in self.jobs.items():
+            jobs.append(dict(job, dependencies=self.dependencies[name]))
+        return {'name': self.name, 'jobs': jobs, 'summary': self.summarize()}
+
+    def write_json(self, filename):
+        with open(filename, 'w') as graph_file:
+            json.dump(self.to_dict(), graph_file, indent=2, sort_keys=True)
+
+    def write_dot(self, filename):
+        """Write the graph in Graphviz's DOT language."""
+        with open(filename, 'w') as graph_file:
+            graph_file.write('digraph {} {{\n'.format(json.dumps(self.name)))
+            graph_file.write('    rankdir=LR;\n')
+            for name, job in self.jobs.items():
+                if job['kind'] == 'barrier':
+                    attributes = 'shape=point'
+                else:
+                    label = '{}\\n{}{} cpu, {}'.format(name, job['tasks'] > 1 and '{} tasks, '.format(job['tasks']) or '', job['processors'] * job['nodes'], job['time_limit'] and format_seconds(job['time_limit']) or 'no limit')
+                    attributes = 'shape=box, label={}'.format(json.dumps(label).replace('\\\\n', '\\n'))
+                graph_file.write('    {} [{}];\n'.format(json.dumps(name), attributes))
+            for name, dependencies in self.dependencies.items():
+                for dependency in dependencies:
+                    graph_file.write('    {} -> {};\n'.format(json.dumps(dependency), json.dumps(name)))
+            graph_file.write('}\n')
+
+    def write(self, filename):
+        """Write the graph in DOT format if the filename ends in .dot or .gv, otherwise JSON."""
+        if filename.endswith(('.dot', '.gv')):
+            self.write_dot(filename)
+        else:
+            self.write_json(filename)
+
+
+class PlanningMixin(object):
+    """
+    Turns a resource manager into a planner that records jobs in a JobGraph instead of submitting them.
+
+    Nothing is written to disk, and the workload manager isn't
+    contacted, but job data is normalized just as it would be for
+    submission, so invalid time limits are caught. Job IDs are the
+    job names. Capabilities are only used if they're already cached;
+    otherwise arrays are split at default_max_array_tasks.
+    """
+
+    # Slurm's default MaxArraySize is 1001, so its arrays hold 1000 tasks.
+    default_max_array_tasks = 1000
+
+    def get_capabilities(self, refresh=False):
+        capabilities = self.get_cached_capabilities()
+        if capabilities is None or not capabilities['installed']:
+            capabilities = self.make_capabilities(True, max_array_tasks=self.default_max_array_tasks)
+        return capabilities
+
+    def make_control_directory(self, job_data):
+        self.set_control_directory(job_data)
+
+    def make_marker_directory(self, job_data):
+        self.set_control_directory(job_data)
+        return drmr.util.absjoin(job_data['control_directory'], 'markers')
+
+    def write_job_file(self, job_data):
+        self.planned_job_data[job_data['job_name']] = job_data
+        return job_data['job_name']
+
+    def submit(self, job_file, hold=False, arguments=None):
+        job_data = drmr.jobspec.JobSpec(self.planned_job_data.pop(job_file))
+        self.normalize_memory(job_data)
+        self.normalize_time_limit(job_data)
+        time_limit = job_data.get('time_limit')
+        array_controls = job_data.get('array_controls') or {}
+        self.job_graph.add_job(
+            job_data['job_name'],
+            kind=hold and 'hold' or 'job',
+            dependencies=[job_id for job_ids in (job_data.get('dependencies') or {}).values() for job_id in job_ids],
+            processors=int(job_data.get('processors') or 1),
+            nodes=int(job_data.get('nodes') or 1),
+            memory=job_data.get('memory') and int(job_data['memory']) or None,
+            processor_memory=job_data.get('processor_memory') and int(drmr.util.normalize_memory(job_data['processor_memory'])) or None,
+            time_limit=time_limit and get_time_limit_seconds(time_limit) or None,
+            tasks=array_controls and array_controls['array_index_max'] - array_controls['array_index_min'] + 1 or 1,
+        )
+        return job_data['job_name']
+
+    def submit_shared_job(self, job_data, command_table, hold=False):
+        return self.submit(self.write_job_file(job_data), hold)
+
+    def submit_completion_jobs(self, job_data, job_list, mail_at_finish=False):
+        if not job_list:
+            raise ValueError('You did not supply a list of job IDs to wait for.')
+        name = job_data['job_name'] + '.success'
+        self.job_graph.add_job(name, kind='barrier', dependencies=job_list)
+        return name
+
+    def get_destinations(self):
+        return frozenset()
+
+    def validate_destination(self, destination):
+        return True
+
+    def write_cancel_script(self, job_data, job_ids):
+        pass
+
+    def write_job_manifest(self, job_data, stages, completion_job_id):
+        pass
+
+
+def make_planner(resource_manager, job_graph):
+    """Make a copy of the resource manager that records the jobs it's given in job_graph instead of submitting them."""
+    planner_class = type('Planning' + resource_manager.__class__.__name__, (PlanningMixin, resource_manager.__class__), {})
+    planner = planner_class(resource_manager.config)
+    planner.profiler = resource_manager.profiler
+    planner.job_graph = job_graph
+    planner.planned_job_data = {}
+    return planner
@@ -0,0 +1,144 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+Timing of the phases of job submission.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import drmr.util
+
+
+class Profiler(object):
+    """
+    Records how long each phase of submission takes, for each job.
+
+    Code to be timed is wrapped in a phase:
+
+        with profiler.phase('render', job_name):
+            ...
+
+    A disabled profiler records nothing, so phases can be left in place
+    at little cost. Phases may be timed from several threads at once.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.events = []
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name, job=None):
+        """Time the enclosed code as the named phase of the given job's submission."""
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, job, start, time.time() - start)
+
+    def iterate(self, name, iterable, job=None):
+        """
+        Iterate over iterable, timing the iteration as the named phase.
+
+        For lazy iterables, like a script being parsed as it's read,
+        only the time spent producing items is counted, not the time
+        spent on them by the loop consuming them. It's recorded when
+        the iteration ends.
+        """
+        if not self.enabled:
+            return iter(iterable)
+        return self.iterate_timed(name, iterable, job)
+
+    def iterate_timed(self, name, iterable, job=None):
+        start = time.time()
+        duration = 0.0
+        iterator = iter(iterable)
+        try:
+            while True:
+                item_start = time.time()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    duration += time.time() - item_start
+                yield item
+        finally:
+            self.record(name, job, start, duration)
+
+    def record(self, name, job, start, duration):
+        """Record that the named phase of the job started at start (a time.time() value) and took duration seconds."""
+        with self.lock:
+            self.events.append({
+                'phase': name,
+                'job': job,
+                'start': start - self.started,
+                'duration': duration,
+                'thread': threading.current_thread().name,
+            })
+
+    def summarize(self):
+        """
+        Return a summary of each phase, in the order the phases were first seen.
+
+        Each summary is a dictionary with the phase name, and the
+        count, total, mean and maximum of its durations, in seconds.
+        """
+        phases = collections.OrderedDict()
+        with self.lock:
+            for event in self.events:
+                phases.setdefault(event['phase'], []).append(event['duration'])
+
+        return [
+            {
+                'phase': name,
+                'count': len(durations),
+                'total': sum(durations),
+                'mean': sum(durations) / len(durations),
+                'max': max(durations),
+            }
+            for name, durations in phases.items()
+        ]
+
+    def format_summary(self):
+        """Format the summary as a table."""
+        lines = ['{:<12} {:>8} {:>12} {:>12} {:>12}'.format('Phase', 'Count', 'Total (s)', 'Mean (ms)', 'Max (ms)')]
+        for phase in self.summarize():
+            lines.append('{phase:<12} {count:>8} {total:>12.3f} {mean_ms:>12.3f} {max_ms:>12.3f}'.format(mean_ms=phase['mean'] * 1000, max_ms=phase['max'] * 1000, **phase))
+        lines.append('Elapsed: {:.3f}s'.format(time.time() - self.started))
+        return '\n'.join(lines)
+
+    def write_trace(self, filename):
+        """Write the summary and every recorded phase to a JSON file."""
+        drmr.util.makedirs(os.path.dirname(filename))
+        with self.lock:
+            events = list(self.events)
+        with open(filename, 'w') as trace:
+            json.dump(
+                {
+                    'started': self.started,
+                    'elapsed': time.time() - self.started,
+                    'summary': self.summarize(),
+                    'events': events,
+                },
+                trace,
+                indent=2,
+                sort_keys=True
+            )
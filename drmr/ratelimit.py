@@ -0,0 +1,62 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+Pacing of the commands drmr sends to resource managers.
+"""
+
+import threading
+import time
+
+
+class RateLimiter(object):
+    """
+    A token bucket that limits how often something is done, adapting its rate to errors.
+
+    Each call to acquire waits for a token. Tokens accumulate at rate
+    per second, up to burst. When the resource manager pushes back,
+    call slow_down, and the rate is halved, down to min_rate; after
+    each success, call speed_up, and it grows by a tenth of max_rate,
+    up to max_rate. Like TCP's congestion control, this backs off
+    quickly and recovers gradually.
+
+    A rate limiter may be shared by several threads.
+    """
+
+    def __init__(self, rate, burst=1, min_rate=None, max_rate=None):
+        self.rate = float(rate)
+        self.max_rate = float(max_rate or rate)
+        self.min_rate = float(min_rate or self.rate / 16)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until the rate limit allows another action."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def slow_down(self):
+        """Halve the rate, after an error suggesting the resource manager is overloaded."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def speed_up(self):
+        """Raise the rate a little, after a success."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
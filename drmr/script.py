@@ -8,6 +8,9 @@
 #
 
 
+import argparse
+import hashlib
+import json
 import logging
 import re
 
@@ -32,9 +35,25 @@ JOB_DIRECTIVES = {
 
 COMMENT_RE = re.compile('(?P<comment>#.*)$')
 CONTINUATION_RE = re.compile('\\\s*$')
-DIRECTIVES = ['job', 'label', 'wait']
+DIRECTIVES = ['job', 'label', 'pack', 'wait']
 DIRECTIVE_RE = re.compile('^#\s*drmr:(?P<directive>{})(\s(?P<args>.*))*'.format('|'.join(DIRECTIVES)))
 EMPTY_RE = re.compile('^\s*$')
+PACK_RE = re.compile('^\s*(?:size=(?P<size>[1-9]\d*)|(?P<default>default))\s*$')
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    """
+    An argument parser for drmr's commands, whose epilog may be a function, only called to show help.
+
+    The help lists the available resource managers, and finding
+    those installed by other packages takes longer than drmr should
+    spend starting up on every run.
+    """
+
+    def format_help(self):
+        if callable(self.epilog):
+            self.epilog = self.epilog()
+        return super(ArgumentParser, self).format_help()
 
 
 def is_empty(line):
@@ -71,25 +90,124 @@ def parse_directive(line):
             for arg in arg_keys:
                 if arg not in JOB_DIRECTIVES:
                     raise NotImplementedError('Unrecognized job directive {} in {}'.format(arg, line))
+        elif directive == 'pack':
+            if not PACK_RE.match(args or ''):
+                raise ValueError('Pack directives must be "size=N", with N a positive integer, or "default": {}'.format(line))
 
     return (directive, args)
 
 
+def parse_pack_size(args, default=1):
+    """Return the pack size given in a pack directive's arguments, or the default if it says "default"."""
+    match = PACK_RE.match(args or '')
+    if not match:
+        raise ValueError('Invalid pack directive arguments: {}'.format(args))
+    return match.group('size') and int(match.group('size')) or default
+
+
+def make_command_key(command, job_directives):
+    """
+    Make a key identifying a command and the job directives it runs with.
+
+    Success markers are named by this key, so a command only counts as
+    done if it succeeded with the same job parameters.
+    """
+    return hashlib.sha1(json.dumps([command, job_directives], sort_keys=True).encode('utf-8')).hexdigest()
+
+
 def is_boring(line):
     """Return True if the line is empty or a comment that does not contain a directive."""
     return is_empty(line) or (is_comment(line) and not is_directive(line))
 
 
-def parse_script(script):
-    """Parse a POSIX script for submission."""
-    lines = [l.strip() for l in script.splitlines() if not is_boring(l)]
+def iter_script(lines):
+    """
+    Parse a POSIX script for submission, one line at a time.
+
+    Takes any iterable of lines, such as an open file, and yields a
+    tuple of the line number where each command starts and the
+    command, with continued lines joined. Boring lines are skipped.
+    Only the command being read is held in memory, so scripts of any
+    size can be parsed as they're read.
+    """
+    line_number = 0
+    command = []
+    command_line_number = None
+    for physical_line in lines:
+        # splitlines, to break lines exactly as parse_script always has
+        for line in physical_line.splitlines() or ['']:
+            line_number += 1
+            if is_boring(line):
+                continue
+
+            line = line.strip()
+            if command_line_number is None:
+                command_line_number = line_number
+            if line.endswith('\\'):  # is_continued, once the line is stripped
+                command.append(line[:-1])
+                continue
+
+            command.append(line)
+            yield command_line_number, ''.join(command)
+            command = []
+            command_line_number = None
+
+    if command and ''.join(command):
+        yield command_line_number, ''.join(command)
+
+
+def get_stream_position(stream):
+    """Return the position of a seekable file, or None if it can't be read again from there, like a pipe."""
+    try:
+        if hasattr(stream, 'seekable') and not stream.seekable():
+            return None
+        return stream.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+class ScriptLines(object):
+    """
+    The lines of a script, which can be read more than once.
+
+    A pipeline's script is read once to check it, then again to
+    submit it. Strings and lists are kept as they are. A seekable file
+    is read again from where it was when it was given, so no script
+    that's in a file is held in memory. Anything else, like a pipe on
+    standard input, can only be read once, so its lines are kept as
+    they're first read.
+    """
+
+    def __init__(self, lines):
+        if hasattr(lines, 'splitlines'):
+            lines = lines.splitlines()
+        self.lines = lines
+        self.position = None
+        self.buffer = None
+        if iter(lines) is lines:
+            # a file or other iterator, which iterating would use up
+            self.position = get_stream_position(lines)
+            if self.position is None:
+                self.buffer = []
+
+    def __iter__(self):
+        if self.position is not None:
+            self.lines.seek(self.position)
+        if self.buffer is None:
+            return iter(self.lines)
+        return self.iter_buffered()
+
+    def iter_buffered(self):
+        # the lines already read, then the rest, kept for next time
+        i = 0
+        while i < len(self.buffer):
+            yield self.buffer[i]
+            i += 1
+        for line in self.lines:
+            self.buffer.append(line)
+            yield line
 
-    commands = ''
-    for line in lines:
-        if is_continued(line):
-            commands += CONTINUATION_RE.sub('', line)
-            continue
-        else:
-            commands += line + '\n'
 
-    return commands.splitlines()
+def parse_script(script):
+    """Parse a POSIX script for submission."""
+    return [command for line_number, command in iter_script(script.splitlines())]
@@ -0,0 +1,651 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+"""
+A stand-in for Slurm and PBS control commands, for testing drmr without a cluster.
+
+The simulator answers sacct, sbatch, squeue, scancel, scontrol, qsub,
+qstat, qdel and qmgr, keeping its jobs in a JSON state file. It can be used
+in-process, by replacing a resource manager's capture_process_output
+with Simulator.capture_process_output, or from the shell, through
+executables created with:
+
+    python -m drmr.simulator --state DIRECTORY install BIN_DIRECTORY
+
+Put BIN_DIRECTORY at the front of your PATH and drmr, or anything
+else, will talk to the simulator. Latency, the rate of transient
+failures, queue limits and how long jobs take are set with
+Simulator.configure or the configure command.
+"""
+
+from __future__ import print_function
+
+import argparse
+import contextlib
+import fcntl
+import getpass
+import json
+import os
+import random
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+
+# The directory containing the drmr package, for the commands'
+# PYTHONPATH. It's found now, as __file__ may be relative to a
+# working directory that has since changed.
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+COMMANDS = [
+    'qdel',
+    'qmgr',
+    'qstat',
+    'qsub',
+    'sacct',
+    'sbatch',
+    'scancel',
+    'scontrol',
+    'squeue',
+]
+
+DEFAULT_SETTINGS = {
+    # seconds each command takes
+    'latency': 0.0,
+    # the probability that submission or control commands fail with a transient error
+    'failure_rate': 0.0,
+    # the most jobs the simulated user may have pending or running
+    'queue_limit': None,
+    # how long jobs run once their dependencies are satisfied, in seconds; None means they stay pending
+    'runtime': None,
+    # the probability that a job exits with an error
+    'job_failure_rate': 0.0,
+    # the peak memory jobs are reported to have used, in megabytes
+    'job_memory': 100,
+    'max_array_size': 1001,
+    # whether Slurm job accounting is available to sacct
+    'accounting': True,
+    'partitions': ['simulated'],
+    'seed': 0,
+}
+
+SLURM_STATES = {
+    'cancelled': 'CANCELLED',
+    'completed': 'COMPLETED',
+    'failed': 'FAILED',
+    'pending': 'PENDING',
+    'running': 'RUNNING',
+}
+
+PBS_STATES = {
+    'cancelled': 'C',
+    'completed': 'C',
+    'failed': 'C',
+    'pending': 'Q',
+    'running': 'R',
+}
+
+SACCT_FIELDS = {
+    'elapsed': 'elapsed',
+    'jobid': 'job_id',
+    'jobname': 'name',
+    'maxrss': 'max_rss',
+    'partition': 'destination',
+    'state': 'slurm_state',
+    'totalcpu': 'elapsed',
+    'user': 'owner',
+}
+
+SQUEUE_FIELDS = {
+    'A': ('ARRAY_JOB_ID', 'job_id'),
+    'i': ('JOBID', 'task_id'),
+    'j': ('NAME', 'name'),
+    'P': ('PARTITION', 'destination'),
+    'T': ('STATE', 'slurm_state'),
+    'u': ('USER', 'owner'),
+}
+
+SLURM_TRANSIENT_ERROR = 'sbatch: error: Batch job submission failed: Socket timed out on send/recv operation'
+SLURM_QUEUE_LIMIT_ERROR = 'sbatch: error: Batch job submission failed: Job violates accounting/QOS policy (job submit limit, user\'s size and/or time limits)'
+PBS_TRANSIENT_ERROR = 'qsub: cannot connect to server simulator (errno=111) Connection refused'
+PBS_QUEUE_LIMIT_ERROR = 'qsub: would exceed queue generic\'s per-user limit'
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return '{:02d}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+class CommandError(Exception):
+    def __init__(self, output, returncode=1):
+        super(CommandError, self).__init__(output)
+        self.output = output
+        self.returncode = returncode
+
+
+class Simulator(object):
+    """A simulated Slurm and PBS controller, keeping its state in a directory."""
+
+    # serializes access by threads of this process; the state file lock handles other processes
+    lock = threading.RLock()
+
+    squeue_field_re = re.compile('%(\\w)')
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.state_filename = os.path.join(self.directory, 'state.json')
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @contextlib.contextmanager
+    def state(self):
+        """Lock, load and yield the simulator state, saving any changes afterward."""
+        with self.lock:
+            with open(os.path.join(self.directory, 'state.lock'), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    state = self.load_state()
+                    yield state
+                    self.save_state(state)
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def load_state(self):
+        try:
+            with open(self.state_filename) as state_file:
+                state = json.load(state_file)
+        except (IOError, OSError, ValueError):
+            state = {}
+
+        state.setdefault('settings', dict(DEFAULT_SETTINGS))
+        state.setdefault('jobs', {})
+        state.setdefault('last_job_id', 0)
+        state.setdefault('statistics', {})
+        return state
+
+    def save_state(self, state):
+        temporary_filename = self.state_filename + '.tmp'
+        with open(temporary_filename, 'w') as state_file:
+            json.dump(state, state_file, indent=1, sort_keys=True)
+        os.rename(temporary_filename, self.state_filename)
+
+    def configure(self, **settings):
+        """Change the simulator's settings. See DEFAULT_SETTINGS."""
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError('Unknown simulator settings: {}'.format(', '.join(sorted(unknown))))
+        with self.state() as state:
+            state['settings'].update(settings)
+
+    def get_statistics(self):
+        """Return counts of the commands run, submissions and failures."""
+        with self.state() as state:
+            return dict(state['statistics'])
+
+    def get_jobs(self):
+        """Return the simulated jobs, with their current states, keyed by ID."""
+        with self.state() as state:
+            self.update_job_states(state)
+            return state['jobs']
+
+    def install(self, bin_directory, python_path=None):
+        """Create executables in bin_directory that run the simulator's commands, importing drmr from python_path."""
+        if not os.path.isdir(bin_directory):
+            os.makedirs(bin_directory)
+
+        python_path = python_path or PACKAGE_DIRECTORY
+        for command in COMMANDS:
+            filename = os.path.join(bin_directory, command)
+            with open(filename, 'w') as shim:
+                shim.write('#!/bin/sh\n')
+                shim.write('PYTHONPATH="{}${{PYTHONPATH:+:$PYTHONPATH}}" exec "{}" -m drmr.simulator --state "{}" {} "$@"\n'.format(python_path, sys.executable, self.directory, command))
+            os.chmod(filename, 0o755)
+
+    def capture_process_output(self, command):
+        """Run a command like subprocess.check_output, raising CalledProcessError if it fails."""
+        returncode, output = self.run(command)
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, command, output)
+        return output
+
+    def run(self, command):
+        """Run a simulated command, given as a list of arguments. Returns its exit status and output."""
+        name = os.path.basename(command[0])
+        if name not in COMMANDS:
+            raise OSError(2, 'No such file or directory: {}'.format(command[0]))
+
+        with self.state() as state:
+            settings = state['settings']
+            statistics = state['statistics']
+            statistics[name] = statistics.get(name, 0) + 1
+            calls = sum(statistics[c] for c in COMMANDS if c in statistics)
+            latency = settings.get('latency') or 0.0
+            self.update_job_states(state)
+            try:
+                output = getattr(self, 'run_' + name)(state, command[1:], random.Random('{}:{}'.format(settings.get('seed'), calls)))
+                returncode = 0
+            except CommandError as e:
+                statistics['errors'] = statistics.get('errors', 0) + 1
+                output, returncode = e.output, e.returncode
+
+        if latency:
+            time.sleep(latency)
+
+        if output and not output.endswith('\n'):
+            output += '\n'
+        return returncode, output
+
+    def maybe_fail(self, state, rng, message):
+        if rng.random() < (state['settings'].get('failure_rate') or 0.0):
+            state['statistics']['injected_failures'] = state['statistics'].get('injected_failures', 0) + 1
+            raise CommandError(message)
+
+    def check_queue_limit(self, state, message):
+        queue_limit = state['settings'].get('queue_limit')
+        if queue_limit is not None:
+            active = [job for job in state['jobs'].values() if job['state'] in ('pending', 'running')]
+            if len(active) >= queue_limit:
+                state['statistics']['queue_limit_rejections'] = state['statistics'].get('queue_limit_rejections', 0) + 1
+                raise CommandError(message)
+
+    #
+    # Job lifecycle
+    #
+
+    def add_job(self, state, name, dependencies, destination=None, array=None, held=False, script=None, export=None):
+        state['last_job_id'] += 1
+        job_id = str(state['last_job_id'])
+        job = {
+            'array': array,
+            'dependencies': dependencies,
+            # the variables given to the job, like sbatch --export or qsub -v
+            'environment': dict(variable.split('=', 1) for variable in (export or '').split(',') if '=' in variable),
+            'destination': destination or state['settings']['partitions'][0],
+            'held': held,
+            'job_id': job_id,
+            'name': name,
+            'owner': getpass.getuser(),
+            'script': script,
+            'state': 'pending',
+            'submitted': time.time(),
+        }
+        state['jobs'][job_id] = job
+        state['statistics']['submitted'] = state['statistics'].get('submitted', 0) + 1
+        return job
+
+    def update_job_states(self, state):
+        """Advance jobs whose dependencies are satisfied, if jobs are configured to run."""
+        runtime = state['settings'].get('runtime')
+        if runtime is None:
+            return
+
+        now = time.time()
+        job_failure_rate = state['settings'].get('job_failure_rate') or 0.0
+        jobs = state['jobs']
+        for job_id in sorted(jobs, key=int):
+            job = jobs[job_id]
+            if job['state'] not in ('pending', 'running') or job['held']:
+                continue
+
+            start = job['submitted']
+            satisfied = True
+            for dependency_state, dependency_ids in job['dependencies'].items():
+                for dependency_id in dependency_ids:
+                    dependency = jobs.get(dependency_id)
+                    if dependency is None:
+                        continue
+                    if dependency_state == 'start':
+                        if dependency['state'] == 'pending':
+                            satisfied = False
+                    elif dependency['state'] in ('pending', 'running'):
+                        satisfied = False
+                    elif dependency_state == 'ok' and dependency['state'] != 'completed':
+                        satisfied = None
+                    elif dependency_state == 'notok' and dependency['state'] == 'completed':
+                        satisfied = None
+                    else:
+                        start = max(start, dependency.get('ended', start))
+                    if satisfied is None:
+                        break
+
+            if satisfied is None:
+                # like a cluster configured to kill jobs whose dependencies can't be met
+                job['state'] = 'cancelled'
+                job['ended'] = now
+            elif satisfied:
+                if now >= start + runtime:
+                    failed = random.Random('{}:{}'.format(state['settings'].get('seed'), job_id)).random() < job_failure_rate
+                    job['state'] = failed and 'failed' or 'completed'
+                    job['started'] = start
+                    job['ended'] = start + runtime
+                    job['exit_code'] = failed and 1 or 0
+                elif now >= start:
+                    job['state'] = 'running'
+                    job['started'] = start
+
+    def cancel_jobs(self, state, job_ids, error_format):
+        jobs = state['jobs']
+        for job_id in job_ids:
+            job = jobs.get(job_id.split('[')[0].split('.')[0].split('_')[0])
+            if job is None:
+                raise CommandError(error_format.format(job_id))
+            if job['state'] in ('pending', 'running'):
+                job['state'] = 'cancelled'
+                job['ended'] = time.time()
+                state['statistics']['cancelled'] = state['statistics'].get('cancelled', 0) + 1
+
+    def read_directives(self, filename, prefix):
+        """Return the arguments of the directive lines (e.g. #SBATCH) in a job script."""
+        arguments = []
+        try:
+            with open(filename) as script:
+                for line in script:
+                    if line.startswith(prefix):
+                        arguments.extend(shlex.split(line[len(prefix):]))
+        except (IOError, OSError) as e:
+            raise CommandError('Unable to open file {}: {}'.format(filename, e))
+        return arguments
+
+    def parse_dependencies(self, dependency_string):
+        """Parse dependencies like "afterok:1:2,afterany:3" into {'ok': ['1', '2'], 'any': ['3']}."""
+        dependencies = {}
+        for dependency in dependency_string.split(','):
+            fields = dependency.split(':')
+            state_name = fields[0]
+            if state_name.startswith('after'):
+                state_name = state_name[len('after'):]
+            if state_name.endswith('array'):
+                state_name = state_name[:-len('array')]
+            dependencies.setdefault(state_name, []).extend(job_id.split('[')[0].split('.')[0] for job_id in fields[1:])
+        return dependencies
+
+    #
+    # Slurm
+    #
+
+    def run_sbatch(self, state, arguments, rng):
+        self.maybe_fail(state, rng, SLURM_TRANSIENT_ERROR)
+        self.check_queue_limit(state, SLURM_QUEUE_LIMIT_ERROR)
+
+        parser = argparse.ArgumentParser(prog='sbatch', add_help=False)
+        parser.add_argument('--array')
+        parser.add_argument('--dependency')
+        parser.add_argument('--export')
+        parser.add_argument('--hold', action='store_true')
+        parser.add_argument('--job-name')
+        parser.add_argument('--output')
+        parser.add_argument('--parsable', action='store_true')
+        parser.add_argument('--partition')
+        parser.add_argument('script')
+
+        options, _ = parser.parse_known_args(arguments)
+        script_options, _ = parser.parse_known_args(self.read_directives(options.script, '#SBATCH') + [options.script])
+        for option, value in vars(options).items():
+            if value:
+                setattr(script_options, option, value)
+
+        partition = script_options.partition
+        # like Slurm, take a comma-separated list of partitions, every one of which must exist
+        if partition and set(partition.split(',')) - set(state['settings']['partitions']):
+            raise CommandError('sbatch: error: Batch job submission failed: Invalid partition name specified')
+
+        dependencies = {}
+        if script_options.dependency:
+            dependencies = self.parse_dependencies(script_options.dependency)
+            for dependency_ids in dependencies.values():
+                for dependency_id in dependency_ids:
+                    if dependency_id not in state['jobs']:
+                        raise CommandError('sbatch: error: Batch job submission failed: Job dependency problem')
+
+        job = self.add_job(state, script_options.job_name or os.path.basename(options.script), dependencies, partition, script_options.array, script_options.hold, options.script, script_options.export)
+        if options.parsable:
+            return job['job_id']
+        return 'Submitted batch job {}'.format(job['job_id'])
+
+    def run_squeue(self, state, arguments, rng):
+        parser = argparse.ArgumentParser(prog='squeue', add_help=False)
+        parser.add_argument('-r', '--array', action='store_true')
+        parser.add_argument('-o', '--format', default='%i %P %j %u %T')
+        parser.add_argument('-h', '--noheader', action='store_true')
+        parser.add_argument('-j', '--jobs')
+        parser.add_argument('-n', '--name')
+        parser.add_argument('-t', '--states')
+        parser.add_argument('-u', '--user')
+        options = parser.parse_args(arguments)
+
+        job_ids = options.jobs and set(options.jobs.split(',')) or None
+        names = options.name and set(options.name.split(',')) or None
+        users = options.user and set(options.user.split(',')) or None
+        states = options.states and set(s.upper() for s in options.states.split(',')) or set(['PENDING', 'RUNNING'])
+        if job_ids and job_ids - set(state['jobs']):
+            raise CommandError('slurm_load_jobs error: Invalid job id specified')
+
+        def format_line(values):
+            return self.squeue_field_re.sub(lambda m: str(values(SQUEUE_FIELDS[m.group(1)])), options.format)
+
+        lines = []
+        if not options.noheader:
+            lines.append(format_line(lambda field: field[0]))
+
+        for job_id in sorted(state['jobs'], key=int):
+            job = dict(state['jobs'][job_id], slurm_state=SLURM_STATES[state['jobs'][job_id]['state']])
+            if 'ALL' not in states and job['slurm_state'] not in states:
+                continue
+            if job_ids and job_id not in job_ids:
+                continue
+            if names and job['name'] not in names:
+                continue
+            if users and job['owner'] not in users:
+                continue
+            task_ids = [job_id]
+            if job['array'] and options.array:
+                # like real squeue -r, array tasks are listed one per line, as JOBID_TASK
+                first, _, last = job['array'].split('%')[0].partition('-')
+                task_ids = ['{}_{}'.format(job_id, i) for i in range(int(first), int(last or first) + 1)]
+            for task_id in task_ids:
+                task = dict(job, task_id=task_id)
+                lines.append(format_line(lambda field: task[field[1]]))
+
+        return '\n'.join(lines)
+
+    def run_sacct(self, state, arguments, rng):
+        if not state['settings'].get('accounting', True):
+            raise CommandError('sacct: error: Slurm accounting storage is disabled')
+        parser = argparse.ArgumentParser(prog='sacct', add_help=False)
+        parser.add_argument('-n', '--noheader', action='store_true')
+        parser.add_argument('-P', '--parsable2', action='store_true')
+        parser.add_argument('-X', '--allocations', action='store_true')
+        parser.add_argument('-o', '--format', default='JobID,JobName,Partition,State')
+        parser.add_argument('-j', '--jobs')
+        options = parser.parse_args(arguments)
+
+        fields = [field.lower() for field in options.format.split(',')]
+        job_ids = options.jobs and set(options.jobs.split(',')) or None
+        separator = options.parsable2 and '|' or ' '
+
+        lines = []
+        if not options.noheader:
+            lines.append(separator.join(field.capitalize() for field in fields))
+
+        for job_id in sorted(state['jobs'], key=int):
+            if job_ids and job_id not in job_ids:
+                continue
+            job = dict(state['jobs'][job_id], slurm_state=SLURM_STATES[state['jobs'][job_id]['state']], elapsed='', max_rss='')
+            ran = 'started' in job and 'ended' in job
+            if ran:
+                job['elapsed'] = format_duration(job['ended'] - job['started'])
+            task_ids = [job_id]
+            if job['array']:
+                first, _, last = job['array'].split('%')[0].partition('-')
+                task_ids = ['{}_{}'.format(job_id, i) for i in range(int(first), int(last or first) + 1)]
+            for task_id in task_ids:
+                lines.append(separator.join(str(dict(job, job_id=task_id)[SACCT_FIELDS[field]]) for field in fields))
+                if ran and not options.allocations:
+                    # like real accounting, memory use is reported for the job's batch step
+                    step = dict(job, job_id=task_id + '.batch', name='batch', max_rss='{}K'.format(int(state['settings'].get('job_memory') or 0) * 1000))
+                    lines.append(separator.join(str(step[SACCT_FIELDS[field]]) for field in fields))
+
+        return '\n'.join(lines)
+
+    def run_scancel(self, state, arguments, rng):
+        self.maybe_fail(state, rng, 'scancel: error: Kill job error on job id: Socket timed out on send/recv operation')
+        self.cancel_jobs(state, arguments, 'scancel: error: Invalid job id {}')
+        return ''
+
+    def run_scontrol(self, state, arguments, rng):
+        if arguments == ['version']:
+            return 'slurm 17.11.0-simulated'
+        if arguments[:2] == ['show', 'config']:
+            return 'Configuration data as of simulated\nMaxArraySize            = {}\nSLURM_VERSION           = 17.11.0-simulated'.format(state['settings']['max_array_size'])
+        if arguments[:2] == ['show', 'partition']:
+            if len(arguments) == 2:
+                return '\n\n'.join('PartitionName={}\n   State=UP'.format(partition) for partition in state['settings']['partitions'])
+            if arguments[2] in state['settings']['partitions']:
+                return 'PartitionName={}\n   State=UP'.format(arguments[2])
+            raise CommandError('Partition {} not found'.format(arguments[2]))
+        raise CommandError('scontrol: error: unsupported command: {}'.format(' '.join(arguments)))
+
+    #
+    # PBS
+    #
+
+    def run_qsub(self, state, arguments, rng):
+        self.maybe_fail(state, rng, PBS_TRANSIENT_ERROR)
+        self.check_queue_limit(state, PBS_QUEUE_LIMIT_ERROR)
+
+        parser = argparse.ArgumentParser(prog='qsub', add_help=False)
+        parser.add_argument('-h', dest='hold', action='store_true')
+        parser.add_argument('-N', dest='name')
+        parser.add_argument('-o', dest='output')
+        parser.add_argument('-v', dest='export')
+        parser.add_argument('-W', dest='attributes', action='append', default=[])
+        parser.add_argument('-q', dest='queue')
+        parser.add_argument('-t', dest='array')
+        parser.add_argument('script')
+
+        options, _ = parser.parse_known_args(arguments)
+        script_options, _ = parser.parse_known_args(self.read_directives(options.script, '#PBS') + [options.script])
+        for option, value in vars(options).items():
+            if value:
+                setattr(script_options, option, value)
+
+        queue = script_options.queue
+        if queue and queue not in state['settings']['partitions']:
+            raise CommandError('qsub: submit error (Unknown queue MSG=cannot locate queue)')
+
+        dependencies = {}
+        for attribute in script_options.attributes:
+            if attribute.startswith('depend='):
+                dependencies = self.parse_dependencies(attribute[len('depend='):])
+
+        job = self.add_job(state, script_options.name or os.path.basename(options.script), dependencies, queue, script_options.array, script_options.hold, options.script, script_options.export)
+        return '{}{}.simulator'.format(job['job_id'], job['array'] and '[]' or '')
+
+    def run_qstat(self, state, arguments, rng):
+        if arguments[:2] == ['-Q', '-f']:
+            if not arguments[2:]:
+                return '\n\n'.join('Queue: {}\n    queue_type = Execution'.format(queue) for queue in state['settings']['partitions'])
+            if arguments[2] in state['settings']['partitions']:
+                return 'Queue: {}\n    queue_type = Execution'.format(arguments[2])
+            raise CommandError('qstat: Unknown queue MSG=cannot locate queue')
+
+        parser = argparse.ArgumentParser(prog='qstat', add_help=False)
+        parser.add_argument('-t', action='store_true')
+        parser.add_argument('-x', action='store_true')
+        parser.add_argument('-u', dest='users')
+        parser.add_argument('job_ids', nargs='*')
+        options = parser.parse_args(arguments)
+
+        job_ids = set(job_id.split('[')[0].split('.')[0] for job_id in options.job_ids)
+        users = options.users and set(options.users.split(',')) or None
+        unknown_job_ids = job_ids - set(state['jobs'])
+        if unknown_job_ids:
+            raise CommandError('qstat: Unknown Job Id {}.simulator'.format(min(unknown_job_ids)), returncode=153)
+
+        xml = ['<Data>']
+        for job_id in sorted(state['jobs'], key=int):
+            job = state['jobs'][job_id]
+            if job_ids and job_id not in job_ids:
+                continue
+            if users and job['owner'] not in users:
+                continue
+
+            pbs_state = job['held'] and job['state'] == 'pending' and 'H' or PBS_STATES[job['state']]
+            full_ids = ['{}.simulator'.format(job_id)]
+            if job['array'] and options.t:
+                first, _, last = job['array'].split('%')[0].partition('-')
+                full_ids = ['{}[{}].simulator'.format(job_id, i) for i in range(int(first), int(last or first) + 1)]
+            resources_used = ''
+            if 'started' in job and 'ended' in job:
+                resources_used = '<resources_used><cput>{0}</cput><mem>{1}kb</mem><walltime>{0}</walltime></resources_used>'.format(
+                    format_duration(job['ended'] - job['started']), int(state['settings'].get('job_memory') or 0) * 1000
+                )
+            for full_id in full_ids:
+                xml.append(
+                    '<Job><Job_Id>{}</Job_Id><Job_Name>{}</Job_Name><Job_Owner>{}@simulator</Job_Owner><job_state>{}</job_state>{}{}</Job>'.format(
+                        full_id, job['name'], job['owner'], pbs_state,
+                        'exit_code' in job and '<exit_status>{}</exit_status>'.format(job['exit_code']) or '',
+                        resources_used,
+                    )
+                )
+        xml.append('</Data>')
+        return ''.join(xml)
+
+    def run_qdel(self, state, arguments, rng):
+        self.maybe_fail(state, rng, 'qdel: Server simulator is busy, try again later')
+        self.cancel_jobs(state, arguments, 'qdel: Unknown Job Id {}')
+        return ''
+
+    def run_qmgr(self, state, arguments, rng):
+        return 'Server simulator\n\tpbs_version = 4.2.10-simulated\n\tmax_job_array_size = {}'.format(state['settings']['max_array_size'])
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m drmr.simulator',
+        description='Simulate Slurm and PBS control commands.',
+    )
+    parser.add_argument('--state', default=os.environ.get('DRMR_SIMULATOR_STATE', '.drmr-simulator'), help='The directory holding the simulator state (default: $DRMR_SIMULATOR_STATE or .drmr-simulator).')
+    parser.add_argument('command', help='A simulated command ({}), or one of: configure, install, jobs, statistics.'.format(', '.join(COMMANDS)))
+    parser.add_argument('arguments', nargs=argparse.REMAINDER, help='Arguments for the command.')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_arguments(argv)
+    simulator = Simulator(args.state)
+
+    if args.command == 'install':
+        if len(args.arguments) != 1:
+            print('Usage: install BIN_DIRECTORY', file=sys.stderr)
+            return 1
+        simulator.install(args.arguments[0])
+    elif args.command == 'configure':
+        settings = {}
+        for argument in args.arguments:
+            key, _, value = argument.partition('=')
+            settings[key] = json.loads(value)
+        simulator.configure(**settings)
+    elif args.command == 'jobs':
+        print(json.dumps(simulator.get_jobs(), indent=2, sort_keys=True))
+    elif args.command == 'statistics':
+        print(json.dumps(simulator.get_statistics(), indent=2, sort_keys=True))
+    else:
+        returncode, output = simulator.run([args.command] + args.arguments)
+        (returncode and sys.stderr or sys.stdout).write(output)
+        return returncode
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+#
+# drmr: A tool for submitting pipeline scripts to distributed resource
+# managers.
+#
+# Copyright 2015 Stephen Parker
+#
+# Licensed under Version 3 of the GPL or any later version
+#
+
+
+import io
+import os
+import threading
+
+
+# Each index record holds the byte offset and length of one command.
+RECORD_FORMAT = u'{:020d} {:020d}\n'
+RECORD_WIDTH = len(RECORD_FORMAT.format(0, 0))
+
+
+class CommandTable(object):
+    """
+    A file of commands with a fixed-width index, for constant-time lookup.
+
+    The commands are concatenated in one file. Its index, in the same
+    place with ".index" appended to the name, has a fixed-width record
+    of offset and length for each command, so a job can seek straight
+    to the Nth record and then to its command, no matter how many
+    commands there are. The table is append-only, and commands are
+    numbered from 1, like array job indexes. Commands may be appended
+    from several threads at once.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.index_filename = filename + '.index'
+        self.count = 0
+        self.offset = 0
+        self.commands = None
+        self.index = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        """Create the table, replacing any existing table of the same name."""
+        self.commands = io.open(self.filename, 'wb')
+        self.index = io.open(self.index_filename, 'wb')
+        self.count = 0
+        self.offset = 0
+
+    def close(self):
+        for f in (self.commands, self.index):
+            if f is not None:
+                f.close()
+        self.commands = self.index = None
+
+    def append(self, command):
+        """Add a command to the table, returning its index."""
+        encoded = command.encode('utf-8')
+        with self.lock:
+            if self.commands is None:
+                self.open()
+
+            self.commands.write(encoded)
+            self.index.write(RECORD_FORMAT.format(self.offset, len(encoded)).encode('ascii'))
+            self.offset += len(encoded)
+            self.count += 1
+            return self.count
+
+    def extend(self, commands):
+        """Add each of the given commands to the table, returning the index of the last."""
+        for command in commands:
+            self.append(command)
+        return self.count
+
+    def flush(self, sync=False):
+        """
+        Make sure everything appended so far is on disk, where jobs can read it.
+
+        With sync, wait until it's really on disk, or on the file
+        server, so jobs on other hosts can read it right away.
+        """
+        with self.lock:
+            for f in (self.commands, self.index):
+                if f is not None:
+                    f.flush()
+                    if sync:
+                        os.fsync(f.fileno())
+
+    def get(self, index):
+        """Return the command with the given index."""
+        if index < 1:
+            raise IndexError('Command table indexes start at 1.')
+
+        self.flush()
+        with io.open(self.index_filename, 'rb') as index_file:
+            index_file.seek((index - 1) * RECORD_WIDTH)
+            record = index_file.read(RECORD_WIDTH)
+        if len(record) < RECORD_WIDTH:
+            raise IndexError('No command {} in {}'.format(index, self.filename))
+
+        offset, length = [int(field) for field in record.split()]
+        with io.open(self.filename, 'rb') as commands:
+            commands.seek(offset)
+            return commands.read(length).decode('utf-8')
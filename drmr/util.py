@@ -10,12 +10,18 @@
 
 import copy
 import decimal
+import errno
+import functools
 import os
 import re
 
 
 MEMORY = re.compile('^([0-9]+)(?:([gkmt])b?)?$', re.IGNORECASE)
 
+# Bytes in each unit of memory. Units are decimal, so a gigabyte is
+# 1000 megabytes, in memory requests and in reported usage alike.
+MEMORY_UNITS = {'': 1, 'k': 1000, 'm': 1000 ** 2, 'g': 1000 ** 3, 't': 1000 ** 4}
+
 # First, let me apologize for you having to spend part of your life
 # trying to parse this nasty regular expression.
 #
@@ -37,6 +43,29 @@ MINUTES = re.compile('(' + FLOAT_PATTERN + ')m')
 SECONDS = re.compile('(' + FLOAT_PATTERN + ')(?:s|\Z)')
 TIME_UNITS = re.compile('(' + FLOAT_PATTERN + ')[dhms\Z]')
 
+
+def memoize(function):
+    """
+    Cache a function's results by its arguments, which must be hashable.
+
+    A pipeline's jobs ask for the same few amounts of memory and time
+    limits over and over, so each is only parsed once. Exceptions
+    aren't cached.
+    """
+    cache = {}
+
+    @functools.wraps(function)
+    def memoized(*arguments):
+        try:
+            return cache[arguments]
+        except KeyError:
+            result = cache[arguments] = function(*arguments)
+            return result
+
+    return memoized
+
+
+@memoize
 def normalize_memory(memory):
     """
     Normalizes a string describing an amount of memory.
@@ -50,18 +79,21 @@ def normalize_memory(memory):
     match = MEMORY.match(memory)
     if match:
         amount, unit = match.groups('')
-        amount = int(amount)
-        unit = unit.lower()
-        if unit == 'g':
-            amount *= 1000
-        elif unit == 'k':
-            amount //= 1000
-        elif unit == 't':
-            amount *= 1000 * 1000
+        amount = int(amount) * MEMORY_UNITS[unit.lower() or 'm'] // MEMORY_UNITS['m']
 
     return amount
 
 
+def get_megabytes(amount, unit=''):
+    """
+    Converts an amount of memory in the given unit (k, m, g or t, or
+    bytes if there's none) to megabytes, rounding up.
+    """
+
+    megabytes = decimal.Decimal(str(amount)) * MEMORY_UNITS[unit.lower()] / MEMORY_UNITS['m']
+    return int(megabytes.quantize(decimal.Decimal('1.'), decimal.ROUND_UP))
+
+
 def tally_time_units(regex, time_string):
     occurrences = regex.findall(time_string)
     return sum(occurrence and float(occurrence) or 0.0 for occurrence in occurrences)
@@ -107,6 +139,7 @@ def make_time_string(days=0, hours=0, minutes=0, seconds=0):
     return '{:02f}:{:02f}:{:02f}'.format(hours, minutes, seconds)
 
 
+@memoize
 def normalize_time(time):
     """
     Normalizes a string describing a duration.
@@ -135,7 +168,25 @@ def makedirs(*paths):
             if not os.path.isdir(path):
                 raise ValueError('Path exists but is not a directory: %s' % path)
         else:
-            os.makedirs(path)
+            try:
+                os.makedirs(path)
+            except OSError as e:
+                # someone else (another submission thread, say) may have just created it
+                if e.errno != errno.EEXIST or not os.path.isdir(path):
+                    raise
+
+
+def get_cache_directory(*paths):
+    """
+    Return the path of drmr's cache directory, or of paths within it.
+
+    The DRMR_CACHE_DIR environment variable overrides the default of
+    $XDG_CACHE_HOME/drmr (usually ~/.cache/drmr).
+    """
+    cache_directory = os.environ.get('DRMR_CACHE_DIR')
+    if not cache_directory:
+        cache_directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'drmr')
+    return os.path.join(cache_directory, *paths)
 
 
 def absjoin(*paths):
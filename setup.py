@@ -12,9 +12,13 @@ readme = open('README.rst').read()
 
 requirements = [
     'Jinja2',
-    'lxml'
 ]
 
+# lxml is only needed to read qstat's XML
+extra_requirements = {
+    'PBS': ['lxml'],
+}
+
 test_requirements = []
 
 setup(
@@ -31,9 +35,12 @@ setup(
         'scripts/drmrc',
         'scripts/drmrarray',
         'scripts/drmrm',
+        'scripts/drmrreport',
+        'scripts/drmrstatus',
     ],
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extra_requirements,
     license="GPLv3+",
     zip_safe=False,
     keywords='DRM distributed resource workload manager pipeline',
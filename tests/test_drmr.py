@@ -3,15 +3,43 @@
 
 from __future__ import print_function
 
+import getpass
 import json
 import os
+import random
 import shutil
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import unittest
 
 import drmr.config
+import drmr.drm.PBS
+import drmr.drm.Slurm
+import drmr.drm.base
+import drmr.exceptions
+import drmr.history
+import drmr.jobspec
+import drmr.pipeline
+import drmr.profile
+import drmr.ratelimit
+import drmr.script
+import drmr.simulator
+import drmr.table
 import drmr.util
 
+# drmr.__file__ may be relative, so this is found before any test changes directory.
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(drmr.__file__)))
+
+
+def restore_environment_variable(name, value):
+    if value is None:
+        os.environ.pop(name, None)
+    else:
+        os.environ[name] = value
+
 
 class TestMemoryParsing(unittest.TestCase):
 
@@ -83,9 +111,13 @@ class TestPBS(unittest.TestCase):
         self.oldpath = os.environ['PATH']
         os.environ['PATH'] = self.tmpdir
 
+        self.oldcachedir = os.environ.get('DRMR_CACHE_DIR')
+        os.environ['DRMR_CACHE_DIR'] = self.tmpdir
+
     def tearDown(self):
         shutil.rmtree(self.tmpdir)
         os.environ['PATH'] = self.oldpath
+        restore_environment_variable('DRMR_CACHE_DIR', self.oldcachedir)
         os.chdir(self.oldcwd)
 
     def testPBS(self):
@@ -158,9 +190,13 @@ class TestSlurm(unittest.TestCase):
         self.oldpath = os.environ['PATH']
         os.environ['PATH'] = self.tmpdir
 
+        self.oldcachedir = os.environ.get('DRMR_CACHE_DIR')
+        os.environ['DRMR_CACHE_DIR'] = self.tmpdir
+
     def tearDown(self):
         # shutil.rmtree(self.tmpdir)
         os.environ['PATH'] = self.oldpath
+        restore_environment_variable('DRMR_CACHE_DIR', self.oldcachedir)
         os.chdir(self.oldcwd)
 
     def testSlurm(self):
@@ -222,3 +258,1242 @@ class TestSlurm(unittest.TestCase):
             pass  # right, job 2 is invalid
 
         resource_manager.delete_jobs([job_id])
+
+
+class TestCapabilities(unittest.TestCase):
+
+    def setUp(self):
+        self.oldcwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrcapabilitiestest')
+        os.chdir(self.tmpdir)
+
+        self.oldpath = os.environ['PATH']
+        os.environ['PATH'] = self.tmpdir
+
+        self.oldcachedir = os.environ.get('DRMR_CACHE_DIR')
+        os.environ['DRMR_CACHE_DIR'] = self.tmpdir
+
+        # count the probes by having the fake scontrol log each version check
+        with open('scontrol', 'w') as scontrol:
+            scontrol.write(
+                '#!/bin/sh\n'
+                'if [ "$1" = "version" ]; then echo probed >> {}/probes; echo "slurm 17.02.1"; fi\n'
+                'if [ "$1" = "show" ]; then echo "MaxArraySize            = 1001"; fi\n'.format(self.tmpdir)
+            )
+        os.chmod('scontrol', 0o755)
+
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+
+    def tearDown(self):
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+        shutil.rmtree(self.tmpdir)
+        os.environ['PATH'] = self.oldpath
+        restore_environment_variable('DRMR_CACHE_DIR', self.oldcachedir)
+        os.chdir(self.oldcwd)
+
+    def count_probes(self):
+        if not os.path.exists('probes'):
+            return 0
+        with open('probes') as probes:
+            return len(probes.readlines())
+
+    def test_probe_once_per_process(self):
+        resource_manager = drmr.config.get_resource_manager('Slurm')
+        self.assertTrue(resource_manager.is_installed())
+        self.assertTrue(resource_manager.is_installed())
+        self.assertTrue(drmr.config.get_resource_manager('Slurm').is_installed())
+        self.assertEqual(self.count_probes(), 1)
+
+        capabilities = resource_manager.get_capabilities()
+        self.assertEqual(capabilities['name'], 'Slurm')
+        self.assertEqual(capabilities['version'], '17.02.1')
+        self.assertTrue(capabilities['features']['arrays'])
+        self.assertIn('notok', capabilities['features']['dependency_states'])
+        self.assertEqual(capabilities['features']['max_array_tasks'], 1000)
+
+    def test_disk_cache(self):
+        self.assertTrue(drmr.config.get_resource_manager('Slurm').is_installed())
+
+        # a new process would start with an empty in-memory cache
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+        self.assertTrue(drmr.config.get_resource_manager('Slurm').is_installed())
+        self.assertEqual(self.count_probes(), 1)
+
+        # but not trust the disk cache once it has expired
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+        resource_manager = drmr.config.get_resource_manager('Slurm')
+        resource_manager.capability_cache_ttl = -1
+        self.assertTrue(resource_manager.is_installed())
+        self.assertEqual(self.count_probes(), 2)
+
+    def test_failed_probe_cached(self):
+        # the probes are logged outside the PATH, so logging them doesn't look like an installation
+        os.mkdir('bin')
+        os.environ['PATH'] = os.path.join(self.tmpdir, 'bin')
+        with open('bin/qmgr', 'w') as qmgr:
+            qmgr.write('#!/bin/sh\necho probed >> {}/probes\nexit 1\n'.format(self.tmpdir))
+        os.chmod('bin/qmgr', 0o755)
+
+        self.assertFalse(drmr.config.get_resource_manager('PBS').is_installed())
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+        self.assertFalse(drmr.config.get_resource_manager('PBS').is_installed())
+        self.assertEqual(self.count_probes(), 1)
+
+        # installing a command on the PATH means probing again
+        with open('bin/qstat', 'w') as qstat:
+            qstat.write('#!/bin/sh\n')
+        self.assertFalse(drmr.config.get_resource_manager('PBS').is_installed())
+        self.assertEqual(self.count_probes(), 2)
+
+        # and a different PATH gets a probe of its own
+        os.environ['PATH'] = os.path.join(self.tmpdir, 'bin') + os.pathsep + self.tmpdir
+        self.assertFalse(drmr.config.get_resource_manager('PBS').is_installed())
+        self.assertEqual(self.count_probes(), 3)
+
+
+class TestResourceManagerRegistry(unittest.TestCase):
+
+    def test_lazy_loading(self):
+        # in a new process, getting one resource manager doesn't import the others, or anything heavy
+        package_directory = os.path.dirname(os.path.dirname(os.path.abspath(drmr.__file__)))
+        output = subprocess.check_output(
+            [
+                sys.executable, '-c',
+                'import sys, drmr.config; drmr.config.get_resource_manager("Slurm", {}); '
+                'print(" ".join(sorted(name for name in sys.modules if sys.modules[name] and name.split(".")[0] in ("drmr", "jinja2", "lxml", "sqlite3", "inspect"))))'
+            ],
+            env=dict(os.environ, PYTHONPATH=package_directory),
+            universal_newlines=True
+        )
+        modules = output.split()
+        self.assertIn('drmr.drm.Slurm', modules)
+        for module in ['drmr.drm.Local', 'drmr.drm.PBS', 'jinja2', 'lxml', 'sqlite3', 'inspect']:
+            self.assertNotIn(module, modules)
+
+    def test_registration(self):
+        registry = drmr.config.ResourceManagerRegistry({'Slurm': 'drmr.drm.Slurm:Slurm'})
+        self.assertIs(registry['Slurm'], drmr.drm.Slurm.Slurm)
+        self.assertNotIn('PBS', registry)
+        self.assertRaises(KeyError, registry.__getitem__, 'PBS')
+
+        registry.register('PBS', drmr.drm.PBS.PBS)
+        registry.register('Torque', 'drmr.drm.PBS:PBS')
+        self.assertEqual(list(registry), ['PBS', 'Slurm', 'Torque'])
+        self.assertIs(registry['Torque'], drmr.drm.PBS.PBS)
+
+        self.assertTrue(set(['Local', 'PBS', 'Slurm']) <= set(drmr.config.RESOURCE_MANAGERS))
+        self.assertRaises(drmr.exceptions.ConfigurationError, drmr.config.get_resource_manager, 'Nonexistent')
+
+
+class TestJobSpec(unittest.TestCase):
+
+    def setUp(self):
+        self.template_data = {'master_job_name': 'test', 'memory': '4g', 'environment_setup': ['module load samtools']}
+
+    def test_layering(self):
+        directives = drmr.jobspec.JobSpec(self.template_data, {'memory': '8g'})
+        job_data = drmr.jobspec.JobSpec(directives, {'job_name': 'test.1'})
+        self.assertEqual(job_data['memory'], '8g')
+        self.assertEqual(job_data['master_job_name'], 'test')
+        self.assertEqual(len(job_data.get_layers()), 3)
+        self.assertEqual(dict(job_data), {'master_job_name': 'test', 'memory': '8g', 'environment_setup': ['module load samtools'], 'job_name': 'test.1'})
+
+        # changes only go in the top layer
+        job_data['memory'] = '16g'
+        del job_data['master_job_name']
+        self.assertNotIn('master_job_name', job_data)
+        self.assertRaises(KeyError, lambda: job_data['master_job_name'])
+        self.assertEqual(job_data.pop('job_name'), 'test.1')
+        self.assertEqual(sorted(job_data), ['environment_setup', 'memory'])
+        self.assertEqual(directives['memory'], '8g')
+        self.assertEqual(self.template_data['master_job_name'], 'test')
+
+        child = job_data.child()
+        child['memory'] = '1g'
+        self.assertEqual(job_data['memory'], '16g')
+        self.assertEqual(child, {'memory': '1g', 'environment_setup': ['module load samtools']})
+
+        # a child sees later changes to its parent, but a copy doesn't
+        copy = job_data.copy()
+        job_data['processors'] = 4
+        job_data['memory'] = '32g'
+        self.assertEqual(child['processors'], 4)
+        self.assertEqual(child['memory'], '1g')
+        self.assertEqual(copy, {'memory': '16g', 'environment_setup': ['module load samtools']})
+        self.assertEqual(copy.get_layers(), [copy.layer])
+
+    def test_job_script_leaves_template_alone(self):
+        oldvirtualenv = os.environ.get('VIRTUAL_ENV')
+        os.environ['VIRTUAL_ENV'] = '/tmp/venv'
+        try:
+            resource_manager = drmr.config.get_resource_manager('Slurm', {'template_cache': False})
+            for job_number in (1, 2):
+                job_data = drmr.jobspec.JobSpec(self.template_data, {'job_name': 'test.{}'.format(job_number), 'command': 'true', 'timestamp': '20160101000000'})
+                script = resource_manager.make_job_script(job_data)
+                self.assertEqual(script.count('. /tmp/venv/bin/activate'), 1)
+            self.assertEqual(self.template_data, {'master_job_name': 'test', 'memory': '4g', 'environment_setup': ['module load samtools']})
+            self.assertEqual(resource_manager.default_job_data['environment_setup'], [])
+        finally:
+            restore_environment_variable('VIRTUAL_ENV', oldvirtualenv)
+
+
+class TestTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrtemplatetest')
+        self.oldcachedir = os.environ.get('DRMR_CACHE_DIR')
+        os.environ['DRMR_CACHE_DIR'] = self.tmpdir
+
+        self.job_data = {
+            'master_job_name': 'test',
+            'job_name': 'test.1',
+            'timestamp': '20160101000000',
+            'command': 'echo "hello world"',
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        restore_environment_variable('DRMR_CACHE_DIR', self.oldcachedir)
+
+    def test_templates_compiled_once(self):
+        resource_manager = drmr.config.get_resource_manager('Slurm')
+        template = resource_manager.get_template(resource_manager.default_job_template, trim_blocks=True, lstrip_blocks=True)
+        another_instance = drmr.config.get_resource_manager('Slurm')
+        self.assertIs(template, another_instance.get_template(another_instance.default_job_template, trim_blocks=True, lstrip_blocks=True))
+
+        script = resource_manager.make_job_script(self.job_data)
+        self.assertIn('#SBATCH --job-name=test.1', script)
+        self.assertIn('echo "hello world"', script)
+        self.assertTrue(os.listdir(os.path.join(self.tmpdir, 'templates')))
+
+    def test_job_template_override(self):
+        template_filename = os.path.join(self.tmpdir, 'site.template')
+        with open(template_filename, 'w') as template_file:
+            template_file.write('#!/bin/sh\n# site template for {{job_name}}\n{{command}}\n')
+
+        resource_manager = drmr.config.get_resource_manager('PBS', {'job_template': template_filename, 'template_cache': False})
+        script = resource_manager.make_job_script(self.job_data)
+        self.assertEqual(script, '#!/bin/sh\n# site template for test.1\necho "hello world"')
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'templates')))
+
+
+class TestCommandTable(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrtabletest')
+        self.commands = [
+            'echo first',
+            'echo "second" | tr a-z A-Z',
+            u'echo "ünicode"',
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        with drmr.table.CommandTable(os.path.join(self.tmpdir, 'test.commands')) as table:
+            self.assertEqual(table.extend(self.commands), 3)
+            for index, command in enumerate(self.commands, 1):
+                self.assertEqual(table.get(index), command)
+            with self.assertRaises(IndexError):
+                table.get(4)
+
+    def test_shell_lookup(self):
+        resource_manager = drmr.config.get_resource_manager('Slurm', {'template_cache': False})
+        with drmr.table.CommandTable(os.path.join(self.tmpdir, 'test.commands')) as table:
+            table.extend(self.commands[:2])
+
+        lookup = resource_manager.make_array_table_command(table)
+        for index, expected_output in [(1, 'first\n'), (2, 'SECOND\n')]:
+            environment = dict(os.environ, SLURM_ARRAY_TASK_ID=str(index))
+            output = subprocess.check_output(['/bin/bash', '-c', lookup], env=environment, universal_newlines=True)
+            self.assertEqual(output, expected_output)
+
+
+class TestArrayPlanning(unittest.TestCase):
+
+    def setUp(self):
+        self.resource_manager = drmr.config.get_resource_manager('Slurm')
+
+    def test_no_limit(self):
+        chunks = self.resource_manager.plan_array_jobs(5000, 'all', 0)
+        self.assertEqual(chunks, [{'offset': 0, 'size': 5000, 'concurrency': 5000, 'after': None}])
+
+    def test_split(self):
+        chunks = self.resource_manager.plan_array_jobs(2500, 'all', 1000)
+        self.assertEqual([(c['offset'], c['size'], c['concurrency'], c['after']) for c in chunks], [
+            (0, 1000, 1000, None),
+            (1000, 1000, 1000, None),
+            (2000, 500, 500, None),
+        ])
+
+    def test_slot_limit_below_array_size(self):
+        chunks = self.resource_manager.plan_array_jobs(2500, 100, 1000)
+        self.assertEqual([(c['concurrency'], c['after']) for c in chunks], [(100, None), (100, 0), (100, 1)])
+
+    def test_slot_limit_spans_arrays(self):
+        chunks = self.resource_manager.plan_array_jobs(5000, 2500, 1000)
+        self.assertEqual([(c['concurrency'], c['after']) for c in chunks], [
+            (1000, None),
+            (1000, None),
+            (1000, 0),
+            (1000, 1),
+            (1000, 2),
+        ])
+        # never more than the slot limit running at once
+        lanes = len([c for c in chunks if c['after'] is None])
+        self.assertLessEqual(lanes * chunks[0]['concurrency'], 2500)
+
+
+class TestLocal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrlocaltest')
+        self.oldcachedir = os.environ.get('DRMR_CACHE_DIR')
+        os.environ['DRMR_CACHE_DIR'] = self.tmpdir
+        self.resource_manager = drmr.config.get_resource_manager('Local', {'local_processors': 2, 'local_memory': 1000})
+        self.job_data = {
+            'master_job_name': 'test',
+            'submission_directory': self.tmpdir,
+            'timestamp': '20160101000000',
+            'working_directory': self.tmpdir,
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        restore_environment_variable('DRMR_CACHE_DIR', self.oldcachedir)
+
+    def submit(self, job_name, command, **job_data):
+        job_data.update(self.job_data, job_name=job_name, command=command)
+        return self.resource_manager.submit(self.resource_manager.write_job_file(job_data))
+
+    def read_output(self, job_name, job_id):
+        with open(os.path.join(self.tmpdir, '.drmr', 'test-20160101000000', '{}_{}.out'.format(job_name, job_id))) as output:
+            return output.read()
+
+    def test_not_detected(self):
+        self.assertNotIn('Local', drmr.config.get_available_resource_managers())
+
+    def test_dependencies(self):
+        first = self.submit('test.1', 'echo first > order')
+        second = self.submit('test.2', 'echo second >> order', dependencies={'ok': [first]})
+        failure = self.submit('test.3', 'echo failing; exit 3', dependencies={'ok': [second]})
+        never = self.submit('test.4', 'echo never', dependencies={'ok': [failure]})
+        cleanup = self.submit('test.5', 'echo cleanup', dependencies={'any': [never]})
+        recovery = self.submit('test.6', 'echo recovery', dependencies={'notok': [failure]})
+
+        self.assertFalse(self.resource_manager.wait_for_jobs())
+
+        with open(os.path.join(self.tmpdir, 'order')) as order:
+            self.assertEqual(order.read(), 'first\nsecond\n')
+
+        states = dict((job_id, self.resource_manager.jobs[job_id].state) for job_id in [first, second, failure, never, cleanup, recovery])
+        self.assertEqual(states, {first: 'ok', second: 'ok', failure: 'failed', never: 'cancelled', cleanup: 'ok', recovery: 'ok'})
+        self.assertEqual(self.read_output('test.3', failure), 'failing\n')
+        self.assertEqual(self.read_output('test.6', recovery), 'recovery\n')
+
+    def test_admission(self):
+        # each job wants the whole machine, so they must run one at a time
+        for i in range(3):
+            self.submit('test.{}'.format(i), 'mkdir running || exit 1; sleep 0.2; rmdir running', processors='2')
+        self.assertTrue(self.resource_manager.wait_for_jobs())
+
+    def test_array(self):
+        array_data = dict(self.job_data, job_name='test')
+        with drmr.table.CommandTable(self.resource_manager.make_command_table_filename(array_data)) as table:
+            table.extend(['echo {}'.format(i) for i in range(1, 6)])
+
+        array_id = self.submit('test', self.resource_manager.make_array_table_command(table), array_controls={'array_index_min': 1, 'array_index_max': 5, 'array_concurrent_jobs': 2})
+        self.assertTrue(self.resource_manager.wait_for_jobs())
+        for i in range(1, 6):
+            self.assertEqual(self.read_output('test', '{}_{}'.format(array_id, i)), '{}\n'.format(i))
+
+
+class TestSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrsimulatortest')
+        self.oldcachedir = os.environ.get('DRMR_CACHE_DIR')
+        os.environ['DRMR_CACHE_DIR'] = self.tmpdir
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+
+        self.simulator = drmr.simulator.Simulator(os.path.join(self.tmpdir, 'simulator'))
+        self.job_data = {
+            'master_job_name': 'test',
+            'submission_directory': self.tmpdir,
+            'timestamp': '20160101000000',
+            'working_directory': self.tmpdir,
+        }
+
+    def tearDown(self):
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+        shutil.rmtree(self.tmpdir)
+        restore_environment_variable('DRMR_CACHE_DIR', self.oldcachedir)
+
+    def get_resource_manager(self, name):
+        resource_manager = drmr.config.get_resource_manager(name)
+        resource_manager.capture_process_output = self.simulator.capture_process_output
+        return resource_manager
+
+    def submit(self, resource_manager, job_name, **job_data):
+        job_data.update(self.job_data, job_name=job_name, command='true')
+        return resource_manager.submit(resource_manager.write_job_file(job_data))
+
+    def test_slurm(self):
+        resource_manager = self.get_resource_manager('Slurm')
+        self.assertEqual(resource_manager.get_capabilities()['features']['max_array_tasks'], 1000)
+        self.assertTrue(resource_manager.validate_destination('simulated'))
+        self.assertFalse(resource_manager.validate_destination('nonexistent'))
+
+        first = self.submit(resource_manager, 'test.1')
+        second = self.submit(resource_manager, 'test.2', dependencies={'ok': [first]})
+        self.assertEqual(resource_manager.get_active_job_ids(), set([first, second]))
+        self.assertEqual(resource_manager.get_active_job_ids(job_name='test.2'), set([second]))
+
+        resource_manager.delete_jobs([first], job_owner=getpass.getuser())
+        self.assertEqual(resource_manager.get_active_job_ids(), set([second]))
+
+        # once jobs run, the dependent job can never start
+        self.simulator.configure(runtime=0)
+        resource_manager.invalidate_queue_snapshots()
+        self.assertEqual(resource_manager.get_active_job_ids(), set())
+        self.assertEqual(self.simulator.get_jobs()[second]['state'], 'cancelled')
+
+    def test_pbs(self):
+        resource_manager = self.get_resource_manager('PBS')
+        self.assertEqual(resource_manager.get_capabilities()['version'], '4.2.10-simulated')
+        self.assertTrue(resource_manager.validate_destination('simulated'))
+
+        job_id = self.submit(resource_manager, 'test.1')
+        self.assertEqual(job_id, '1.simulator')
+        array_id = self.submit(resource_manager, 'test.2', array_controls={'array_index_min': 1, 'array_index_max': 3, 'array_concurrent_jobs': 2})
+        self.assertEqual(array_id, '2[].simulator')
+        self.assertEqual(resource_manager.get_active_job_ids(job_name='test.2'), set(['2[{}].simulator'.format(i) for i in range(1, 4)]))
+
+        resource_manager.delete_jobs(job_owner=getpass.getuser())
+        self.assertEqual(resource_manager.get_active_job_ids(), set())
+
+    def test_queue_snapshots(self):
+        resource_manager = self.get_resource_manager('Slurm')
+        commands = []
+
+        def capture_process_output(command):
+            commands.append(command)
+            return self.simulator.capture_process_output(command)
+
+        resource_manager.capture_process_output = capture_process_output
+        owner = getpass.getuser()
+        first = self.submit(resource_manager, 'test.1')
+        second = self.submit(resource_manager, 'test.2')
+
+        self.assertEqual(resource_manager.get_active_job_ids(job_owner=owner), set([first, second]))
+        self.assertEqual(resource_manager.get_active_job_ids(job_name='test.2', job_owner=owner), set([second]))
+        self.assertEqual(self.simulator.get_statistics()['squeue'], 1)
+        self.assertIn('--user={}'.format(owner), commands[-1])
+
+        self.assertEqual(resource_manager.get_active_job_ids([first, '999']), set([first]))
+        self.assertEqual([c for c in commands if c[0] == 'squeue'][-1][-1], '--states=CONFIGURING,COMPLETING,PENDING,PREEMPTED,RUNNING,SUSPENDED')
+        self.assertEqual(resource_manager.get_active_job_ids([int(first)]), set([first]))
+
+        resource_manager.delete_jobs([first])
+        self.assertEqual(resource_manager.get_active_job_ids(job_owner=owner), set([second]))
+
+        resource_manager.config['queue_snapshot_ttl'] = 0
+        resource_manager.get_active_job_ids(job_owner=owner)
+        resource_manager.get_active_job_ids(job_owner=owner)
+        self.assertEqual(self.simulator.get_statistics()['squeue'], 7)
+
+    def test_active_job_id_batches(self):
+        for name, command in [('Slurm', 'squeue'), ('PBS', 'qstat')]:
+            resource_manager = self.get_resource_manager(name)
+            resource_manager.job_state_batch_size = 2
+            job_ids = [self.submit(resource_manager, 'test.{}'.format(i)) for i in range(5)]
+            queries = self.simulator.get_statistics().get(command, 0)
+            self.assertEqual(resource_manager.get_active_job_ids(job_ids), set(job_ids))
+            self.assertEqual(self.simulator.get_statistics()[command], queries + 3)
+
+            # a command line that's too long is treated like a rejected query
+            def capture_process_output(arguments):
+                if any(job_ids[0] in argument for argument in arguments[1:]):
+                    raise OSError(7, 'Argument list too long')
+                return self.simulator.capture_process_output(arguments)
+
+            resource_manager.capture_process_output = capture_process_output
+            resource_manager.invalidate_queue_snapshots()
+            self.assertEqual(resource_manager.get_active_job_ids(job_ids[:3]), set(job_ids[:3]))
+
+    def test_job_states(self):
+        for name in ['Slurm', 'PBS']:
+            resource_manager = self.get_resource_manager(name)
+            job_id = self.submit(resource_manager, 'test.1')
+            array_id = self.submit(resource_manager, 'test.2', array_controls={'array_index_min': 1, 'array_index_max': 3})
+            self.assertEqual(resource_manager.get_job_states([job_id, array_id, '999']), {job_id: 'pending', array_id: 'pending', '999': 'unknown'})
+
+            self.simulator.configure(runtime=0)
+            resource_manager.invalidate_queue_snapshots()
+            self.assertEqual(resource_manager.get_job_states([job_id, array_id]), {job_id: 'done', array_id: 'done'})
+            self.simulator.configure(runtime=None)
+
+    def test_job_states_without_accounting(self):
+        resource_manager = self.get_resource_manager('Slurm')
+        self.simulator.configure(accounting=False)
+        job_id = self.submit(resource_manager, 'test.1')
+        array_id = self.submit(resource_manager, 'test.2', array_controls={'array_index_min': 1, 'array_index_max': 3})
+        task_id = '{}_2'.format(array_id)
+        self.assertEqual(
+            resource_manager.get_job_states([job_id, array_id, task_id, '999']),
+            {job_id: 'pending', array_id: 'pending', task_id: 'pending', '999': 'unknown'}
+        )
+        statistics = self.simulator.get_statistics()
+        self.assertEqual(statistics['sacct'], 1)
+        self.assertEqual(statistics['squeue'], 1)
+
+        self.simulator.configure(runtime=0)
+        resource_manager.invalidate_queue_snapshots()
+        self.assertEqual(resource_manager.get_job_states([job_id, array_id, task_id]), {job_id: 'done', array_id: 'done', task_id: 'done'})
+
+    def test_batched_deletion(self):
+        for name in ['Slurm', 'PBS']:
+            resource_manager = self.get_resource_manager(name)
+            resource_manager.deletion_batch_size = 2
+            job_ids = [self.submit(resource_manager, 'test.{}'.format(i)) for i in range(5)]
+            resource_manager.delete_jobs(job_ids)
+            self.assertEqual(resource_manager.get_active_job_ids(), set())
+
+        statistics = self.simulator.get_statistics()
+        self.assertEqual(statistics['scancel'], 3)
+        self.assertEqual(statistics['qdel'], 3)
+
+    def test_deletion_retries(self):
+        resource_manager = self.get_resource_manager('Slurm')
+        resource_manager.deletion_rate = 1000.0
+        job_ids = [self.submit(resource_manager, 'test.{}'.format(i)) for i in range(3)]
+        self.simulator.configure(failure_rate=0.5)
+        resource_manager.delete_jobs(job_ids)
+        self.assertTrue(self.simulator.get_statistics()['injected_failures'])
+        self.simulator.configure(failure_rate=0.0)
+        self.assertEqual(resource_manager.get_active_job_ids(), set())
+
+        # a batch that can never be deleted
+        self.assertRaises(drmr.exceptions.DeletionError, resource_manager.delete_job_batches, ['999'])
+
+    def test_cancel_script(self):
+        resource_manager = self.get_resource_manager('PBS')
+        resource_manager.deletion_batch_size = 2
+        job_ids = [self.submit(resource_manager, 'test.{}'.format(i)) for i in range(5)]
+        resource_manager.write_cancel_script(dict(self.job_data, job_name='test.cancel'), job_ids)
+        with open(os.path.join(resource_manager.set_control_directory(dict(self.job_data)), 'test.cancel')) as cancel_script:
+            self.assertEqual(
+                cancel_script.read(),
+                "#!/bin/sh\n\n"
+                "'qdel' '1.simulator' '2.simulator' &\n'qdel' '3.simulator' '4.simulator' &\nwait\nsleep 0.5\n"
+                "'qdel' '5.simulator' &\nwait\n"
+            )
+
+    def test_failures(self):
+        resource_manager = self.get_resource_manager('Slurm')
+        resource_manager.submission_backoff = 0.001
+        self.simulator.configure(failure_rate=1.0)
+        self.assertRaises(drmr.exceptions.SubmissionError, self.submit, resource_manager, 'test.1')
+
+        # queue limits aren't transient, so they're not retried
+        self.simulator.configure(failure_rate=0.0, queue_limit=1)
+        self.submit(resource_manager, 'test.1')
+        self.assertRaises(drmr.exceptions.SubmissionError, self.submit, resource_manager, 'test.2')
+
+        statistics = self.simulator.get_statistics()
+        self.assertEqual(statistics['submitted'], 1)
+        self.assertEqual(statistics['injected_failures'], resource_manager.submission_retries + 1)
+        self.assertEqual(statistics['queue_limit_rejections'], 1)
+
+    def test_submission_pacing(self):
+        resource_manager = self.get_resource_manager('Slurm')
+        resource_manager.submission_backoff = 0.001
+        acquired = []
+        resource_manager.submission_rate_limiter.acquire = lambda: acquired.append(True)
+
+        # submissions aren't paced until the resource manager pushes back
+        for i in range(3):
+            self.submit(resource_manager, 'test.{}'.format(i))
+        self.assertFalse(resource_manager.submission_throttled)
+        self.assertEqual(acquired, [])
+
+        self.simulator.configure(failure_rate=1.0)
+        self.assertRaises(subprocess.CalledProcessError, self.submit, resource_manager, 'test.failed')
+        self.simulator.configure(failure_rate=0.0)
+        self.assertTrue(resource_manager.submission_throttled)
+        self.submit(resource_manager, 'test.paced')
+        # every retry after the first refusal, and the next submission
+        self.assertEqual(len(acquired), resource_manager.submission_retries + 1)
+
+        # a configured rate paces every submission
+        self.assertTrue(drmr.drm.Slurm.Slurm({'submission_rate': 5}).submission_throttled)
+
+    def test_submission_retries(self):
+        resource_manager = self.get_resource_manager('Slurm')
+        resource_manager.submission_backoff = 0.001
+        self.simulator.configure(failure_rate=0.5)
+        job_ids = [self.submit(resource_manager, 'test.{}'.format(i)) for i in range(10)]
+        self.assertEqual(sorted(job_ids, key=int), [str(i) for i in range(1, 11)])
+
+        statistics = self.simulator.get_statistics()
+        self.assertEqual(statistics['submitted'], 10)
+        self.assertTrue(statistics['injected_failures'] > 0)
+        self.assertEqual(resource_manager.submission_statistics['submissions'], 10)
+        self.assertEqual(resource_manager.submission_statistics['retries'], statistics['injected_failures'])
+        self.assertIn('because Slurm was busy', resource_manager.format_submission_statistics())
+
+    def test_install(self):
+        bin_dir = os.path.join(self.tmpdir, 'bin')
+        self.simulator.install(bin_dir)
+        self.simulator.configure(max_array_size=5)
+        output = subprocess.check_output([os.path.join(bin_dir, 'scontrol'), 'show', 'config'], universal_newlines=True)
+        self.assertIn('MaxArraySize            = 5', output)
+
+
+class TestPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrpipelinetest')
+        self.oldcachedir = os.environ.get('DRMR_CACHE_DIR')
+        os.environ['DRMR_CACHE_DIR'] = self.tmpdir
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+
+        self.simulator = drmr.simulator.Simulator(os.path.join(self.tmpdir, 'simulator'))
+        self.resource_manager = drmr.config.get_resource_manager('Slurm')
+        self.resource_manager.capture_process_output = self.simulator.capture_process_output
+
+    def tearDown(self):
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+        shutil.rmtree(self.tmpdir)
+        restore_environment_variable('DRMR_CACHE_DIR', self.oldcachedir)
+
+    def get_jobs_by_name(self):
+        return dict((job['name'], job) for job in self.simulator.get_jobs().values())
+
+    def test_stages(self):
+        pipeline = drmr.pipeline.Pipeline('sample1', self.resource_manager, working_directory=self.tmpdir)
+        pipeline.job(processors=4)
+        pipeline.add_command('echo 1')
+        pipeline.add_command('echo 2')
+        pipeline.wait()
+        pipeline.job()
+        pipeline.add_script('echo 3 \\\n  4\n')
+        result = pipeline.submit()
+
+        jobs = self.get_jobs_by_name()
+        self.assertEqual(result.job_ids, [jobs['sample1.{}'.format(i)]['job_id'] for i in (1, 2, 4)])
+        self.assertEqual(result.stages, [result.job_ids[:2], result.job_ids[2:]])
+        self.assertEqual(result.completion_job_id, jobs['sample1.success']['job_id'])
+        self.assertEqual(jobs['sample1.4']['dependencies'], {'ok': [jobs['sample1.3.success']['job_id']]})
+        with open(jobs['sample1.1']['script']) as job_script:
+            self.assertIn('--cpus-per-task=4', job_script.read())
+        with open(jobs['sample1.4']['script']) as job_script:
+            self.assertIn('echo 3 4', job_script.read())
+
+    def test_shared_resource_manager(self):
+        wait_list = []
+        probes = []
+        for sample in ['sample1', 'sample2']:
+            pipeline = drmr.pipeline.Pipeline(sample, self.resource_manager, working_directory=self.tmpdir)
+            pipeline.add_command('echo {}'.format(sample))
+            wait_list = [pipeline.submit(wait_list=wait_list).completion_job_id]
+            probes.append(self.simulator.get_statistics().get('scontrol', 0))
+
+        jobs = self.get_jobs_by_name()
+        self.assertEqual(jobs['sample2.1']['dependencies'], {'ok': [jobs['sample1.success']['job_id']]})
+        # the resource manager was only probed for the first pipeline
+        self.assertEqual(probes[0], probes[1])
+
+    def test_invalid(self):
+        pipeline = drmr.pipeline.Pipeline('sample1', self.resource_manager, working_directory=self.tmpdir)
+        self.assertRaises(ValueError, pipeline.add_command, '# drmr:wait')
+        self.assertRaises(NotImplementedError, pipeline.job, cores=4)
+
+    def test_validation(self):
+        pipeline = drmr.pipeline.Pipeline('sample1', self.resource_manager, working_directory=self.tmpdir)
+        pipeline.add_command('echo 1')
+        pipeline.add_script('# drmr:job time_limit=forever memory=lots\necho 2\n# drmr:job cores=4 destination=nowhere\necho 3\n# drmr:job destination=nowhere\n')
+        with self.assertRaises(drmr.exceptions.ValidationError) as context:
+            pipeline.submit()
+        self.assertEqual(context.exception.errors, [
+            (1, 'Could not parse the amount of memory "lots"'),
+            (1, 'Invalid time limit: Could not find a time in "forever"'),
+            (3, 'Unrecognized job directive cores in # drmr:job cores=4 destination=nowhere'),
+            (5, 'Slurm has no destination "nowhere"'),
+        ])
+        self.assertEqual(self.simulator.get_jobs(), {})
+
+        # the destinations are listed once, and a valid script is submitted as usual
+        pipeline = drmr.pipeline.Pipeline('sample2', self.resource_manager, destination='simulated', working_directory=self.tmpdir)
+        pipeline.add_script('# drmr:job destination=simulated memory=4g\necho 1\n')
+        probes = self.simulator.get_statistics().get('scontrol', 0)
+        self.assertEqual(len(pipeline.submit().job_ids), 1)
+        self.assertEqual(self.simulator.get_statistics().get('scontrol', 0), probes)
+
+        # the listing is cached with the capabilities, so the next process doesn't list them again
+        drmr.drm.base.DistributedResourceManager.probed_capabilities.clear()
+        resource_manager = drmr.config.get_resource_manager('Slurm')
+        resource_manager.capture_process_output = self.simulator.capture_process_output
+        pipeline = drmr.pipeline.Pipeline('sample3', resource_manager, destination='simulated', working_directory=self.tmpdir)
+        pipeline.add_command('echo 1')
+        self.assertEqual(len(pipeline.submit().job_ids), 1)
+        self.assertEqual(self.simulator.get_statistics().get('scontrol', 0), probes)
+
+    def test_partition_lists(self):
+        self.simulator.configure(partitions=['simulated', 'other'])
+        pipeline = drmr.pipeline.Pipeline('sample1', self.resource_manager, working_directory=self.tmpdir)
+        pipeline.add_script('# drmr:job destination=simulated,other\necho 1\n# drmr:job destination=other,nowhere,elsewhere\necho 2\n')
+        with self.assertRaises(drmr.exceptions.ValidationError) as context:
+            pipeline.submit()
+        self.assertEqual(context.exception.errors, [
+            (3, 'Slurm has no destination "nowhere"'),
+            (3, 'Slurm has no destination "elsewhere"'),
+        ])
+
+        pipeline = drmr.pipeline.Pipeline('sample2', self.resource_manager, destination='other,simulated', working_directory=self.tmpdir)
+        pipeline.add_script('echo 1\n# drmr:job destination=simulated,other\necho 2\n')
+        self.assertEqual(len(pipeline.submit().job_ids), 2)
+        jobs = self.get_jobs_by_name()
+        self.assertEqual(jobs['sample2.1']['destination'], 'other,simulated')
+        self.assertEqual(jobs['sample2.2']['destination'], 'simulated,other')
+
+    def test_script_rereading(self):
+        script_filename = os.path.join(self.tmpdir, 'script')
+        with open(script_filename, 'w') as script_file:
+            script_file.write('echo 1\n# drmr:wait\necho 2 \\\n  3\n')
+
+        # a file is read again from where it was when it was added, not kept in memory
+        with open(script_filename) as script_file:
+            script_file.readline()
+            pipeline = drmr.pipeline.Pipeline('sample1', self.resource_manager, working_directory=self.tmpdir)
+            pipeline.add_script(script_file)
+            self.assertEqual(pipeline.script[0].buffer, None)
+            self.assertEqual(len(pipeline.submit().job_ids), 1)
+            self.assertEqual(list(pipeline.iter_script()), [(1, '# drmr:wait'), (2, 'echo 2 3')])
+
+        # a stream that can't be read again, like a pipe, is kept as it's first read
+        lines = ['echo 1\n', '# drmr:wait\n', 'echo 2\n']
+        pipeline = drmr.pipeline.Pipeline('sample2', self.resource_manager, working_directory=self.tmpdir)
+        pipeline.add_script(iter(lines))
+        self.assertEqual(len(pipeline.submit().job_ids), 2)
+        self.assertEqual(pipeline.script[0].buffer, lines)
+
+        script_lines = drmr.script.ScriptLines(iter(lines))
+        self.assertEqual(next(iter(script_lines)), 'echo 1\n')
+        self.assertEqual(list(script_lines), lines)
+        self.assertEqual(list(script_lines), lines)
+
+    def test_right_size(self):
+        self.simulator.configure(runtime=0, job_memory=1000)
+
+        def submit(sample, right_size):
+            pipeline = drmr.pipeline.Pipeline(sample, self.resource_manager, working_directory=self.tmpdir)
+            pipeline.job(processors=4, processor_memory=32000, time_limit='48:00:00')
+            pipeline.add_command('bwa mem -t 4 ref.fa /data/{}.fq'.format(sample))
+            pipeline.submit(right_size=right_size)
+            return pipeline
+
+        for sample in ['sample1', 'sample2', 'sample3']:
+            self.assertEqual(submit(sample, 'suggest').right_sizer.format_suggestions(), None)
+
+        pipeline = submit('sample4', 'suggest')
+        self.assertIn('suggested memory=1500 time_limit=0:05:00, from 3 earlier runs', pipeline.right_sizer.format_suggestions())
+        with open(self.get_jobs_by_name()['sample4.1']['script']) as job_script:
+            self.assertIn('--mem-per-cpu=32000', job_script.read())
+
+        submit('sample5', 'apply')
+        with open(self.get_jobs_by_name()['sample5.1']['script']) as job_script:
+            script = job_script.read()
+        self.assertIn('--mem=1500', script)
+        self.assertIn('--time=00:05:00', script)
+        self.assertNotIn('--mem-per-cpu', script)
+
+        with drmr.history.JobHistory() as history:
+            self.assertEqual(len(history.get_usage('Slurm', 'bwa mem -t 4 ref.fa sample9.fq', 4)), 4)
+            self.assertEqual(history.get_usage('Slurm', 'bwa mem -t 4 ref.fa sample9.fq', 1), [])
+        self.assertRaises(ValueError, submit, 'sample6', 'always')
+
+        # planning uses the history as it is, without asking for the usage of finished jobs
+        sacct_calls = self.simulator.get_statistics()['sacct']
+        pipeline = drmr.pipeline.Pipeline('sample7', self.resource_manager, working_directory=self.tmpdir)
+        pipeline.job(processors=4, processor_memory=32000, time_limit='48:00:00')
+        pipeline.add_command('bwa mem -t 4 ref.fa /data/sample7.fq')
+        pipeline.plan(right_size='apply')
+        self.assertIn('suggested memory=1500', pipeline.right_sizer.format_suggestions())
+        self.assertEqual(self.simulator.get_statistics()['sacct'], sacct_calls)
+
+        # nor are array jobs right-sized
+        pipeline = drmr.pipeline.Pipeline('sample8', self.resource_manager, working_directory=self.tmpdir)
+        pipeline.job(processors=4, processor_memory=32000, time_limit='48:00:00')
+        for sample in ['sample8', 'sample9']:
+            pipeline.add_command('bwa mem -t 4 ref.fa /data/{}.fq'.format(sample))
+        pipeline.submit(right_size='apply', arrays=True)
+        self.assertEqual(pipeline.right_sizer.format_suggestions(), None)
+
+    def test_plan(self):
+        pipeline = drmr.pipeline.Pipeline('sample1', self.resource_manager, working_directory=self.tmpdir)
+        pipeline.job(processors=4, time_limit='2h')
+        for i in range(3):
+            pipeline.add_command('echo {}'.format(i))
+        pipeline.wait()
+        pipeline.job(processors=2, time_limit='30m')
+        pipeline.add_command('echo merge')
+        pipeline.wait()
+        pipeline.job()
+        pipeline.add_command('echo done')
+        job_graph = pipeline.plan()
+
+        summary = job_graph.summarize()
+        self.assertEqual([stage['jobs'] for stage in summary['stages']], [3, 1, 1])
+        self.assertEqual(summary['submissions'], 11)
+        self.assertEqual(summary['core_hours'], 25.0)
+        self.assertEqual(summary['jobs_without_time_limit'], 1)
+        self.assertEqual((summary['widest_stage'], summary['widest_stage_jobs']), (1, 3))
+        self.assertEqual(summary['makespan'], 9000)
+        self.assertEqual(summary['critical_path'], ['sample1.1', 'sample1.4.success', 'sample1.5', 'sample1.6.success', 'sample1.success'])
+        self.assertEqual(job_graph.dependencies['sample1.5'], ['sample1.4.success'])
+
+        # nothing was submitted or written
+        self.assertEqual(self.simulator.get_jobs(), {})
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, '.drmr')))
+
+        dot_filename = os.path.join(self.tmpdir, 'plan.dot')
+        job_graph.write(dot_filename)
+        with open(dot_filename) as dot_file:
+            self.assertIn('"sample1.4.success" -> "sample1.5";', dot_file.read())
+        json_filename = os.path.join(self.tmpdir, 'plan.json')
+        job_graph.write(json_filename)
+        with open(json_filename) as json_file:
+            self.assertEqual(len(json.load(json_file)['jobs']), 8)
+
+        # array tasks are counted as jobs, but need fewer submissions
+        summary = pipeline.plan(arrays=True).summarize()
+        self.assertEqual((summary['jobs'], summary['submissions'], summary['core_hours']), (5, 9, 25.0))
+
+        # the planned pipeline can still be submitted
+        self.assertEqual(len(pipeline.submit().job_ids), 5)
+
+    def test_plan_without_probing(self):
+        pipeline = drmr.pipeline.Pipeline('sample1', self.resource_manager, working_directory=self.tmpdir)
+        pipeline.job(processors=4, time_limit='2h')
+        for i in range(1500):
+            pipeline.add_command('echo {}'.format(i))
+
+        # without cached capabilities, arrays are split at the planner's default size;
+        # there are two arrays, then the completion jobs
+        summary = pipeline.plan(arrays=True).summarize()
+        self.assertEqual((summary['jobs'], summary['submissions']), (1500, 4))
+        self.assertEqual(self.simulator.get_statistics(), {})
+
+        # with them, at the workload manager's limit
+        self.simulator.configure(max_array_size=101)
+        self.resource_manager.get_capabilities()
+        probes = self.simulator.get_statistics()
+        summary = pipeline.plan(arrays=True).summarize()
+        self.assertEqual((summary['jobs'], summary['submissions']), (1500, 17))
+        self.assertEqual(self.simulator.get_statistics(), probes)
+
+
+class FakeSlurm(drmr.drm.Slurm.Slurm):
+    """A Slurm that records the jobs it's given instead of submitting them, giving each an ID made from its name."""
+
+    def __init__(self, config=None):
+        super(FakeSlurm, self).__init__(config)
+        self.job_files = {}
+        self.dependencies = {}
+        self.lock = threading.Lock()
+
+    def get_capabilities(self, refresh=False):
+        return self.make_capabilities(True, 'fake')
+
+    def write_job_file(self, job_data):
+        with self.lock:
+            self.job_files[job_data['job_name']] = job_data
+        return job_data['job_name']
+
+    def submit(self, job_file, hold=False, arguments=None):
+        # so concurrent submissions finish out of order
+        time.sleep(random.random() / 1000)
+        job_id = 'id.' + job_file
+        with self.lock:
+            dependencies = self.job_files[job_file].get('dependencies') or {}
+            self.dependencies[job_id] = dict((state, sorted(job_ids)) for state, job_ids in dependencies.items())
+        return job_id
+
+
+class TestConcurrentSubmission(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrconcurrencytest')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def submit(self, concurrency):
+        """Submit a pipeline, returning its result, the jobs' dependencies, the sizes of the batches of jobs submitted, and its cancel script."""
+        resource_manager = FakeSlurm()
+        pipeline = drmr.pipeline.Pipeline('sample', resource_manager, working_directory=tempfile.mkdtemp(dir=self.tmpdir))
+        for i in range(200):
+            pipeline.add_command('echo {}'.format(i))
+        pipeline.wait()
+        for i in range(3):
+            pipeline.add_command('echo merge {}'.format(i))
+
+        flushes = []
+        submit_jobs = drmr.pipeline.submit_jobs
+
+        def record_flush(resource_manager, jobs, *args, **kwargs):
+            if jobs:
+                flushes.append(len(jobs))
+            return submit_jobs(resource_manager, jobs, *args, **kwargs)
+
+        drmr.pipeline.submit_jobs = record_flush
+        try:
+            result = pipeline.submit(submit_concurrency=concurrency)
+        finally:
+            drmr.pipeline.submit_jobs = submit_jobs
+
+        with open(os.path.join(resource_manager.set_control_directory(dict(pipeline.template_data)), 'sample.cancel')) as cancel_script:
+            return result, resource_manager.dependencies, flushes, cancel_script.read()
+
+    def test_matches_serial_submission(self):
+        serial_result, serial_dependencies, serial_flushes, serial_cancel_script = self.submit(1)
+        result, dependencies, flushes, cancel_script = self.submit(2)
+
+        self.assertEqual(result, serial_result)
+        self.assertEqual(result.job_ids[:3], ['id.sample.1', 'id.sample.2', 'id.sample.3'])
+        self.assertEqual(dependencies, serial_dependencies)
+        self.assertEqual(dependencies['id.sample.202'], {'ok': ['id.sample.201.success']})
+        self.assertEqual(cancel_script, serial_cancel_script)
+
+        # serially, each job is submitted as it's read; with two at
+        # once, up to 128 are queued, and the queue is flushed at the
+        # wait directive and the end of the script
+        self.assertEqual(serial_flushes, [1] * 203)
+        self.assertEqual(flushes, [128, 72, 3])
+
+    def test_arrays_with_single_jobs(self):
+        def submit(concurrency):
+            resource_manager = FakeSlurm()
+            pipeline = drmr.pipeline.Pipeline('sample', resource_manager, working_directory=tempfile.mkdtemp(dir=self.tmpdir))
+            for i in range(1, 6):
+                pipeline.job(processors=i)
+                pipeline.add_command('echo {}'.format(i))
+            pipeline.job()
+            for i in range(3):
+                pipeline.add_command('echo array {}'.format(i))
+            pipeline.job(processors=8)
+            pipeline.add_command('echo 8')
+
+            calls = []
+            submit_jobs = drmr.pipeline.submit_jobs
+
+            def record_call(resource_manager, jobs, concurrency=1, *args, **kwargs):
+                calls.append((len(jobs), concurrency))
+                return submit_jobs(resource_manager, jobs, concurrency, *args, **kwargs)
+
+            drmr.pipeline.submit_jobs = record_call
+            try:
+                return pipeline.submit(submit_concurrency=concurrency, arrays=True), calls
+            finally:
+                drmr.pipeline.submit_jobs = submit_jobs
+
+        serial_result, serial_calls = submit(1)
+        result, calls = submit(4)
+        self.assertEqual(result, serial_result)
+        self.assertEqual(result.job_ids[:5], ['id.sample.{}'.format(i) for i in range(1, 6)])
+        self.assertEqual(result.job_ids[6], 'id.sample.9')
+
+        # the six jobs that aren't in the array are submitted together, four at a time
+        self.assertEqual(calls, [(6, 4)])
+
+
+class TestHistory(unittest.TestCase):
+
+    def test_fingerprints(self):
+        self.assertEqual(drmr.history.normalize_command('bwa mem -t 4 ref.fa /data/s1.fq > s1.sam'), 'bwa mem -t # *.fa *.fq > *.sam')
+        self.assertEqual(drmr.history.make_command_fingerprint('bwa mem -t 4 ref.fa /data/s1.fq'), drmr.history.make_command_fingerprint('bwa  mem -t 8 ref.fa /other/HepG2_rep2.fq'))
+        self.assertNotEqual(drmr.history.make_command_fingerprint('python3 align.py s1.fq'), drmr.history.make_command_fingerprint('python3 merge.py s1.fq'))
+
+    def test_usage_parsing(self):
+        self.assertEqual(drmr.drm.Slurm.parse_slurm_duration('1-02:03:04'), 93784)
+        self.assertEqual(drmr.drm.Slurm.parse_slurm_duration('03:04.567'), 185)
+        self.assertEqual(drmr.drm.Slurm.parse_slurm_duration(''), None)
+        # memory units are decimal, as in requests, and partial megabytes are rounded up
+        self.assertEqual(drmr.drm.Slurm.parse_slurm_memory('2000K'), 2)
+        self.assertEqual(drmr.drm.Slurm.parse_slurm_memory('2048K'), 3)
+        self.assertEqual(drmr.drm.Slurm.parse_slurm_memory('1.5G'), drmr.util.normalize_memory('1500m'))
+        self.assertEqual(drmr.drm.Slurm.parse_slurm_memory(''), None)
+        self.assertEqual(drmr.drm.PBS.parse_pbs_duration('01:02:03'), 3723)
+        self.assertEqual(drmr.drm.PBS.parse_pbs_memory('100000kb'), 100)
+        self.assertEqual(drmr.drm.PBS.parse_pbs_memory('4gb'), drmr.util.normalize_memory('4gb'))
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrprofilertest')
+        self.oldcachedir = os.environ.get('DRMR_CACHE_DIR')
+        os.environ['DRMR_CACHE_DIR'] = self.tmpdir
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        restore_environment_variable('DRMR_CACHE_DIR', self.oldcachedir)
+
+    def test_disabled(self):
+        profiler = drmr.profile.Profiler(enabled=False)
+        with profiler.phase('parse'):
+            pass
+        self.assertEqual(profiler.summarize(), [])
+
+    def test_summary(self):
+        profiler = drmr.profile.Profiler()
+        for job_name in ['test.1', 'test.2']:
+            with profiler.phase('render', job_name):
+                pass
+        with profiler.phase('submit', 'test.1'):
+            pass
+
+        summary = profiler.summarize()
+        self.assertEqual([(phase['phase'], phase['count']) for phase in summary], [('render', 2), ('submit', 1)])
+        self.assertIn('render', profiler.format_summary())
+
+    def test_job_file_phases(self):
+        resource_manager = drmr.config.get_resource_manager('Slurm')
+        resource_manager.profiler = drmr.profile.Profiler()
+        job_data = {
+            'command': 'true',
+            'job_name': 'test.1',
+            'master_job_name': 'test',
+            'submission_directory': self.tmpdir,
+            'timestamp': '20160101000000',
+        }
+        resource_manager.write_job_file(job_data)
+
+        trace_filename = resource_manager.make_profile_filename(job_data)
+        resource_manager.profiler.write_trace(trace_filename)
+        with open(trace_filename) as trace_file:
+            trace = json.load(trace_file)
+
+        self.assertEqual([(event['phase'], event['job']) for event in trace['events']], [('render', 'test.1'), ('write', 'test.1')])
+        self.assertEqual(os.path.dirname(trace_filename), job_data['control_directory'])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_adaptation(self):
+        rate_limiter = drmr.ratelimit.RateLimiter(10, min_rate=2)
+        for i in range(4):
+            rate_limiter.slow_down()
+        self.assertEqual(rate_limiter.rate, 2)
+        for i in range(20):
+            rate_limiter.speed_up()
+        self.assertEqual(rate_limiter.rate, 10)
+
+    def test_acquire(self):
+        rate_limiter = drmr.ratelimit.RateLimiter(100, burst=5)
+        start = time.time()
+        for i in range(15):
+            rate_limiter.acquire()
+        # the first five are free
+        self.assertTrue(0.09 <= time.time() - start < 1)
+
+
+class TestDrmrScript(unittest.TestCase):
+
+    def setUp(self):
+        self.oldcwd = os.getcwd()
+        self.tmpdir = tempfile.mkdtemp(prefix='drmrscripttest')
+        os.chdir(self.tmpdir)
+
+        self.simulator = drmr.simulator.Simulator(os.path.join(self.tmpdir, 'simulator'))
+        self.simulator.install(os.path.join(self.tmpdir, 'bin'), PACKAGE_DIRECTORY)
+        with open('.drmrc', 'w') as drmrc:
+            json.dump({'resource_manager': 'Slurm'}, drmrc)
+
+        self.script_directory = os.path.join(PACKAGE_DIRECTORY, 'scripts')
+        self.environment = dict(
+            os.environ,
+            DRMR_CACHE_DIR=self.tmpdir,
+            HOME=self.tmpdir,
+            PATH=os.path.join(self.tmpdir, 'bin') + os.pathsep + os.environ['PATH'],
+            PYTHONPATH=PACKAGE_DIRECTORY,
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        os.chdir(self.oldcwd)
+
+    def run_script(self, name, *args):
+        command = [sys.executable, os.path.join(self.script_directory, name)] + list(args)
+        return subprocess.check_output(command, env=self.environment, stderr=subprocess.STDOUT, universal_newlines=True)
+
+    def write_pipeline(self, text):
+        with open('pipeline', 'w') as pipeline:
+            pipeline.write(text)
+
+    def get_jobs_by_name(self):
+        return dict((job['name'], job) for job in self.simulator.get_jobs().values())
+
+    def test_barriers(self):
+        self.write_pipeline('echo 1\necho 2\n# drmr:wait\necho 3\n')
+        self.run_script('drmr', 'pipeline')
+        jobs = self.get_jobs_by_name()
+        self.assertEqual(sorted(jobs), ['pipeline.1', 'pipeline.2', 'pipeline.3.finish', 'pipeline.3.success', 'pipeline.4', 'pipeline.finish', 'pipeline.success'])
+        self.assertEqual(jobs['pipeline.4']['dependencies'], {'ok': [jobs['pipeline.3.success']['job_id']]})
+
+    def test_direct_dependencies(self):
+        self.write_pipeline('echo 1\necho 2\n# drmr:wait\n# drmr:wait\necho 3\n# drmr:wait\necho 4\n')
+        self.run_script('drmr', '--direct-dependencies', 'pipeline')
+        jobs = self.get_jobs_by_name()
+        self.assertEqual(sorted(jobs), ['pipeline.1', 'pipeline.2', 'pipeline.3', 'pipeline.4', 'pipeline.finish', 'pipeline.success'])
+        self.assertEqual(sorted(jobs['pipeline.3']['dependencies']['ok']), sorted([jobs['pipeline.1']['job_id'], jobs['pipeline.2']['job_id']]))
+        self.assertEqual(jobs['pipeline.4']['dependencies'], {'ok': [jobs['pipeline.3']['job_id']]})
+        self.assertEqual(jobs['pipeline.success']['dependencies'], {'ok': [jobs['pipeline.4']['job_id']]})
+
+    def test_pack(self):
+        self.write_pipeline('echo 1\necho 2\necho 3\n# drmr:pack size=2\n# drmr:job processors=2\necho 4\nexit 5\necho 6\n')
+        self.run_script('drmr', '--pack', '3', 'pipeline')
+        jobs = self.get_jobs_by_name()
+        self.assertEqual(sorted(jobs), ['pipeline.1', 'pipeline.2', 'pipeline.3', 'pipeline.finish', 'pipeline.success'])
+
+        # the second job's commands run in parallel, and it fails because one did
+        job_script = jobs['pipeline.2']['script']
+        with open(os.devnull, 'w') as devnull:
+            self.assertNotEqual(subprocess.call(['bash', job_script], stdout=devnull, stderr=subprocess.STDOUT), 0)
+        with open(os.path.join(os.path.dirname(job_script), 'pipeline.2.status')) as status_file:
+            self.assertEqual(sorted(status_file.read().splitlines()), ['1 0', '2 5'])
+
+    def test_pack_directive(self):
+        self.assertEqual(drmr.script.parse_directive('# drmr:pack size=10'), ('pack', 'size=10'))
+        self.assertEqual(drmr.script.parse_pack_size('size=10'), 10)
+        self.assertEqual(drmr.script.parse_pack_size('default', 4), 4)
+        self.assertRaises(ValueError, drmr.script.parse_directive, '# drmr:pack size=0')
+
+    def test_resume(self):
+        self.write_pipeline('echo 1\necho 2\n# drmr:wait\necho 3\n')
+        self.run_script('drmr', 'pipeline')
+        first_run = set(self.simulator.get_jobs())
+        control_directory = os.path.dirname(self.get_jobs_by_name()['pipeline.1']['script'])
+        with open(self.get_jobs_by_name()['pipeline.1']['script']) as job_script:
+            self.assertIn('markers/' + drmr.script.make_command_key('echo 1', {}), job_script.read())
+
+        # pretend the first command succeeded
+        open(os.path.join(control_directory, 'markers', drmr.script.make_command_key('echo 1', {})), 'w').close()
+        self.run_script('drmr', '--resume', control_directory, 'pipeline')
+        resumed = dict((job_id, job) for job_id, job in self.simulator.get_jobs().items() if job_id not in first_run)
+        self.assertEqual(sorted(job['name'] for job in resumed.values()), ['pipeline.2', 'pipeline.3.finish', 'pipeline.3.success', 'pipeline.4', 'pipeline.finish', 'pipeline.success'])
+
+        # once every command has succeeded, there's nothing to do
+        for command in ['echo 2', 'echo 3']:
+            open(os.path.join(control_directory, 'markers', drmr.script.make_command_key(command, {})), 'w').close()
+        output = self.run_script('drmr', '--resume', control_directory, 'pipeline')
+        self.assertIn('Nothing to resume', output)
+
+    def test_shared_job_scripts(self):
+        self.write_pipeline('echo 1\necho 2\n# drmr:job processors=2\necho 3\n')
+        self.run_script('drmr', '--shared-job-scripts', 'pipeline')
+        jobs = self.get_jobs_by_name()
+
+        control_directory = os.path.dirname(jobs['pipeline.1']['script'])
+        job_scripts = [filename for filename in os.listdir(control_directory) if filename.startswith('pipeline.') and filename.endswith('.slurm')]
+        self.assertEqual(sorted(job_scripts), ['pipeline.finish.slurm', 'pipeline.shared.1.slurm', 'pipeline.shared.2.slurm', 'pipeline.success.slurm'])
+        self.assertEqual(jobs['pipeline.1']['script'], jobs['pipeline.2']['script'])
+        self.assertNotEqual(jobs['pipeline.1']['script'], jobs['pipeline.3']['script'])
+
+        for job_name, index in [('pipeline.1', '1'), ('pipeline.2', '2'), ('pipeline.3', '3')]:
+            job = jobs[job_name]
+            self.assertEqual(job['environment'], {'DRMR_COMMAND_INDEX': index})
+            output = subprocess.check_output(['bash', job['script']], env=dict(os.environ, DRMR_COMMAND_INDEX=index), universal_newlines=True)
+            self.assertEqual(output, index + '\n')
+
+    def test_arrays(self):
+        self.write_pipeline('echo 1\necho 2\necho 3\n# drmr:job processors=2\necho 4\n# drmr:wait\necho 5\necho 6\n')
+        self.run_script('drmr', '--arrays', 'pipeline')
+        jobs = self.get_jobs_by_name()
+        self.assertEqual(sorted(jobs), ['pipeline.1-3', 'pipeline.4', 'pipeline.5.finish', 'pipeline.5.success', 'pipeline.6-7', 'pipeline.finish', 'pipeline.success'])
+        self.assertEqual(jobs['pipeline.5.success']['dependencies'], {'ok': [jobs['pipeline.1-3']['job_id'], jobs['pipeline.4']['job_id']]})
+        self.assertEqual(jobs['pipeline.6-7']['dependencies'], {'ok': [jobs['pipeline.5.success']['job_id']]})
+
+        # each task runs its own command, with or without a command table
+        for options in [[], ['--shared-job-scripts']]:
+            self.run_script('drmr', *(['--arrays', '-j', 'shared' if options else 'inline'] + options + ['pipeline']))
+            job_script = self.get_jobs_by_name()['{}.1-3'.format(options and 'shared' or 'inline')]['script']
+            for index in ['1', '3']:
+                output = subprocess.check_output(['bash', job_script], env=dict(os.environ, SLURM_ARRAY_TASK_ID=index), universal_newlines=True)
+                self.assertEqual(output, index + '\n')
+
+    def test_status(self):
+        self.write_pipeline('echo 1\necho 2\n# drmr:wait\necho 3\n')
+        completion_job_id = self.run_script('drmr', 'pipeline').strip()
+        jobs = self.get_jobs_by_name()
+        control_directory = os.path.dirname(jobs['pipeline.1']['script'])
+
+        with open(os.path.join(control_directory, 'pipeline.jobs.json')) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(manifest['stages'], [[jobs['pipeline.1']['job_id'], jobs['pipeline.2']['job_id']], [jobs['pipeline.4']['job_id']]])
+        self.assertEqual(manifest['completion_job_id'], completion_job_id)
+
+        output = self.run_script('drmrstatus', completion_job_id)
+        self.assertIn('Total           3        3        0        0        0        0', output)
+
+        # every state is fetched at once
+        squeue_calls = self.simulator.get_statistics().get('squeue', 0)
+        self.simulator.configure(runtime=0)
+        output = self.run_script('drmrstatus', '--watch', '--interval', '0.1', control_directory)
+        self.assertIn('Total           3        0        0        3        0        0', output)
+        self.assertEqual(self.simulator.get_statistics()['sacct'], 2)
+        self.assertEqual(self.simulator.get_statistics().get('squeue', 0), squeue_calls)
+
+    def test_telemetry(self):
+        with open('.drmrc', 'w') as drmrc:
+            json.dump({'resource_manager': 'Slurm', 'telemetry_interval': 0.05}, drmrc)
+        self.write_pipeline('echo 1\nsleep 0.2\n# drmr:wait\nexit 3\n')
+        self.run_script('drmr', '--telemetry', 'pipeline')
+        jobs = self.get_jobs_by_name()
+        control_directory = os.path.dirname(jobs['pipeline.1']['script'])
+        with open(jobs['pipeline.success']['script']) as job_script:
+            self.assertNotIn('drmr_telemetry', job_script.read())
+
+        # each job records how it went, and keeps its exit status
+        with open(os.devnull, 'w') as devnull:
+            for job_name, status in [('pipeline.1', 0), ('pipeline.2', 0), ('pipeline.4', 3)]:
+                job = jobs[job_name]
+                self.assertEqual(subprocess.call(['bash', job['script']], env=dict(os.environ, SLURM_JOB_ID=job['job_id']), stdout=devnull), status)
+                with open(os.path.join(control_directory, 'telemetry', job['job_id'] + '.json')) as record_file:
+                    record = json.load(record_file)
+                self.assertEqual(record['exit_code'], status)
+                self.assertEqual(record['processors'], 1)
+                self.assertIsNone(record['array_task_id'])
+                self.assertGreaterEqual(record['end'], record['start'])
+        self.assertEqual(sorted(os.listdir(os.path.join(control_directory, 'telemetry'))), sorted(jobs[job_name]['job_id'] + '.json' for job_name in ['pipeline.1', 'pipeline.2', 'pipeline.4']))
+        self.assertGreaterEqual(record['elapsed'], 0)
+
+        output = self.run_script('drmrreport', control_directory)
+        self.assertIn('Pipeline pipeline: 3 telemetry records', output)
+        self.assertIn('Slowest job in stage 1: job {}'.format(jobs['pipeline.2']['job_id']), output)
+        self.assertRegexpMatches(output, r'\n2 +1 +0 +1 ')
+
+
+class TestScriptParsing(unittest.TestCase):
+
+    def setUp(self):
+        self.script = '#!/bin/bash\necho 1\n\n# a comment\necho 2 \\\n  and 3\n# drmr:wait\necho 4 \\\n'
+
+    def test_iter_script(self):
+        self.assertEqual(
+            list(drmr.script.iter_script(self.script.splitlines(True))),
+            [(2, 'echo 1'), (5, 'echo 2 and 3'), (7, '# drmr:wait'), (8, 'echo 4 ')]
+        )
+
+    def test_parse_script(self):
+        self.assertEqual(drmr.script.parse_script(self.script), ['echo 1', 'echo 2 and 3', '# drmr:wait', 'echo 4 '])
+
+    def test_lazy(self):
+        def lines():
+            yield 'echo 1\n'
+            raise AssertionError('Read too far')
+
+        commands = drmr.script.iter_script(lines())
+        self.assertEqual(next(commands), (1, 'echo 1'))